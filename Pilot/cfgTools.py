@@ -0,0 +1,328 @@
+"""Reader and writer of the DIRAC configuration files (pilot.cfg)"""
+
+import os
+import sys
+import tempfile
+from shlex import quote
+from threading import RLock
+
+from threadTools import synchronized
+
+
+def splitConfigOption(option):
+    """
+    Split an "/Path/To/Option=value" string the way the DIRAC "-o" switch does.
+
+    :param str option: the option string
+    :return: (path, value), or None if it is not an "option=value" string
+    :rtype: tuple
+    """
+    fields = [field.strip() for field in option.split("=") if field]
+    if len(fields) < 2:
+        return None
+    return fields[0], "=".join(fields[1:])
+
+
+class CFG(object):
+    """
+    Minimal implementation of the DIRAC CFG format (DIRAC.Core.Utilities.CFG), enough to read,
+    update and write the local configuration file (pilot.cfg) inside the pilot process.
+
+    The file is written the same way DIRAC serializes it: 2 spaces indentation, section names followed
+    by a brace on a separate line, multi-valued options written as "option = v1" and "option += v2".
+    """
+
+    def __init__(self):
+        # entry name -> str (option) or CFG (section), in the order of the file
+        self._data = {}
+        self._comments = {}
+
+    def isSection(self, name):
+        return isinstance(self._data.get(name), CFG)
+
+    def listSections(self):
+        return [name for name in self._data if self.isSection(name)]
+
+    def listOptions(self):
+        return [name for name in self._data if not self.isSection(name)]
+
+    def __getitem__(self, name):
+        return self._data[name]
+
+    def __contains__(self, name):
+        return name in self._data
+
+    def _setComment(self, name, comment):
+        if comment:
+            self._comments[name] = comment
+
+    def createNewSection(self, name, comment=""):
+        """
+        Create a section (or return the existing one with the same name).
+
+        :param str name: section name
+        :param str comment: comment of the section
+        :return: the section
+        :rtype: CFG
+        """
+        if name in self._data and not self.isSection(name):
+            raise KeyError("%s is an option, not a section" % name)
+        self._setComment(name, comment)
+        return self._data.setdefault(name, CFG())
+
+    def setOption(self, name, value, comment=""):
+        if self.isSection(name):
+            raise KeyError("%s is a section, not an option" % name)
+        self._setComment(name, comment)
+        self._data[name] = str(value)
+
+    def appendToOption(self, name, value):
+        self._data[name] = self._data.get(name, "") + value
+
+    def _getLevels(self, path):
+        return [level.strip() for level in path.split("/") if level.strip()]
+
+    def setOptionInPath(self, path, value):
+        """
+        Set an option given by its absolute path, creating the sections on the way.
+
+        :param str path: option path, e.g. /LocalSite/BatchSystemInfo/Type
+        :param str value: option value
+        """
+        levels = self._getLevels(path)
+        if not levels:
+            raise KeyError("Invalid option path %s" % path)
+        section = self
+        for level in levels[:-1]:
+            section = section.createNewSection(level)
+        section.setOption(levels[-1], value)
+
+    def getOption(self, path, default=None):
+        """
+        Get an option value given by its absolute path.
+
+        :param str path: option path
+        :param default: value returned if the option does not exist
+        :return: option value (str)
+        """
+        target = self
+        for level in self._getLevels(path):
+            if not isinstance(target, CFG) or level not in target:
+                return default
+            target = target[level]
+        return default if isinstance(target, CFG) else target
+
+    def loadFromBuffer(self, data):
+        """
+        Load the content of a CFG string (same parsing rules as DIRAC).
+
+        :param str data: CFG content
+        :return: self
+        """
+        levelList = []
+        currentLevel = self
+        currentlyParsedString = ""
+        currentComment = ""
+        for line in data.split("\n"):
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("#"):
+                currentComment += "%s\n" % line.replace("#", "")
+                continue
+            for index in range(len(line)):
+                if line[index] == "{":
+                    currentlyParsedString = currentlyParsedString.strip()
+                    levelList.append(currentLevel)
+                    currentLevel = currentLevel.createNewSection(currentlyParsedString, currentComment)
+                    currentlyParsedString = ""
+                    currentComment = ""
+                elif line[index] == "}":
+                    if not levelList:
+                        raise ValueError("Error parsing CFG: unbalanced '}'")
+                    currentLevel = levelList.pop()
+                elif line[index] == "=":
+                    fields = line.split("=")
+                    currentLevel.setOption(fields[0].strip(), "=".join(fields[1:]).strip(), currentComment)
+                    currentlyParsedString = ""
+                    currentComment = ""
+                    break
+                elif line[index : index + 2] == "+=":
+                    fields = line.split("+=")
+                    currentLevel.appendToOption(fields[0].strip(), ", %s" % "+=".join(fields[1:]).strip())
+                    currentlyParsedString = ""
+                    currentComment = ""
+                    break
+                else:
+                    currentlyParsedString += line[index]
+        if currentlyParsedString.strip() or levelList:
+            raise ValueError("Error parsing CFG")
+        return self
+
+    def loadFromFile(self, fileName):
+        with open(fileName, "r") as fd:
+            return self.loadFromBuffer(fd.read())
+
+    def serialize(self, tabLevelString=""):
+        """
+        Serialize in the DIRAC CFG format.
+
+        :param str tabLevelString: indentation of this level
+        :return: CFG content
+        :rtype: str
+        """
+        indentation = "  "
+        cfgString = ""
+        for name, entry in self._data.items():
+            for commentLine in self._comments.get(name, "").split("\n"):
+                if commentLine.strip():
+                    cfgString += "%s#%s\n" % (tabLevelString, commentLine.strip())
+            if isinstance(entry, CFG):
+                cfgString += "%s%s\n%s{\n" % (tabLevelString, name, tabLevelString)
+                cfgString += entry.serialize(tabLevelString + indentation)
+                cfgString += "%s}\n" % tabLevelString
+            else:
+                valueList = [value.strip() for value in entry.split(",") if value.strip()]
+                if not valueList:
+                    cfgString += "%s%s = \n" % (tabLevelString, name)
+                else:
+                    cfgString += "%s%s = %s\n" % (tabLevelString, name, valueList[0])
+                    for value in valueList[1:]:
+                        cfgString += "%s%s += %s\n" % (tabLevelString, name, value)
+        return cfgString
+
+    def __str__(self):
+        return self.serialize()
+
+    def writeToFile(self, fileName):
+        """
+        Write the CFG to a file, atomically: the content goes to a temporary file in the same directory,
+        which is then renamed, so readers never see a partially written file.
+
+        :param str fileName: target file (if it is a symlink, its target is replaced)
+        """
+        fileName = os.path.realpath(fileName)
+        fd, tmpName = tempfile.mkstemp(dir=os.path.dirname(fileName), prefix=".%s." % os.path.basename(fileName))
+        try:
+            with os.fdopen(fd, "w") as tmpFile:
+                tmpFile.write(self.serialize())
+                tmpFile.flush()
+                os.fsync(tmpFile.fileno())
+            try:
+                os.chmod(tmpName, os.stat(fileName).st_mode & 0o7777)
+            except OSError:
+                os.chmod(tmpName, 0o644)
+            os.rename(tmpName, fileName)
+        except BaseException:
+            os.remove(tmpName)
+            raise
+
+
+class ConfigTransaction(object):
+    """
+    Options of the local configuration file (pilot.cfg) collected from several pilot commands,
+    and written in one go instead of one "dirac-configure -FDMH" call per command.
+
+    The options and switches are kept in the order of the commands adding them (then in the order they
+    are added), so committing them gives the same result as the sequential calls did, even if the commands
+    run concurrently: an option added later overrides the same option added earlier.
+
+    If only "-o /Path=value" options are pending, they are merged into the local configuration file
+    directly (see CFG), without starting dirac-configure. Other switches (e.g. "-n SiteName", which makes
+    dirac-configure query the Configuration Service) always go through dirac-configure.
+    """
+
+    def __init__(self, pilotParams):
+        """
+        c'tor
+
+        :param pilotParams: the pilot parameters, giving the configure script and the local cfg file
+        """
+        self._rlock = RLock()
+        self.pp = pilotParams
+        # (sequence, path, value) for options, (sequence, None, switch) for raw switches
+        self.pending = []
+        # set to False to always use dirac-configure
+        self.nativeWriter = True
+
+    @synchronized
+    def addOption(self, path, value, sequence=None):
+        """
+        Add an "-o path=value" option.
+
+        :param str path: absolute option path
+        :param value: option value
+        :param int sequence: position of the command adding it in the command list
+        """
+        self.pending.append((sequence, path, str(value)))
+
+    @synchronized
+    def addSwitch(self, switch, sequence=None):
+        """
+        Add a raw dirac-configure switch, e.g. '-n "SiteName"'.
+
+        :param str switch: the switch
+        :param int sequence: position of the command adding it in the command list
+        """
+        self.pending.append((sequence, None, switch))
+
+    @synchronized
+    def isEmpty(self):
+        return not self.pending
+
+    def _canWriteNatively(self, entries):
+        if not (self.nativeWriter and self.pp.localConfigFile and os.path.isfile(self.pp.localConfigFile)):
+            return False
+        return all(path is not None and path.startswith("/") for path, _value in entries)
+
+    def _writeNatively(self, entries):
+        """Merge the options into the local configuration file"""
+        cfg = CFG().loadFromFile(self.pp.localConfigFile)
+        for path, value in entries:
+            cfg.setOptionInPath(path, value.strip())
+        cfg.writeToFile(self.pp.localConfigFile)
+
+    def commit(self, command):
+        """
+        Write all pending options to the local configuration file, natively or with one dirac-configure call.
+
+        :param command: the pilot command on behalf of which dirac-configure is executed
+        :return: the dirac-configure return code (0 if nothing was pending)
+        :rtype: int
+        """
+        with self._rlock:
+            if not self.pending:
+                return 0
+            entries, self.pending = self.pending, []
+        # sorted() is stable: same command, same order
+        entries = [
+            (path, value)
+            for _sequence, path, value in sorted(entries, key=lambda e: sys.maxsize if e[0] is None else e[0])
+        ]
+
+        if self._canWriteNatively(entries):
+            try:
+                self._writeNatively(entries)
+                command.log.info("Updated %s with %d options" % (self.pp.localConfigFile, len(entries)))
+                return 0
+            except (IOError, OSError, KeyError, ValueError) as exc:
+                command.log.warn(
+                    "Could not update %s, using %s: %s" % (self.pp.localConfigFile, self.pp.configureScript, exc)
+                )
+
+        cfg = []
+        for path, value in entries:
+            cfg.append("-o %s" % quote("%s=%s" % (path, value)) if path is not None else value)
+        # these are needed as this is not the first time we call dirac-configure
+        cfg.append("-FDMH")
+        if self.pp.localConfigFile:
+            cfg.append("-O %s" % self.pp.localConfigFile)  # our target file for pilots
+            cfg.extend(["--cfg", self.pp.localConfigFile])  # this file is also an input
+        if self.pp.debugFlag:
+            cfg.append("-ddd")
+
+        configureCmd = "%s %s" % (self.pp.configureScript, " ".join(cfg))
+        retCode, _configureOutData = command.executeAndGetOutput(
+            configureCmd, self.pp.installEnv, capture="none"
+        )
+        return retCode
@@ -0,0 +1,304 @@
+"""CVMFS locations of the pilot, and warm-up of their caches"""
+
+import os
+import queue
+import re
+import sys
+import threading
+import time
+from threading import RLock
+
+from fileSystemTools import FileSystemProbe
+
+
+class CVMFSLocationMap(object):
+    """
+    Where the pilot finds things in the CVMFS repositories (CVMFS_locations), discovered once.
+
+    All the repositories, and the sub-paths looked for in each of them, are probed at once, with a
+    single deadline. The repositories that can be listed are the healthy ones, ranked by how long that
+    took: the consumers (the security directories, the preinstalled environment) get the fastest one
+    that has what they look for.
+    """
+
+    def __init__(self, locations, probes=None):
+        """c'tor
+
+        :param list locations: the CVMFS repositories
+        :param FileSystemProbe probes: the probe service (default: the shared one)
+        """
+        self.locations = [location for location in locations if location]
+        self.probes = probes or FileSystemProbe.get()
+        # seconds to list the repository, None if it can't be (unhealthy), by location
+        self.latency = {}
+        # operation, by sub-path
+        self.subPaths = {}
+
+    def discover(self, dirs=(), files=(), timeout=60):
+        """Probe all the repositories, and the sub-paths in each of them, concurrently
+
+        :param list dirs: sub-paths of directories, found if not empty
+        :param list files: sub-paths of files
+        :param float timeout: the longest time to wait for all of them, in seconds
+        :return: the healthy repositories, fastest first
+        :rtype: list
+        """
+        self.subPaths.update(dict.fromkeys(dirs, "listdir"))
+        self.subPaths.update(dict.fromkeys(files, "isfile"))
+        deadline = time.time() + timeout
+        for location in self.locations:
+            self.probes.submit("listdir", location)
+        for location in self.locations:
+            for subPath, operation in self.subPaths.items():
+                self.probes.submit(operation, os.path.join(location, subPath))
+        for location in self.locations:
+            self.latency[location] = None
+            if self.probes.listdir(location, max(0, deadline - time.time())):
+                self.latency[location] = self.probes.duration("listdir", location)
+        for location in self.healthy:
+            for subPath, operation in self.subPaths.items():
+                # they are cached by the probe service
+                getattr(self.probes, operation)(os.path.join(location, subPath), max(0, deadline - time.time()))
+        return self.healthy
+
+    @property
+    def healthy(self):
+        """The repositories that can be listed, fastest first"""
+        return sorted(
+            (location for location in self.locations if self.latency.get(location) is not None),
+            key=lambda location: self.latency[location],
+        )
+
+    def find(self, subPath, isFile=False, timeout=60):
+        """The sub-path in the fastest healthy repository that has it
+
+        :param str subPath: a sub-path (a non-empty directory, or a file), looked for in each repository
+        :param bool isFile: the sub-path is a file (if it was not discovered)
+        :param float timeout: the longest time to wait for a sub-path that was not discovered, in seconds
+        :return: the full path, or None if no repository has it
+        :rtype: str
+        """
+        if not self.latency and self.locations:
+            self.discover()
+        operation = self.subPaths.get(subPath, "isfile" if isFile else "listdir")
+        for location in self.healthy:
+            path = os.path.join(location, subPath)
+            if getattr(self.probes, operation)(path, timeout):
+                return path
+        return None
+
+
+class CVMFSWarmUp(object):
+    """
+    Reads ahead the DIRAC release in CVMFS, in background threads, while the pilot does other work:
+    the first DIRAC processes (dirac-configure, the JobAgent) then find its files in the CVMFS cache.
+
+    The files listed in the manifest are read first, then the Python package tree of the release,
+    until the budget (bytes, and seconds) is spent. The manifest has one path per line, relative to
+    the release directory (where diracosrc is); it can be recorded offline, see manifestFromTrace.
+    """
+
+    # files of the package tree that are read ahead
+    suffixes = (".py", ".pyc", ".so")
+    chunkSize = 1048576
+
+    def __init__(self, root, manifest=None, maxBytes=512 * 1048576, maxTime=600, threads=4):
+        """c'tor
+
+        :param str root: the release directory
+        :param str manifest: the manifest file (None: none)
+        :param int maxBytes: the most bytes read
+        :param float maxTime: the longest time spent reading, in seconds
+        :param int threads: the number of reading threads
+        """
+        self.root = root
+        self.manifest = manifest
+        self.maxBytes = maxBytes
+        self.maxTime = maxTime
+        self.threads = max(1, threads)
+        self._rlock = RLock()
+        self._stop = threading.Event()
+        # set once all the paths are queued
+        self._listed = threading.Event()
+        self._paths = queue.Queue(1000)
+        self._threads = []
+        self.startTime = None
+        self.files = 0
+        self.bytes = 0
+        self.errors = 0
+
+    @staticmethod
+    def manifestFromTrace(lines, root):
+        """The manifest of the files a process opened under the release directory, from its strace output
+        (e.g. strace -f -e trace=open,openat -o trace.txt dirac-pilot.py ...)
+
+        :param lines: the strace output lines
+        :param str root: the release directory
+        :return: the paths, relative to root, in the order they were opened
+        :rtype: list
+        """
+        root = root.rstrip("/") + "/"
+        paths = []
+        for line in lines:
+            match = re.search(r'open(?:at)?\(.*?"([^"]+)".*\)\s*=\s*(-?\d+)', line)
+            if match and int(match.group(2)) >= 0 and match.group(1).startswith(root):
+                path = match.group(1)[len(root) :]
+                if path not in paths:
+                    paths.append(path)
+        return paths
+
+    def start(self):
+        """Start the reading threads (they are daemons: they never delay the pilot exit)"""
+        self.startTime = time.time()
+        self._threads = [threading.Thread(target=self._list, name="CVMFSWarmUpList")]
+        for i in range(self.threads):
+            self._threads.append(threading.Thread(target=self._read, name="CVMFSWarmUp%d" % i))
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        """Stop reading (the files being read are finished)"""
+        self._stop.set()
+
+    @property
+    def done(self):
+        """True once all the threads are over"""
+        return not any(thread.is_alive() for thread in self._threads)
+
+    def wait(self, timeout=None):
+        """Wait for the end of the warm-up, at most timeout seconds
+
+        :return: True if it is over
+        :rtype: bool
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(0, deadline - time.time()))
+        return self.done
+
+    @property
+    def stopped(self):
+        """True if the budget is spent, or the warm-up stopped"""
+        if time.time() - self.startTime >= self.maxTime:
+            self._stop.set()
+        return self._stop.is_set()
+
+    def _put(self, path):
+        """Queue a path for the readers, unless stopped"""
+        while not self.stopped:
+            try:
+                self._paths.put(path, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _manifestPaths(self):
+        """The paths listed in the manifest"""
+        if not self.manifest:
+            return
+        try:
+            with open(self.manifest) as fp:
+                for line in fp:
+                    line = line.strip()
+                    if line and not line.startswith("#"):
+                        yield os.path.join(self.root, line)
+        except OSError as exc:
+            sys.stderr.write("CVMFS warm-up: manifest %s not read: %s\n" % (self.manifest, exc))
+
+    def _treePaths(self):
+        """The files of the package tree of the release"""
+        for dirPath, dirNames, fileNames in os.walk(self.root):
+            dirNames.sort()
+            for fileName in sorted(fileNames):
+                if fileName.endswith(self.suffixes):
+                    yield os.path.join(dirPath, fileName)
+
+    def _list(self):
+        """Body of the listing thread: the manifest, then the package tree"""
+        seen = set()
+        try:
+            for paths in (self._manifestPaths(), self._treePaths()):
+                for path in paths:
+                    if path not in seen:
+                        seen.add(path)
+                        if not self._put(path):
+                            return
+        finally:
+            self._listed.set()
+            # one end mark per reader, to end them at once (else they see _listed when the queue is empty)
+            for i in range(self.threads):
+                try:
+                    self._paths.put_nowait(None)
+                except queue.Full:
+                    break
+
+    def _read(self):
+        """Body of a reading thread"""
+        while not self.stopped:
+            try:
+                path = self._paths.get(timeout=1)
+            except queue.Empty:
+                if self._listed.is_set():
+                    return
+                continue
+            if path is None:
+                return
+            try:
+                with open(path, "rb") as fp:
+                    while not self.stopped:
+                        data = fp.read(self.chunkSize)
+                        if not data:
+                            break
+                        with self._rlock:
+                            self.bytes += len(data)
+                            if self.bytes >= self.maxBytes:
+                                self._stop.set()
+                with self._rlock:
+                    self.files += 1
+            except OSError:
+                with self._rlock:
+                    self.errors += 1
+
+    @property
+    def summary(self):
+        """Files and bytes read, errors, and time spent so far
+
+        :rtype: dict
+        """
+        with self._rlock:
+            return {
+                "files": self.files,
+                "bytes": self.bytes,
+                "errors": self.errors,
+                "seconds": round(time.time() - self.startTime, 3) if self.startTime else 0,
+            }
+
+
+def startCVMFSWarmUp(pilotParams, log):
+    """Start the warm-up of the DIRAC release in CVMFS, if requested and the release is there
+
+    :param pilotParams: the pilot parameters (warmUpCVMFS, warmUpManifest, warmUpBudget, warmUpTime)
+    :param log: the pilot logger
+    :return: the warm-up, or None
+    :rtype: CVMFSWarmUp
+    """
+    if not pilotParams.warmUpCVMFS:
+        return None
+    envScript = pilotParams.preinstalledEnv or pilotParams.locationMap.find(
+        pilotParams.preinstalledEnvSubPath, isFile=True
+    )
+    if not envScript:
+        log.info("CVMFS warm-up: no preinstalled release found")
+        return None
+    root = os.path.dirname(envScript)
+    manifest = pilotParams.warmUpManifest
+    if not manifest and FileSystemProbe.get().isfile(os.path.join(root, "warmup.manifest")):
+        manifest = os.path.join(root, "warmup.manifest")
+    warmUp = CVMFSWarmUp(
+        root, manifest, maxBytes=pilotParams.warmUpBudget * 1048576, maxTime=pilotParams.warmUpTime
+    )
+    log.info("CVMFS warm-up of %s (manifest: %s), in the background" % (root, manifest))
+    warmUp.start()
+    return warmUp
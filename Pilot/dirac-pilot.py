@@ -14,6 +14,14 @@ The pilot script defines two switches in order to choose a set of commands for t
     the list is CheckWorkerNode,InstallDIRAC,ConfigureBasics,RegisterPilot,CheckCECapabilities,CheckWNCapabilities,
                 ConfigureSite,ConfigureArchitecture,ConfigureCPURequirements,LaunchAgent
 
+Commands declaring the resources they need and produce (see schedulerTools.CommandScheduler) run concurrently
+when they don't depend on each other, with --maxParallelCommands greater than 1 (at most that many of
+them). The others, and all of them by default, run in the order of the command list.
+
+With --compileConfig, the script is a tool: the options of pilot.json (-F) applying to a CE (-N), queue (-Q),
+VO (--wnVO) and setup (-S) are written to <pilot.json>.compiled. Pilots given the same options use that
+small file instead of pilot.json, as long as the timestamp of pilot.json is the same.
+
 The pilot script by default performs initial sanity checks on WN, installs and configures
 DIRAC and runs the DIRAC JobAgent (https://github.com/DIRACGrid/DIRAC/blob/integration/src/DIRAC/WorkloadManagementSystem/Agent/JobAgent.py) to execute pending workloads in the DIRAC WMS.
 But, as said, all the actions are actually configurable.
@@ -24,13 +32,18 @@ import sys
 import time
 from io import StringIO
 
+from cvmfsTools import startCVMFSWarmUp
 from pilotTools import (
+    LogFile,
     Logger,
     PilotParams,
     RemoteLogger,
+    finaliseRemoteLogs,
     getCommand,
+    getRemoteLogPipeline,
     pythonPathCheck,
 )
+from schedulerTools import CommandScheduler
 
 ############################
 
@@ -45,6 +58,12 @@ if __name__ == "__main__":
     buffer.close()
     # print the buffer, so we have a "classic' logger back in sync.
     sys.stdout.write(bufContent)
+    if pilotParams.compileConfig:
+        # used as a tool: pilot.json is compiled for a CE, queue, VO and setup
+        pilotParams.writeCompiledConfig()
+        sys.exit(0)
+    if pilotParams.structuredLogging:
+        Logger.setStructured(pilotParams.pilotUUID)
     # now the remote logger.
     remote = pilotParams.pilotLogging and (pilotParams.loggerURL is not None)
     if remote:
@@ -53,21 +72,29 @@ if __name__ == "__main__":
         receivedContent = ""
         if not sys.stdin.isatty():
             receivedContent = sys.stdin.read()
+        # the pilot log pipeline: one buffer, flush timer and sender, for this logger and those of the commands
         log = RemoteLogger(
             pilotParams.loggerURL,
             "Pilot",
-            bufsize=pilotParams.loggerBufsize,
             pilotUUID=pilotParams.pilotUUID,
             debugFlag=pilotParams.debugFlag,
             wnVO=pilotParams.wnVO,
+            compact=pilotParams.loggerCompact,
+            buffer=getRemoteLogPipeline(pilotParams),
         )
         log.info("Remote logger activated")
-        log.buffer.write(receivedContent)
+        # as records, in structured mode
+        log.write(receivedContent)
         log.buffer.flush()
-        log.buffer.write(bufContent)
+        log.write(bufContent)
     else:
         log = Logger("Pilot", debugFlag=pilotParams.debugFlag)
 
+    try:
+        LogFile.setFlushPolicy(pilotParams.logFlushPolicy)
+    except ValueError as exc:
+        log.error("%s, flushing pilot.out after each message" % exc)
+
     if pilotParams.keepPythonPath:
         pythonPathCheck()
     else:
@@ -80,30 +107,68 @@ if __name__ == "__main__":
     pilotParams.pilotRootPath = os.getcwd()
     pilotParams.pilotScript = os.path.realpath(sys.argv[0])
     pilotParams.pilotScriptName = os.path.basename(pilotParams.pilotScript)
+    pilotParams.timing.startTime = pilotStartTime
+    pilotParams.timing.info = {
+        "pilotUUID": pilotParams.pilotUUID,
+        "site": pilotParams.site,
+        "ceName": pilotParams.ceName,
+        "queueName": pilotParams.queueName,
+    }
     log.debug("PARAMETER [%s]" % ", ".join(map(str, pilotParams.optList)))
 
     if pilotParams.commandExtensions:
         log.info("Requested command extensions: %s" % str(pilotParams.commandExtensions))
 
     log.info("Executing commands: %s" % str(pilotParams.commands))
+    if pilotParams.maxParallelCommands > 1:
+        log.info("Running up to %d independent commands concurrently" % pilotParams.maxParallelCommands)
 
     if remote:
-        # It's safer to cancel the timer here. Each command has got its own logger object with a timer cancelled by the
-        # finaliser. No need for a timer in the "else" code segment below.
-        try:
-            log.buffer.cancelTimer()
-            log.debug("Timer canceled")
-            log.buffer.flush()
-        except Exception as exc:
-            log.error(str(exc))
-    for commandName in pilotParams.commands:
+        # what was logged so far (e.g. by the pilot wrapper) can go now, without waiting
+        log.buffer.flush(wait=False)
+
+    def runCommand(sequence, commandName):
         command, module = getCommand(pilotParams, commandName)
-        if command is not None:
-            command.log.info("Command %s instantiated from %s" % (commandName, module))
-            command.execute()
-        else:
+        if command is None:
             log.error("Command %s could not be instantiated" % commandName)
-            # send the last message and abandon ship.
-            if remote:
-                log.buffer.flush()
+            # abandon ship (the remote log is finalised below)
             sys.exit(-1)
+        command.sequence = sequence
+        command.log.info("Command %s instantiated from %s" % (commandName, module))
+        executedCommands.append(command)
+        with pilotParams.timing.measure(commandName):
+            # options of the local configuration file are written in one go, when a command needs them
+            if command.needsLocalConfig:
+                command.commitLocalConfig()
+            command.execute()
+
+    def stopWarmUp(sequence=None, commandName=None):
+        # the warm-up must not compete with the payloads: it stops before the command running them
+        # (LaunchAgent), if not at the end
+        global warmUp
+        if warmUp is not None:
+            warmUp.stop()
+            log.info("CVMFS warm-up: %s" % warmUp.summary)
+            warmUp = None
+
+    executedCommands = []
+    scheduler = CommandScheduler(pilotParams, maxWorkers=pilotParams.maxParallelCommands)
+    # the release is read ahead in the background, while the first commands run
+    warmUp = startCVMFSWarmUp(pilotParams, log)
+    try:
+        try:
+            scheduler.run(runCommand, beforePayloads=stopWarmUp)
+        finally:
+            stopWarmUp()
+        # whatever is still pending (e.g. no LaunchAgent in the command list)
+        if executedCommands:
+            executedCommands[-1].commitLocalConfig()
+    except SystemExit as exCode:
+        if remote:
+            # the remote log is finalised once, whichever command exits
+            finaliseRemoteLogs(pilotParams, log, exCode)
+        raise
+    finally:
+        if remote:
+            log.buffer.flush()
+            log.buffer.cancelTimer()
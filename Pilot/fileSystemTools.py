@@ -0,0 +1,251 @@
+"""Checks of the file systems (CVMFS) that can't hang the pilot on a stuck mount"""
+
+import os
+import threading
+import time
+from collections import deque
+from threading import RLock
+from urllib.request import urlopen
+
+
+def readFileHead(path, size=4096):
+    """The first bytes of a file"""
+    with open(path, "rb") as fp:
+        return fp.read(size)
+
+
+def readURLHead(url, size=4096, timeout=60):
+    """The first bytes of an http(s) URL"""
+    with urlopen(url, timeout=timeout) as response:
+        return response.read(size)
+
+
+class FileSystemProbe(object):
+    """
+    Checks of paths of lazily-loaded file systems (CVMFS), that can't hang the pilot on a stuck mount.
+
+    The system calls are made by a small pool of worker threads, and the caller waits for at most
+    a timeout. A probe that times out goes on in its worker, which is replaced: at most maxStuck
+    probes can be stuck at once, after that the new ones fail at once. Only one probe of a path runs
+    at a time (the callers share it). The successful results are cached for cacheTTL seconds, so the
+    same checks of the CVMFS locations done by PilotParams and the commands are free: the cache assumes
+    read-only paths, a caller probing anything else passes cache=False. Failures are never cached, and the
+    negative results (False or None, e.g. of isfile) only for negativeCacheTTL seconds: a path may appear.
+    """
+
+    maxWorkers = 8
+    maxStuck = 8
+    cacheTTL = 300
+    negativeCacheTTL = 5
+    # a worker with nothing to do for that long stops
+    idleTimeout = 30
+
+    operations = {
+        "listdir": os.listdir,
+        "isfile": os.path.isfile,
+        "isdir": os.path.isdir,
+        "stat": os.stat,
+        "readHead": readFileHead,
+        "readURLHead": readURLHead,
+    }
+
+    _rlock = RLock()
+    _instance = None
+
+    def __init__(self):
+        """c'tor"""
+        self._cond = threading.Condition()
+        self._queue = deque()
+        # probes queued or running, by (operation, path, args)
+        self._pending = {}
+        # (expiry time, result, None, duration) of the successful probes, by (operation, path, args)
+        self._cache = {}
+        self._workers = 0
+        self._idle = 0
+        # probes that timed out and are still running
+        self._stuck = 0
+        self.hits = 0
+        self.timeouts = 0
+
+    @classmethod
+    def get(cls):
+        """The (shared) probe service"""
+        with cls._rlock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    @classmethod
+    def clear(cls):
+        """Forget the shared probe service (and its cache)"""
+        with cls._rlock:
+            cls._instance = None
+
+    def invalidate(self, path=None):
+        """Forget the cached results of a path, or of all the paths"""
+        with self._cond:
+            for key in list(self._cache):
+                if path is None or key[1] == path:
+                    del self._cache[key]
+
+    def _run(self):
+        """Body of a worker thread"""
+        with self._cond:
+            while True:
+                if not self._queue:
+                    self._idle += 1
+                    self._cond.wait(self.idleTimeout)
+                    self._idle -= 1
+                    if not self._queue:
+                        self._workers -= 1
+                        return
+                key, probe = self._queue.popleft()
+                probe["running"] = True
+                self._cond.release()
+                start = time.time()
+                try:
+                    result, exception = self.operations[key[0]](key[1], *key[2]), None
+                except Exception as exc:
+                    result, exception = None, exc
+                end = time.time()
+                self._cond.acquire()
+                ttl = self.negativeCacheTTL if result is None or result is False else self.cacheTTL
+                probe["outcome"] = (end + ttl, result, exception, end - start)
+                if exception is None and probe["cache"]:
+                    self._cache[key] = probe["outcome"]
+                del self._pending[key]
+                probe["done"] = True
+                if probe["stuck"]:
+                    # its worker was replaced: it is not needed any longer
+                    self._stuck -= 1
+                    self._workers -= 1
+                    self._cond.notify_all()
+                    return
+                self._cond.notify_all()
+
+    def _startWorker(self):
+        """Start a worker if the queued probes need one (called with the condition held)"""
+        if self._idle < len(self._queue) and self._workers - self._stuck < self.maxWorkers:
+            self._workers += 1
+            worker = threading.Thread(target=self._run, name="FileSystemProbe")
+            worker.daemon = True  # don't delay program's exit
+            worker.start()
+
+    def _submit(self, key, cache=True):
+        """The pending probe of key, queued if needed (called with the condition held)
+
+        :param bool cache: whether its result is to be cached (if successful)
+        :return: the probe, or None if too many probes are stuck
+        """
+        probe = self._pending.get(key)
+        if probe is None:
+            if self._stuck >= self.maxStuck:
+                return None
+            probe = self._pending[key] = {"running": False, "done": False, "stuck": False, "cache": cache}
+            self._queue.append((key, probe))
+            self._startWorker()
+            self._cond.notify_all()
+        probe["cache"] = probe["cache"] or cache
+        return probe
+
+    def submit(self, operation, path, *args, cache=True):
+        """Start an operation on a path, without waiting: probe() gets its (cached) result, wait() the result
+        of the probe returned (also without the cache)
+
+        :return: the probe, None if the result is cached, or if too many probes are stuck
+        """
+        key = (operation, path, args)
+        with self._cond:
+            cached = self._cache.get(key) if cache else None
+            if cached is None or cached[0] <= time.time():
+                return self._submit(key, cache)
+            return None
+
+    def duration(self, operation, path, *args):
+        """How long the (cached) operation on a path took, in seconds, None if it is not done"""
+        with self._cond:
+            cached = self._cache.get((operation, path, args))
+            return cached[3] if cached is not None else None
+
+    def probe(self, operation, path, timeout=60, *args, cache=True):
+        """Run an operation on a path, waiting for at most timeout seconds
+
+        :param str operation: one of operations
+        :param str path: the path
+        :param float timeout: the longest time to wait, in seconds
+        :param bool cache: whether to use (and fill) the cache, for read-only paths
+        :return: (True, the result) or (False, None) on timeout
+        :rtype: tuple
+        :raises OSError: as the operation does
+        """
+        key = (operation, path, args)
+        with self._cond:
+            cached = self._cache.get(key) if cache else None
+            if cached is not None and cached[0] > time.time():
+                self.hits += 1
+                return self._result(cached)
+            return self.wait(self._submit(key, cache), timeout)
+
+    def wait(self, probe, timeout=60):
+        """Wait for at most timeout seconds for the result of a probe returned by submit()
+
+        :return: (True, the result) or (False, None) on timeout, or if there is no probe
+        :rtype: tuple
+        :raises OSError: as the operation does
+        """
+        deadline = time.time() + timeout
+        with self._cond:
+            if probe is None:
+                self.timeouts += 1
+                return False, None
+            while not probe["done"]:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    if probe["running"] and not probe["stuck"]:
+                        # its worker is stuck: it does not count any more, and is replaced
+                        probe["stuck"] = True
+                        self._stuck += 1
+                        self._startWorker()
+                    return False, None
+                self._cond.wait(remaining)
+            return self._result(probe["outcome"])
+
+    @staticmethod
+    def _result(cached):
+        if cached[2] is not None:
+            raise cached[2]
+        return True, cached[1]
+
+    def listdir(self, directory, timeout=60, cache=True):
+        """The content of a directory (a new list), [] if it does not exist, None on timeout"""
+        try:
+            content = self.probe("listdir", directory, timeout, cache=cache)[1]
+            return list(content) if content is not None else None
+        except FileNotFoundError:
+            print("%s not found" % directory)
+        except OSError:
+            pass
+        return []
+
+    def isfile(self, path, timeout=60):
+        """True if path is an existing file, False if not, or on timeout"""
+        return bool(self.probe("isfile", path, timeout)[1])
+
+    def isdir(self, path, timeout=60):
+        """True if path is an existing directory, False if not, or on timeout"""
+        return bool(self.probe("isdir", path, timeout)[1])
+
+    def stat(self, path, timeout=60):
+        """os.stat() of a path, None if it does not exist, or on timeout"""
+        try:
+            return self.probe("stat", path, timeout)[1]
+        except OSError:
+            return None
+
+    def readHead(self, path, size=4096, timeout=60):
+        """The first size bytes of a file, None if it can't be read, or on timeout"""
+        try:
+            return self.probe("readHead", path, timeout, size)[1]
+        except OSError:
+            return None
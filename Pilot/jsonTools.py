@@ -0,0 +1,144 @@
+"""Read-only, lazily decoded JSON (pilot.json)"""
+
+import json
+import mmap
+import os
+import re
+from collections.abc import Mapping
+
+
+class LazyJSONObject(Mapping):
+    """
+    A JSON object of a (memory-mapped) file, read-only, whose members are decoded when first accessed.
+    The members are found by a scan skipping over their values, which stops at the member looked for.
+    Small values are decoded at once (as dict, list, str...), larger objects are LazyJSONObjects too:
+    of a pilot.json with all the CEs of a VO, only the sections a pilot reads are decoded and kept.
+    The values returned are shared with later lookups, so they must not be modified: copy() gives
+    a plain dict, decoded anew, that can be modified (or passed to json.dump).
+    """
+
+    # objects larger than this (in bytes) are decoded lazily
+    lazyThreshold = 65536
+
+    _string = rb'"[^"\\]*(?:\\.[^"\\]*)*"'
+    # everything up to the next bracket (outside strings)
+    _skip = re.compile(rb'[^"\[\]{}]*(?:' + _string + rb'[^"\[\]{}]*)*')
+    # a member name, and the start of its value
+    _member = re.compile(rb"\s*,?\s*(" + _string + rb")\s*:\s*")
+    # a value which is not an object or an array
+    _scalar = re.compile(_string + rb"|[^,}\]\s]+")
+    _closing = re.compile(rb"\s*}")
+
+    def __init__(self, data, start):
+        """c'tor
+
+        :param data: the JSON document (bytes, or an mmap)
+        :param int start: position of the opening brace of the object
+        """
+        self._data = data
+        self._start = start
+        # where the scan of the members goes on, and the position after the closing brace once found
+        self._pos = start + 1
+        self._end = None
+        # a large member object, to skip before going on
+        self._pending = None
+        # the position of the value of the members found so far
+        self._spans = {}
+        # the decoded values
+        self._values = {}
+
+    @classmethod
+    def load(cls, path):
+        """The content of a JSON file: a LazyJSONObject for an object (whatever its size), as decoded by json.load
+        otherwise. A large file is memory-mapped, a small one is read at once.
+        """
+        with open(path, "rb") as fp:
+            size = os.fstat(fp.fileno()).st_size
+            if size < cls.lazyThreshold:
+                data = fp.read()
+            else:
+                data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        start = re.compile(rb"\s*").match(data).end()
+        if data[start : start + 1] != b"{":
+            return json.loads(data[:])
+        return cls(data, start)
+
+    @classmethod
+    def _valueEnd(cls, data, start, limit=None):
+        """The position after the value starting at start, or None for an object larger than limit"""
+        if data[start : start + 1] not in (b"{", b"["):
+            match = cls._scalar.match(data, start)
+            if not match:
+                raise ValueError("Invalid JSON value at %d" % start)
+            return match.end()
+        isObject = data[start : start + 1] == b"{"
+        depth = 0
+        pos = start
+        while True:
+            pos = cls._skip.match(data, pos).end()
+            bracket = data[pos : pos + 1]
+            if bracket in (b"{", b"["):
+                depth += 1
+            elif bracket in (b"}", b"]"):
+                depth -= 1
+            else:
+                raise ValueError("Unterminated JSON value at %d" % start)
+            pos += 1
+            if depth == 0:
+                return pos
+            if limit and isObject and pos - start > limit:
+                return None
+
+    def copy(self):
+        """A plain dict of the object, with all its members decoded: it does not share anything with this object"""
+        return json.loads(self._data[self._start : self.end])
+
+    @property
+    def end(self):
+        """The position after the closing brace"""
+        self._scan()
+        return self._end
+
+    def _scan(self, key=None):
+        """Look for the members, until key is found (None: all of them)"""
+        while self._end is None and (key is None or key not in self._spans):
+            if self._pending is not None:
+                self._pos, self._pending = self._pending.end, None
+            closing = self._closing.match(self._data, self._pos)
+            if closing:
+                self._end = closing.end()
+                break
+            match = self._member.match(self._data, self._pos)
+            if not match:
+                raise ValueError("Invalid JSON object member at %d" % self._pos)
+            name = json.loads(match.group(1))
+            start = match.end()
+            end = self._valueEnd(self._data, start, self.lazyThreshold)
+            if end is None:
+                # its end is found when needed
+                self._values[name] = self._pending = LazyJSONObject(self._data, start)
+            self._spans[name] = (start, end)
+            self._pos = end
+
+    def __getitem__(self, key):
+        if key not in self._values:
+            self._scan(key)
+        if key not in self._values:
+            start, end = self._spans[key]
+            self._values[key] = json.loads(self._data[start:end])
+        return self._values[key]
+
+    def __contains__(self, key):
+        self._scan(key)
+        return key in self._spans
+
+    def __iter__(self):
+        self._scan()
+        return iter(self._spans)
+
+    def __len__(self):
+        self._scan()
+        return len(self._spans)
+
+    def __repr__(self):
+        return "<LazyJSONObject of %d members>" % len(self)
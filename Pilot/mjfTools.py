@@ -0,0 +1,179 @@
+"""Machine/Job Features (MJF) of the worker node"""
+
+import os
+import time
+from threading import RLock
+
+from fileSystemTools import FileSystemProbe
+
+
+class MachineJobFeatures(object):
+    """
+    The Machine/Job Features (MJF) of the pilot job: one file per key, in the $JOBFEATURES and
+    $MACHINEFEATURES directories, that may also be http(s) URLs.
+
+    All the keys are read at once, in parallel (by the FileSystemProbe workers), with a single (short)
+    deadline: a key that can't be read in time is missing, as a key that does not exist. The values are
+    kept for cacheTTL seconds.
+    """
+
+    jobKeys = (
+        "allocated_cpu",
+        "hs06_job",
+        "shutdowntime_job",
+        "grace_secs_job",
+        "jobstart_secs",
+        "job_id",
+        "wall_limit_secs",
+        "cpu_limit_secs",
+        "max_rss_bytes",
+        "max_swap_bytes",
+        "scratch_limit_bytes",
+    )
+    machineKeys = ("total_cpu", "hs06", "shutdowntime", "grace_secs", "db12")
+    cacheTTL = 300
+
+    _rlock = RLock()
+    _instance = None
+
+    def __init__(self, jobFeatures=None, machineFeatures=None, timeout=5, probes=None):
+        """c'tor
+
+        :param str jobFeatures: the job features directory or URL (default: $JOBFEATURES)
+        :param str machineFeatures: the machine features directory or URL (default: $MACHINEFEATURES)
+        :param float timeout: the longest time to read all the keys, in seconds
+        :param FileSystemProbe probes: the probe service reading the keys (default: the shared one)
+        """
+        self.jobFeatures = jobFeatures or os.getenv("JOBFEATURES")
+        self.machineFeatures = machineFeatures or os.getenv("MACHINEFEATURES")
+        self.timeout = timeout
+        self.probes = probes or FileSystemProbe.get()
+        self._rlock = RLock()
+        self._features = None
+        self._readTime = 0
+
+    @classmethod
+    def get(cls):
+        """The (shared) features, of $JOBFEATURES and $MACHINEFEATURES"""
+        with cls._rlock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    @classmethod
+    def clear(cls):
+        """Forget the shared features"""
+        with cls._rlock:
+            cls._instance = None
+
+    @staticmethod
+    def parseValue(text):
+        """An MJF value: an int, a float, or a string"""
+        text = text.strip()
+        for converter in (int, float):
+            try:
+                return converter(text)
+            except ValueError:
+                pass
+        return text
+
+    def _submitKey(self, location, key):
+        """Start reading a key of a directory or URL (not cached: the values may change)"""
+        if location.startswith(("http://", "https://")):
+            url = "%s/%s" % (location.rstrip("/"), key)
+            return self.probes.submit("readURLHead", url, 1024, self.timeout, cache=False)
+        return self.probes.submit("readHead", os.path.join(location, key), 1024, cache=False)
+
+    def read(self):
+        """Read all the keys again
+
+        :return: the values, by key
+        :rtype: dict
+        """
+        pending = {}
+        for location, keys in ((self.jobFeatures, self.jobKeys), (self.machineFeatures, self.machineKeys)):
+            if location:
+                for key in keys:
+                    pending[key] = self._submitKey(location, key)
+        deadline = time.time() + self.timeout
+        features = {}
+        for key, probe in pending.items():
+            try:
+                done, text = self.probes.wait(probe, max(0, deadline - time.time()))
+            except Exception:
+                # not provided
+                continue
+            # what comes later is ignored
+            if done:
+                features[key] = self.parseValue(text.decode())
+        with self._rlock:
+            self._features = features
+            self._readTime = time.time()
+        return features
+
+    @property
+    def features(self):
+        """The values, by key, read again when older than cacheTTL (without holding the lock)
+
+        :rtype: dict
+        """
+        with self._rlock:
+            if self._features is not None and time.time() - self._readTime <= self.cacheTTL:
+                return self._features
+        return self.read()
+
+    def _number(self, key):
+        value = self.features.get(key)
+        return value if isinstance(value, (int, float)) and value > 0 else None
+
+    @property
+    def processors(self):
+        """The number of processors allocated to the job, None if unknown"""
+        return self._number("allocated_cpu")
+
+    @property
+    def maxRAM(self):
+        """The memory limit of the job, in MB, None if unknown"""
+        maxRSS = self._number("max_rss_bytes")
+        return int(maxRSS / 1048576) if maxRSS else None
+
+    @property
+    def hs06(self):
+        """The HS06 power of a processor, None if unknown"""
+        hs06Job = self._number("hs06_job")
+        if hs06Job and self.processors:
+            return float(hs06Job) / self.processors
+        hs06, totalCPU = self._number("hs06"), self._number("total_cpu")
+        if hs06 and totalCPU:
+            return float(hs06) / totalCPU
+        return None
+
+    @property
+    def shutdownTime(self):
+        """When the job (or the machine) will be stopped, in seconds since the epoch, None if unknown"""
+        times = [self._number(key) for key in ("shutdowntime_job", "shutdowntime")]
+        times = [shutdown for shutdown in times if shutdown]
+        return min(times) if times else None
+
+    @property
+    def cpuTimeLeft(self):
+        """The CPU time left of a processor, in seconds, None if unknown.
+
+        The CPU limit (for all the processors) is shared by the allocated processors, and can't go beyond
+        the wall-clock limit; what elapsed since the job start, and the shutdown time, are taken into account.
+        """
+        limits = []
+        if self._number("cpu_limit_secs"):
+            limits.append(float(self._number("cpu_limit_secs")) / (self.processors or 1))
+        if self._number("wall_limit_secs"):
+            limits.append(float(self._number("wall_limit_secs")))
+        if not limits:
+            return None
+        limit = min(limits)
+        jobStart = self._number("jobstart_secs")
+        now = time.time()
+        if jobStart:
+            limit -= now - jobStart
+        if self.shutdownTime:
+            limit = min(limit, self.shutdownTime - now)
+        return max(0, int(limit))
@@ -15,6 +15,10 @@ object and the command name as arguments, e.g.::
 
 The command class must implement execute() method for the actual command
 execution.
+
+Commands can declare the resources they need and produce (see CommandBase.needs and
+CommandBase.produces), so that the independent ones run concurrently. Commands not declaring
+them run alone, in the order of the command list.
 """
 
 import filecmp
@@ -30,22 +34,20 @@ from collections import Counter
 from http.client import HTTPSConnection
 from shlex import quote
 
-from pilotTools import (
-    CommandBase,
-    getSubmitterInfo,
-    retrieveUrlTimeout,
-    safe_listdir,
-    sendMessage,
-)
+from cfgTools import splitConfigOption
+from fileSystemTools import FileSystemProbe
+from mjfTools import MachineJobFeatures
+from pilotTools import CommandBase, getSubmitterInfo, retrieveUrlTimeout, safe_listdir
+from transportTools import PilotCredentials
 
 ############################
 
 
 def logFinalizer(func):
     """
-    PilotCommand decorator. It marks a log file as final so no more messages should be written to it.
-    Finalising is triggered by a return statement or any sys.exit() call, so a file might be incomplete
-    if a command throws SystemExit exception with a code =! 0.
+    PilotCommand decorator. It documents how a command ended in the remote log. The remote log pipeline
+    itself is shared by all the commands, and finalised once by the steering script (dirac-pilot.py),
+    so that a sys.exit() in any command still flushes it and marks the log as final.
 
     :param func: method to be decorated
     :type func: method object
@@ -59,29 +61,17 @@ def logFinalizer(func):
             return func(self)
 
         try:
-            ret = func(self)
-            self.log.buffer.flush()
-            return ret
+            return func(self)
 
         except SystemExit as exCode:  # or Exception ?
-            # controlled exit
-            pRef = self.pp.pilotReference
-            self.log.info(
-                "Flushing the remote logger buffer for pilot on sys.exit(): %s (exit code:%s)" % (pRef, str(exCode))
-            )
-            self.log.buffer.flush()  # flush the buffer unconditionally (on sys.exit()).
-            try:
-                sendMessage(self.log.url, self.log.pilotUUID, self.log.wnVO, "finaliseLogs", {"retCode": str(exCode)})
-            except Exception as exc:
-                self.log.error("Remote logger couldn't be finalised %s " % str(exc))
+            # controlled exit, the remote log is finalised by the steering script
+            self.log.info("Command %s exiting (exit code:%s)" % (self.__class__.__name__, str(exCode)))
             raise
         except Exception as exc:
             # unexpected exit: document it and bail out.
             self.log.error(str(exc))
             self.log.error(traceback.format_exc())
             raise
-        finally:
-            self.log.buffer.cancelTimer()
 
     return wrapper
 
@@ -89,6 +79,9 @@ def logFinalizer(func):
 class GetPilotVersion(CommandBase):
     """Now just returns what was obtained by pilotTools.py"""
 
+    needs = ()
+    produces = ()
+
     def __init__(self, pilotParams):
         """c'tor"""
         super(GetPilotVersion, self).__init__(pilotParams)
@@ -102,6 +95,9 @@ class GetPilotVersion(CommandBase):
 class CheckWorkerNode(CommandBase):
     """Executes some basic checks"""
 
+    needs = ()
+    produces = ()
+
     def __init__(self, pilotParams):
         """c'tor"""
         super(CheckWorkerNode, self).__init__(pilotParams)
@@ -191,6 +187,9 @@ class CheckWorkerNode(CommandBase):
 class InstallDIRAC(CommandBase):
     """Source from CVMFS, or install locally"""
 
+    needs = ()
+    produces = ("installEnv",)
+
     def __init__(self, pilotParams):
         """c'tor"""
         super(InstallDIRAC, self).__init__(pilotParams)
@@ -243,14 +242,11 @@ class InstallDIRAC(CommandBase):
             preinstalledEnvScript = os.path.join(self.pp.preinstalledEnvPrefix, version, arch, "diracosrc")
 
         if not preinstalledEnvScript and self.pp.CVMFS_locations:
-            for CVMFS_location in self.pp.CVMFS_locations:
-                version = self.pp.releaseVersion or "pro"
-                arch = platform.system() + "-" + platform.machine()
-                preinstalledEnvScript = os.path.join(
-                    CVMFS_location, self.pp.releaseProject.lower() + "dirac", version, arch, "diracosrc"
-                )
-                if os.path.isfile(preinstalledEnvScript):
-                    break
+            # in the fastest CVMFS location that has it (else, the last one: evaluated below)
+            subPath = self.pp.preinstalledEnvSubPath
+            preinstalledEnvScript = self.pp.locationMap.find(subPath, isFile=True) or os.path.join(
+                self.pp.CVMFS_locations[-1], subPath
+            )
 
         self.log.debug("preinstalledEnvScript = %s" % preinstalledEnvScript)
 
@@ -259,7 +255,7 @@ class InstallDIRAC(CommandBase):
             if not safe_listdir(os.path.dirname(preinstalledEnvScript)):
                 raise OSError("release not found")
 
-            if os.path.isfile(preinstalledEnvScript):
+            if FileSystemProbe.get().isfile(preinstalledEnvScript):
                 self.pp.preinstalledEnv = preinstalledEnvScript
                 self.pp.installEnv["DIRAC_RC_PATH"] = preinstalledEnvScript
 
@@ -287,7 +283,7 @@ class InstallDIRAC(CommandBase):
             shutil.rmtree("diracos")
 
         retCode, _ = self.executeAndGetOutput(
-            "bash /cvmfs/dirac.egi.eu/installSource/%s 2>&1" % installerName, installEnv
+            "bash /cvmfs/dirac.egi.eu/installSource/%s 2>&1" % installerName, installEnv, capture="none"
         )
         if retCode:
             self.log.warn("Could not install DIRACOS from CVMFS [ERROR %d]" % retCode)
@@ -304,7 +300,7 @@ class InstallDIRAC(CommandBase):
                 shutil.rmtree("diracos")
 
             # 4. bash DIRACOS-Linux-$(uname -m).sh
-            retCode, _ = self.executeAndGetOutput("bash %s 2>&1" % installerName, installEnv)
+            retCode, _ = self.executeAndGetOutput("bash %s 2>&1" % installerName, installEnv, capture="none")
             if retCode:
                 self.log.error("Could not install DIRACOS [ERROR %d]" % retCode)
                 self.exitWithError(retCode)
@@ -354,7 +350,7 @@ class InstallDIRAC(CommandBase):
                     pipInstalling += "'%s[pilot] @ %s@%s'" % (project, gitUrl, branch)
                 else:
                     pipInstalling += "%s[pilot]" % gitUrl
-                retCode, output = self.executeAndGetOutput(pipInstalling, self.pp.installEnv)
+                retCode, _ = self.executeAndGetOutput(pipInstalling, self.pp.installEnv, capture="none")
                 if retCode:
                     self.log.error("Could not %s [ERROR %d]" % (pipInstalling, retCode))
                     self.exitWithError(retCode)
@@ -364,7 +360,7 @@ class InstallDIRAC(CommandBase):
                 cmd = "%s %sDIRAC[pilot]" % (pipInstallingPrefix, self.pp.releaseProject)
             else:
                 cmd = "%s %sDIRAC[pilot]==%s" % (pipInstallingPrefix, self.pp.releaseProject, self.releaseVersion)
-            retCode, output = self.executeAndGetOutput(cmd, self.pp.installEnv)
+            retCode, _ = self.executeAndGetOutput(cmd, self.pp.installEnv, capture="none")
             if retCode:
                 self.log.error("Could not pip install %s [ERROR %d]" % (self.releaseVersion, retCode))
                 self.exitWithError(retCode)
@@ -427,8 +423,14 @@ class ConfigureBasics(CommandBase):
     .. note:: Further commands should always call dirac-configure using the options -FDMH
     .. note:: If custom cfg file is created further commands should call dirac-configure with
                "-O %s %s" % ( self.pp.localConfigFile, self.pp.localConfigFile )
+    .. note:: Further commands only updating the local cfg file should rather add their options
+               to the configuration transaction (see addConfigOption), which is committed with a single
+               dirac-configure call
     """
 
+    needs = ("installEnv", "localConfig")
+    produces = ("pilot.cfg", "pilotReference")
+
     def __init__(self, pilotParams):
         """c'tor"""
         super(ConfigureBasics, self).__init__(pilotParams)
@@ -457,7 +459,7 @@ class ConfigureBasics(CommandBase):
 
         configureCmd = "%s %s" % (self.pp.configureScript, " ".join(self.cfg))
 
-        retCode, _configureOutData = self.executeAndGetOutput(configureCmd, self.pp.installEnv)
+        retCode, _configureOutData = self.executeAndGetOutput(configureCmd, self.pp.installEnv, capture="none")
 
         if retCode:
             self.log.error("Could not configure DIRAC basics [ERROR %d]" % retCode)
@@ -481,6 +483,11 @@ class ConfigureBasics(CommandBase):
     def _getBasicsCFG(self):
         """basics (needed!)"""
         self.cfg.append('-S "%s"' % self.pp.setup)
+        # the site (found from the CE if not given) and its LocalSE are looked up in the Configuration Service
+        if self.pp.site:
+            self.cfg.append('-n "%s"' % self.pp.site)
+        if self.pp.ceName:
+            self.cfg.append('-N "%s"' % self.pp.ceName)
         if self.pp.configServer:
             self.cfg.append('-C "%s"' % self.pp.configServer)
         if self.pp.preferredURLPatterns:
@@ -517,6 +524,11 @@ class ConfigureBasics(CommandBase):
 class RegisterPilot(CommandBase):
     """The Pilot self-announce its own presence"""
 
+    # only the basic configuration (setup, CS) is needed
+    needsLocalConfig = False
+    needs = ("installEnv", "pilot.cfg", "pilotReference", "localConfig")
+    produces = ()
+
     def __init__(self, pilotParams):
         """c'tor"""
         super(RegisterPilot, self).__init__(pilotParams)
@@ -545,7 +557,7 @@ class RegisterPilot(CommandBase):
             self.pilotStamp,
             " ".join(self.cfg),
         )
-        retCode, _ = self.executeAndGetOutput(checkCmd, self.pp.installEnv)
+        retCode, _ = self.executeAndGetOutput(checkCmd, self.pp.installEnv, capture="none")
         if retCode:
             self.log.error("Could not get execute dirac-admin-add-pilot [ERROR %d]" % retCode)
 
@@ -553,6 +565,10 @@ class RegisterPilot(CommandBase):
 class CheckCECapabilities(CommandBase):
     """Used to get CE tags and other relevant parameters."""
 
+    needsLocalConfig = False
+    needs = ("installEnv", "pilot.cfg", "localConfig")
+    produces = ("tags", "queueParameters", "localConfig")
+
     def __init__(self, pilotParams):
         """c'tor"""
         super(CheckCECapabilities, self).__init__(pilotParams)
@@ -577,7 +593,7 @@ class CheckCECapabilities(CommandBase):
             self.pp.queueName,
             " ".join(self.cfg),
         )
-        retCode, resourceDict = self.executeAndGetOutput(checkCmd, self.pp.installEnv)
+        retCode, resourceDict = self.executeAndGetOutput(checkCmd, self.pp.installEnv, capture="lastLine")
         if retCode:
             self.log.error("Could not get resource parameters [ERROR %d]" % retCode)
             self.exitWithError(retCode)
@@ -600,27 +616,14 @@ class CheckCECapabilities(CommandBase):
         self.pp.reqtags += resourceDict.pop("RequiredTag", [])
 
         self.pp.queueParameters = resourceDict
+        if self.pp.useServerCertificate:
+            self.addConfigOption("/DIRAC/Security/UseServerCertificate", "yes")
         for queueParamName, queueParamValue in self.pp.queueParameters.items():
             if isinstance(queueParamValue, list):  # for the tags
                 queueParamValue = ",".join([str(qpv).strip() for qpv in queueParamValue])
-            self.cfg.append("-o /LocalSite/%s=%s" % (queueParamName, quote(queueParamValue)))
+            self.addConfigOption("/LocalSite/%s" % queueParamName, queueParamValue)
 
-        if self.cfg:
-            if self.pp.localConfigFile:
-                self.cfg.append("-O %s" % self.pp.localConfigFile)  # this file is as output
-
-            self.cfg.append("-FDMH")
-
-            if self.debugFlag:
-                self.cfg.append("-ddd")
-
-            configureCmd = "%s %s" % (self.pp.configureScript, " ".join(self.cfg))
-            retCode, _configureOutData = self.executeAndGetOutput(configureCmd, self.pp.installEnv)
-            if retCode:
-                self.log.error("Could not configure DIRAC [ERROR %d]" % retCode)
-                self.exitWithError(retCode)
-
-        else:
+        if not self.pp.queueParameters:
             self.log.debug("No CE parameters (tags) defined for %s/%s" % (self.pp.ceName, self.pp.queueName))
 
 
@@ -629,14 +632,24 @@ class CheckWNCapabilities(CommandBase):
     after the CheckCECapabilities command
     """
 
+    needsLocalConfig = False
+    needs = ("installEnv", "pilot.cfg", "tags", "queueParameters", "localConfig")
+    produces = ("tags", "pilotProcessors", "localConfig")
+
     def __init__(self, pilotParams):
         """c'tor"""
         super(CheckWNCapabilities, self).__init__(pilotParams)
         self.cfg = []
 
-    @logFinalizer
-    def execute(self):
-        """Discover NumberOfProcessors and RAM"""
+    def _getWNParameters(self):
+        """The number of processors, RAM (MB) and number of GPUs of the worker node, from the Machine/Job
+        Features if they have them, else from dirac-wms-get-wn-parameters. The Machine/Job Features have
+        no GPUs: unless the queue defines NumberOfGPUs, dirac-wms-get-wn-parameters is run to detect them.
+        """
+        mjf = MachineJobFeatures.get()
+        if mjf.processors and mjf.maxRAM and "NumberOfGPUs" in self.pp.queueParameters:
+            self.log.info("Worker node parameters from the Machine/Job Features")
+            return int(mjf.processors), mjf.maxRAM, int(self.pp.queueParameters["NumberOfGPUs"])
 
         if self.pp.useServerCertificate:
             self.cfg.append("-o /DIRAC/Security/UseServerCertificate=yes")
@@ -649,7 +662,7 @@ class CheckWNCapabilities(CommandBase):
             self.pp.queueName,
             " ".join(self.cfg),
         )
-        retCode, result = self.executeAndGetOutput(checkCmd, self.pp.installEnv)
+        retCode, result = self.executeAndGetOutput(checkCmd, self.pp.installEnv, capture="lastLine")
         if retCode:
             self.log.error("Could not get resource parameters [ERROR %d]" % retCode)
             self.exitWithError(retCode)
@@ -665,6 +678,16 @@ class CheckWNCapabilities(CommandBase):
         except ValueError:
             self.log.error("Wrong Command output %s" % result)
             self.exitWithError(1)
+        if mjf.processors and mjf.maxRAM:
+            self.log.info("Worker node processors and RAM from the Machine/Job Features")
+            return int(mjf.processors), mjf.maxRAM, numberOfGPUs
+        return numberOfProcessorsOnWN, maxRAM, numberOfGPUs
+
+    @logFinalizer
+    def execute(self):
+        """Discover NumberOfProcessors and RAM"""
+
+        numberOfProcessorsOnWN, maxRAM, numberOfGPUs = self._getWNParameters()
 
         # If NumberOfProcessors or MaxRAM are defined in the resource configuration, these
         # values are preferred
@@ -673,12 +696,12 @@ class CheckWNCapabilities(CommandBase):
         self.pp.pilotProcessors = numberOfProcessorsOnWN
 
         self.log.info("pilotProcessors = %d" % self.pp.pilotProcessors)
-        self.cfg.append('-o "/Resources/Computing/CEDefaults/NumberOfProcessors=%d"' % self.pp.pilotProcessors)
+        self.addConfigOption("/Resources/Computing/CEDefaults/NumberOfProcessors", "%d" % self.pp.pilotProcessors)
 
         maxRAM = self.pp.queueParameters.get("MaxRAM", maxRAM)
         if maxRAM:
             try:
-                self.cfg.append('-o "/Resources/Computing/CEDefaults/MaxRAM=%d"' % int(maxRAM))
+                self.addConfigOption("/Resources/Computing/CEDefaults/MaxRAM", "%d" % int(maxRAM))
             except ValueError:
                 self.log.warn("MaxRAM is not an integer, will not fill it")
         else:
@@ -686,107 +709,86 @@ class CheckWNCapabilities(CommandBase):
 
         if numberOfGPUs:
             self.log.info("numberOfGPUs = %d" % int(numberOfGPUs))
-            self.cfg.append('-o "/Resources/Computing/CEDefaults/NumberOfGPUs=%d"' % int(numberOfGPUs))
+            self.addConfigOption("/Resources/Computing/CEDefaults/NumberOfGPUs", "%d" % int(numberOfGPUs))
 
         # Add normal and required tags to the configuration
         self.pp.tags = list(set(self.pp.tags))
         if self.pp.tags:
-            self.cfg.append('-o "/Resources/Computing/CEDefaults/Tag=%s"' % ",".join((str(x) for x in self.pp.tags)))
+            self.addConfigOption("/Resources/Computing/CEDefaults/Tag", ",".join((str(x) for x in self.pp.tags)))
 
         self.pp.reqtags = list(set(self.pp.reqtags))
         if self.pp.reqtags:
-            self.cfg.append(
-                '-o "/Resources/Computing/CEDefaults/RequiredTag=%s"' % ",".join((str(x) for x in self.pp.reqtags))
+            self.addConfigOption(
+                "/Resources/Computing/CEDefaults/RequiredTag", ",".join((str(x) for x in self.pp.reqtags))
             )
 
         if self.pp.useServerCertificate:
-            self.cfg.append("-o /DIRAC/Security/UseServerCertificate=yes")
-
-        if self.pp.localConfigFile:
-            self.cfg.append("-O %s" % self.pp.localConfigFile)  # this file is as output
-            self.cfg.extend(["--cfg", self.pp.localConfigFile])  # this file is as input
-
-        if self.debugFlag:
-            self.cfg.append("-ddd")
-
-        if self.cfg:
-            self.cfg.append("-FDMH")
-
-            configureCmd = "%s %s" % (self.pp.configureScript, " ".join(self.cfg))
-            retCode, _configureOutData = self.executeAndGetOutput(configureCmd, self.pp.installEnv)
-            if retCode:
-                self.log.error("Could not configure DIRAC [ERROR %d]" % retCode)
-                self.exitWithError(retCode)
+            self.addConfigOption("/DIRAC/Security/UseServerCertificate", "yes")
 
 
 class ConfigureSite(CommandBase):
     """Command to configure DIRAC sites using the pilot options"""
 
+    needsLocalConfig = False
+    needs = ("pilot.cfg", "pilotReference", "localConfig")
+    produces = ("localConfig",)
+
     def __init__(self, pilotParams):
         """c'tor"""
         super(ConfigureSite, self).__init__(pilotParams)
 
-        # this variable contains the options that are passed to dirac-configure,
-        # and that will fill the local dirac.cfg file
-        self.cfg = []
-
     @logFinalizer
     def execute(self):
         """Setup configuration parameters"""
-        self.cfg.append("-o /LocalSite/GridMiddleware=%s" % self.pp.flavour)
+        self.addConfigOption("/LocalSite/GridMiddleware", self.pp.flavour)
 
         # Add batch system details to the configuration
         # Can be used by the pilot/job later on, to interact with the batch system
-        self.cfg.append("-o /LocalSite/BatchSystemInfo/Type=%s" % self.pp.batchSystemInfo.get("Type", "Unknown"))
-        self.cfg.append("-o /LocalSite/BatchSystemInfo/JobID=%s" % self.pp.batchSystemInfo.get("JobID", "Unknown"))
+        self.addConfigOption("/LocalSite/BatchSystemInfo/Type", self.pp.batchSystemInfo.get("Type", "Unknown"))
+        self.addConfigOption("/LocalSite/BatchSystemInfo/JobID", self.pp.batchSystemInfo.get("JobID", "Unknown"))
 
         batchSystemParams = self.pp.batchSystemInfo.get("Parameters", {})
-        self.cfg.append("-o /LocalSite/BatchSystemInfo/Parameters/Queue=%s" % batchSystemParams.get("Queue", "Unknown"))
-        self.cfg.append(
-            "-o /LocalSite/BatchSystemInfo/Parameters/BinaryPath=%s" % batchSystemParams.get("BinaryPath", "Unknown")
+        self.addConfigOption("/LocalSite/BatchSystemInfo/Parameters/Queue", batchSystemParams.get("Queue", "Unknown"))
+        self.addConfigOption(
+            "/LocalSite/BatchSystemInfo/Parameters/BinaryPath", batchSystemParams.get("BinaryPath", "Unknown")
         )
-        self.cfg.append("-o /LocalSite/BatchSystemInfo/Parameters/Host=%s" % batchSystemParams.get("Host", "Unknown"))
-        self.cfg.append(
-            "-o /LocalSite/BatchSystemInfo/Parameters/InfoPath=%s" % batchSystemParams.get("InfoPath", "Unknown")
+        self.addConfigOption("/LocalSite/BatchSystemInfo/Parameters/Host", batchSystemParams.get("Host", "Unknown"))
+        self.addConfigOption(
+            "/LocalSite/BatchSystemInfo/Parameters/InfoPath", batchSystemParams.get("InfoPath", "Unknown")
         )
 
-        self.cfg.append('-n "%s"' % self.pp.site)
-        self.cfg.append('-S "%s"' % self.pp.setup)
-
-        self.cfg.append('-N "%s"' % self.pp.ceName)
-        self.cfg.append("-o /LocalSite/GridCE=%s" % self.pp.ceName)
-        self.cfg.append("-o /LocalSite/CEQueue=%s" % self.pp.queueName)
+        # what the dirac-configure switches -n, -S and -N set (the Configuration Service lookups of the site
+        # and of its LocalSE are done by ConfigureBasics): options only, written without dirac-configure
+        if self.pp.site:
+            self.addConfigOption("/LocalSite/Site", self.pp.site)
+            self.addConfigOption("/LocalInstallation/SiteName", self.pp.site)
+        self.addConfigOption("/DIRAC/Setup", self.pp.setup)
+        self.addConfigOption("/LocalInstallation/Setup", self.pp.setup)
+
+        if self.pp.ceName:
+            self.addConfigOption("/LocalInstallation/CEName", self.pp.ceName)
+        self.addConfigOption("/LocalSite/GridCE", self.pp.ceName)
+        self.addConfigOption("/LocalSite/CEQueue", self.pp.queueName)
         if self.pp.ceType:
-            self.cfg.append("-o /LocalSite/LocalCE=%s" % self.pp.ceType)
+            self.addConfigOption("/LocalSite/LocalCE", self.pp.ceType)
 
         for o, v in self.pp.optList:
             if o == "-o" or o == "--option":
-                self.cfg.append('-o "%s"' % v)
+                option = splitConfigOption(v)
+                if option and option[0].startswith("/"):
+                    self.addConfigOption(*option)
+                else:
+                    self.addConfigSwitch('-o "%s"' % v)
 
         if self.pp.pilotReference:
-            self.cfg.append("-o /LocalSite/PilotReference=%s" % self.pp.pilotReference)
+            self.addConfigOption("/LocalSite/PilotReference", self.pp.pilotReference)
 
         if self.pp.useServerCertificate:
-            self.cfg.append("--UseServerCertificate")
-            self.cfg.append("-o /DIRAC/Security/CertFile=%s/hostcert.pem" % self.pp.certsLocation)
-            self.cfg.append("-o /DIRAC/Security/KeyFile=%s/hostkey.pem" % self.pp.certsLocation)
-
-        # these are needed as this is not the first time we call dirac-configure
-        self.cfg.append("-FDMH")
-        if self.pp.localConfigFile:
-            self.cfg.append("-O %s" % self.pp.localConfigFile)
-            self.cfg.extend(["--cfg", self.pp.localConfigFile])
-
-        if self.debugFlag:
-            self.cfg.append("-ddd")
-
-        configureCmd = "%s %s" % (self.pp.configureScript, " ".join(self.cfg))
-
-        retCode, _configureOutData = self.executeAndGetOutput(configureCmd, self.pp.installEnv)
-
-        if retCode:
-            self.log.error("Could not configure DIRAC [ERROR %d]" % retCode)
-            self.exitWithError(retCode)
+            # what --UseServerCertificate sets
+            self.addConfigOption("/LocalInstallation/UseServerCertificate", "True")
+            self.addConfigOption("/DIRAC/Security/UseServerCertificate", "yes")
+            self.addConfigOption("/DIRAC/Security/CertFile", "%s/hostcert.pem" % self.pp.certsLocation)
+            self.addConfigOption("/DIRAC/Security/KeyFile", "%s/hostkey.pem" % self.pp.certsLocation)
 
 
 class ConfigureArchitecture(CommandBase):
@@ -794,6 +796,10 @@ class ConfigureArchitecture(CommandBase):
     Separated from the ConfigureDIRAC command for easier extensibility.
     """
 
+    needsLocalConfig = False
+    needs = ("installEnv", "pilot.cfg", "localConfig")
+    produces = ("localConfig", "architecture")
+
     @logFinalizer
     def execute(self):
         """This is a simple command to call the dirac-platform utility to get the platform,
@@ -817,35 +823,24 @@ class ConfigureArchitecture(CommandBase):
         if self.pp.architectureScript.split(" ")[0] == "dirac-apptainer-exec":
             architectureCmd = "dirac-apptainer-exec '%s' %s" % (architectureCmd, " ".join(cfg))
 
-        retCode, localArchitecture = self.executeAndGetOutput(architectureCmd, self.pp.installEnv)
+        retCode, localArchitecture = self.executeAndGetOutput(architectureCmd, self.pp.installEnv, capture="lastLine")
         if retCode:
             self.log.error("There was an error getting the platform [ERROR %d]" % retCode)
             self.exitWithError(retCode)
         self.log.info("Architecture determined: %s" % localArchitecture.strip().split("\n")[-1])
 
-        # standard options
-        cfg = ["-FDMH"]  # force update, skip CA checks, skip CA download, skip VOMS
+        # standard options (-FDMH etc.) are added when the configuration transaction is committed
+        # (what --UseServerCertificate and -S would set)
         if self.pp.useServerCertificate:
-            cfg.append("--UseServerCertificate")
-        if self.pp.localConfigFile:
-            cfg.append("-O %s" % self.pp.localConfigFile)  # our target file for pilots
-            cfg.extend(["--cfg", self.pp.localConfigFile])  # this file is also an input
-        if self.pp.debugFlag:
-            cfg.append("-ddd")
+            self.addConfigOption("/DIRAC/Security/UseServerCertificate", "yes")
 
         # real options added here
         localArchitecture = localArchitecture.strip().split("\n")[-1].strip()
-        cfg.append('-S "%s"' % self.pp.setup)
-        cfg.append("-o /LocalSite/Architecture=%s" % localArchitecture)
+        self.addConfigOption("/DIRAC/Setup", self.pp.setup)
+        self.addConfigOption("/LocalSite/Architecture", localArchitecture)
 
         # add the local platform as determined by the platform module
-        cfg.append("-o /LocalSite/Platform=%s" % platform.machine())
-
-        configureCmd = "%s %s" % (self.pp.configureScript, " ".join(cfg))
-        retCode, _configureOutData = self.executeAndGetOutput(configureCmd, self.pp.installEnv)
-        if retCode:
-            self.log.error("Configuration error [ERROR %d]" % retCode)
-            self.exitWithError(retCode)
+        self.addConfigOption("/LocalSite/Platform", platform.machine())
 
         return localArchitecture
 
@@ -855,6 +850,10 @@ class ConfigureArchitectureWithoutCLI(CommandBase):
     Separated from the ConfigureDIRAC command for easier extensibility.
     """
 
+    needsLocalConfig = False
+    needs = ("pilot.cfg", "localConfig")
+    produces = ("localConfig", "architecture")
+
     def getPlatformString(self):
         # Modified to return our desired platform string, R. Graciani
         platformTuple = (platform.system(), platform.machine())
@@ -882,28 +881,18 @@ class ConfigureArchitectureWithoutCLI(CommandBase):
             self.log.error("Configuration error [ERROR %s]" % str(e))
             self.exitWithError(1)
 
-        cfg = ["-FDMH"]  # force update, skip CA checks, skip CA download, skip VOMS
+        # standard options (-FDMH etc.) are added when the configuration transaction is committed
+        # (what --UseServerCertificate and -S would set)
         if self.pp.useServerCertificate:
-            cfg.append("--UseServerCertificate")
-        if self.pp.localConfigFile:
-            cfg.append("-O %s" % self.pp.localConfigFile)  # our target file for pilots
-            cfg.extend(["--cfg", self.pp.localConfigFile])  # this file is also an input
-        if self.pp.debugFlag:
-            cfg.append("-ddd")
+            self.addConfigOption("/DIRAC/Security/UseServerCertificate", "yes")
 
         # real options added here
         localArchitecture = localArchitecture.strip().split("\n")[-1].strip()
-        cfg.append('-S "%s"' % self.pp.setup)
-        cfg.append("-o /LocalSite/Architecture=%s" % localArchitecture)
+        self.addConfigOption("/DIRAC/Setup", self.pp.setup)
+        self.addConfigOption("/LocalSite/Architecture", localArchitecture)
 
         # add the local platform as determined by the platform module
-        cfg.append("-o /LocalSite/Platform=%s" % platform.machine())
-
-        configureCmd = "%s %s" % (self.pp.configureScript, " ".join(cfg))
-        retCode, _configureOutData = self.executeAndGetOutput(configureCmd, self.pp.installEnv)
-        if retCode:
-            self.log.error("Configuration error [ERROR %d]" % retCode)
-            self.exitWithError(retCode)
+        self.addConfigOption("/LocalSite/Platform", platform.machine())
 
         return localArchitecture
 
@@ -911,6 +900,9 @@ class ConfigureArchitectureWithoutCLI(CommandBase):
 class ConfigureCPURequirements(CommandBase):
     """This command determines the CPU requirements. Needs to be executed after ConfigureSite"""
 
+    needs = ("installEnv", "pilot.cfg", "localConfig")
+    produces = ("localConfig", "jobCPUReq")
+
     def __init__(self, pilotParams):
         """c'tor"""
         super(ConfigureCPURequirements, self).__init__(pilotParams)
@@ -918,7 +910,35 @@ class ConfigureCPURequirements(CommandBase):
     @logFinalizer
     def execute(self):
         """Get job CPU requirement and queue normalization"""
-        # Determining the CPU normalization factor and updating pilot.cfg with it
+        mjf = MachineJobFeatures.get()
+        cpuNormalizationFactor = mjf.hs06
+        if cpuNormalizationFactor:
+            self.log.info("Normalized CPU from the Machine/Job Features is %f" % cpuNormalizationFactor)
+            self.addConfigOption("/LocalSite/CPUNormalizationFactor", "%.1f" % cpuNormalizationFactor)
+        else:
+            cpuNormalizationFactor = self._getCPUNormalizationFactor()
+
+        cpuTime = mjf.cpuTimeLeft
+        if cpuTime is not None:
+            self.log.info("CPUTime left (in seconds) from the Machine/Job Features is %d" % cpuTime)
+        else:
+            cpuTime = self._getCPUTimeLeft(cpuNormalizationFactor)
+
+        # HS06s = seconds * HS06
+        try:
+            # determining the CPU time left (in HS06s)
+            self.pp.jobCPUReq = float(cpuTime) * float(cpuNormalizationFactor)
+            self.log.info("Queue length (which is also set as CPUTimeLeft) is %f" % self.pp.jobCPUReq)
+        except ValueError:
+            self.log.error("Pilot command output does not have the correct format")
+            self.exitWithError(1)
+        # now setting this value in local file (when the configuration transaction is committed)
+        if self.pp.useServerCertificate:
+            self.addConfigOption("/DIRAC/Security/UseServerCertificate", "yes")
+        self.addConfigOption("/LocalSite/CPUTimeLeft", str(int(self.pp.jobCPUReq)))  # the only real option
+
+    def _getCPUNormalizationFactor(self):
+        """The CPU normalization factor (HS06), from dirac-wms-cpu-normalization, that also updates pilot.cfg"""
         configFileArg = ""
         if self.pp.useServerCertificate:
             configFileArg = "-o /DIRAC/Security/UseServerCertificate=yes"
@@ -941,7 +961,10 @@ class ConfigureCPURequirements(CommandBase):
                     "Current normalized CPU as determined by 'dirac-wms-cpu-normalization' is %f"
                     % cpuNormalizationFactor
                 )
+        return cpuNormalizationFactor
 
+    def _getCPUTimeLeft(self, cpuNormalizationFactor):
+        """The CPU time left in the queue, in seconds, from dirac-wms-get-queue-cpu-time"""
         configFileArg = ""
         if self.pp.useServerCertificate:
             configFileArg = "-o /DIRAC/Security/UseServerCertificate=yes"
@@ -961,34 +984,14 @@ class ConfigureCPURequirements(CommandBase):
                 cpuTimeOutput = line.replace("CPU time left determined as", "").strip()
                 cpuTime = int(cpuTimeOutput)
                 self.log.info("CPUTime left (in seconds) is %d" % cpuTime)
-
-        # HS06s = seconds * HS06
-        try:
-            # determining the CPU time left (in HS06s)
-            self.pp.jobCPUReq = float(cpuTime) * float(cpuNormalizationFactor)
-            self.log.info("Queue length (which is also set as CPUTimeLeft) is %f" % self.pp.jobCPUReq)
-        except ValueError:
-            self.log.error("Pilot command output does not have the correct format")
-            self.exitWithError(1)
-        # now setting this value in local file
-        cfg = ["-FDMH"]
-        if self.pp.useServerCertificate:
-            cfg.append("-o  /DIRAC/Security/UseServerCertificate=yes")
-        if self.pp.localConfigFile:
-            cfg.append("-O %s" % self.pp.localConfigFile)  # our target file for pilots
-            cfg.extend(["--cfg", self.pp.localConfigFile])  # this file is also input
-        cfg.append("-o /LocalSite/CPUTimeLeft=%s" % str(int(self.pp.jobCPUReq)))  # the only real option
-
-        configureCmd = "%s %s" % (self.pp.configureScript, " ".join(cfg))
-        retCode, _configureOutData = self.executeAndGetOutput(configureCmd, self.pp.installEnv)
-        if retCode:
-            self.log.error("Failed to update CFG file for CPUTimeLeft [ERROR %d]" % retCode)
-            self.exitWithError(retCode)
+        return cpuTime
 
 
 class LaunchAgent(CommandBase):
     """Prepare and launch the job agent"""
 
+    runsPayloads = True
+
     def __init__(self, pilotParams):
         """c'tor"""
         super(LaunchAgent, self).__init__(pilotParams)
@@ -1077,7 +1080,8 @@ class LaunchAgent(CommandBase):
             " ".join(extraCFG),
         )
 
-        retCode, _output = self.executeAndGetOutput(jobAgent, self.pp.installEnv)
+        # the JobAgent may run for days: its output is only echoed, not kept
+        retCode, _output = self.executeAndGetOutput(jobAgent, self.pp.installEnv, capture="none")
         if retCode:
             self.log.error("Error executing the JobAgent [ERROR %d]" % retCode)
             self.exitWithError(retCode)
@@ -1108,6 +1112,9 @@ class NagiosProbes(CommandBase):
     The results are reported through the Pilot Logger.
     """
 
+    # seconds after which a probe is killed
+    probeTimeout = 300
+
     def __init__(self, pilotParams):
         """c'tor"""
         super(NagiosProbes, self).__init__(pilotParams)
@@ -1117,31 +1124,18 @@ class NagiosProbes(CommandBase):
     def _setNagiosOptions(self):
         """Setup list of Nagios probes and optional PUT URL from pilot.json"""
 
-        try:
-            self.nagiosProbes = [
-                str(pv).strip() for pv in self.pp.pilotJSON["Setups"][self.pp.setup]["NagiosProbes"].split(",")
-            ]
-        except KeyError:
-            try:
-                self.nagiosProbes = [
-                    str(pv).strip() for pv in self.pp.pilotJSON["Setups"]["Defaults"]["NagiosProbes"].split(",")
-                ]
-            except KeyError:
-                pass
-
-        try:
-            self.nagiosPutURL = str(self.pp.pilotJSON["Setups"][self.pp.setup]["NagiosPutURL"])
-        except KeyError:
-            try:
-                self.nagiosPutURL = str(self.pp.pilotJSON["Setups"]["Defaults"]["NagiosPutURL"])
-            except KeyError:
-                pass
+        self.nagiosProbes = self.pp.jsonOptions.getList("NagiosProbes", self.nagiosProbes)
+        nagiosPutURL = self.pp.jsonOptions.get("NagiosPutURL")
+        if nagiosPutURL is not None:
+            self.nagiosPutURL = str(nagiosPutURL)
 
         self.log.debug("NAGIOS PROBES [%s]" % ", ".join(self.nagiosProbes))
 
     def _runNagiosProbes(self):
-        """Run the probes one by one"""
+        """Run the probes, at the same time"""
 
+        results = {}
+        runnable = []
         for probeCmd in self.nagiosProbes:
             self.log.debug("Running Nagios probe %s" % probeCmd)
 
@@ -1151,12 +1145,24 @@ class NagiosProbes(CommandBase):
 
             except OSError:
                 self.log.error("File %s is missing! Skipping test" % probeCmd)
-                retCode = 2
-                output = "Probe file %s missing from pilot!" % probeCmd
+                results[probeCmd] = (2, "Probe file %s missing from pilot!" % probeCmd)
 
             else:
-                # FIXME: need a time limit on this in case the probe hangs
-                retCode, output = self.executeAndGetOutput("./" + probeCmd)
+                runnable.append(probeCmd)
+
+        # a probe that hangs is killed, and reported as "unknown"
+        for probeCmd, (retCode, output) in zip(
+            runnable,
+            self.executeInParallel(
+                ["./" + probeCmd for probeCmd in runnable],
+                timeout=self.probeTimeout,
+                maxParallel=self.pp.maxParallelCommands,
+            ),
+        ):
+            results[probeCmd] = (3 if retCode < 0 else retCode, output)
+
+        for probeCmd in self.nagiosProbes:
+            retCode, output = results[probeCmd]
 
             if retCode == 0:
                 self.log.info("Return code = 0: %s" % str(output).split("\n", 1)[0])
@@ -1182,12 +1188,7 @@ class NagiosProbes(CommandBase):
                 self.log.info("Putting %s Nagios output to https://%s%s" % (probeCmd, hostPort, path))
 
                 try:
-                    connection = HTTPSConnection(
-                        host=hostPort,
-                        timeout=30,
-                        key_file=os.environ["X509_USER_PROXY"],
-                        cert_file=os.environ["X509_USER_PROXY"],
-                    )
+                    connection = HTTPSConnection(host=hostPort, timeout=30, context=PilotCredentials.get().context)
 
                     connection.request("PUT", path, str(retCode) + " " + str(int(time.time())) + "\n" + output)
 
@@ -1,28 +1,40 @@
 """A set of common tools to be used in pilot commands"""
 
-import fcntl
+import atexit
 import getopt
+import hashlib
 import importlib.util
 import json
 import os
+import platform
 import re
-import select
-import signal
-import ssl
 import subprocess
 import sys
-import threading
+import time
 import warnings
-from datetime import datetime
-from functools import partial, wraps
+from collections.abc import Mapping
+from functools import partial
+from http.client import HTTPException
 from importlib import import_module
-from io import StringIO
+from io import BytesIO, StringIO
 from threading import RLock, Timer
-from urllib.error import HTTPError, URLError
-from urllib.parse import urlencode
-from urllib.request import urlopen
-
-from proxyTools import getVO
+from types import MappingProxyType
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from cfgTools import ConfigTransaction
+from cvmfsTools import CVMFSLocationMap
+from fileSystemTools import FileSystemProbe
+from jsonTools import LazyJSONObject
+from mjfTools import MachineJobFeatures
+from processTools import EchoSink, ProcessEngine, TimingReport
+from remoteLogTools import BatchSender, RemoteLogSpooler
+from threadTools import synchronized
+from transportTools import HTTPSTransport, PilotCredentials, encodeMessage, isErrorResponse
+
+# the platform of the preinstalled releases, like "Linux-x86_64": computed once, at import,
+# as platform.uname() may run a subprocess (with Python 3.6)
+_arch = platform.system() + "-" + platform.machine()
 
 # Utilities functions
 
@@ -87,64 +99,109 @@ def pythonPathCheck():
 
 
 def alarmTimeoutHandler(*args):
+    """SIGALRM handler raising an exception.
+
+    .. deprecated:: retrieveUrlTimeout does not use it any longer, it is kept for the extensions that may
+    """
     raise Exception("Timeout")
 
 
-def retrieveUrlTimeout(url, fileName, log, timeout=0):
+def retrieveUrlTimeout(url, fileName, log, timeout=0, sha256=None, retries=3, socketTimeout=60):
     """
-    Retrieve remote url to local file, with timeout wrapper
+    Retrieve remote url to local file, streamed in chunks to a temporary file renamed at the end.
+    A dropped connection is resumed (with an HTTP Range request) where it stopped. The transfer is only
+    successful if its size (Content-Length) or its SHA-256 could be verified: a connection closed early
+    can't be told from the end of a content of unknown size.
+
+    :param str url: the URL
+    :param str fileName: the local file (if empty: the content is returned)
+    :param log: the logger
+    :param int timeout: the longest time for the whole transfer, in seconds (0: no limit)
+    :param str sha256: the expected SHA-256 (hex digest) of the content, verified as it is received
+    :param int retries: the number of times in a row a transfer is resumed without getting any further
+    :param float socketTimeout: the longest time without network activity, in seconds
+    :return: True (or the content if no fileName), False if it failed
     """
-    urlData = ""
-    if timeout:
-        signal.signal(signal.SIGALRM, alarmTimeoutHandler)
-        # set timeout alarm
-        signal.alarm(timeout + 5)
+    deadline = time.time() + timeout if timeout else None
+    if fileName:
+        partName = fileName + ".part"
+        localFD = open(partName, "wb")
+    else:
+        localFD = BytesIO()
+    digest = hashlib.sha256()
+    received = 0
+    expectedBytes = 0
+    failures = 0
     try:
-        remoteFD = urlopen(url)
-        expectedBytes = 0
-        # Sometimes repositories do not return Content-Length parameter
-        try:
-            expectedBytes = int(remoteFD.info()["Content-Length"])
-        except Exception:
-            expectedBytes = 0
-        data = remoteFD.read()
-        if fileName:
-            with open(fileName, "wb") as localFD:
-                localFD.write(data)
-        else:
-            urlData += data
-        remoteFD.close()
-        if len(data) != expectedBytes and expectedBytes > 0:
+        while True:
+            headers = {"Range": "bytes=%d-" % received} if received else {}
+            try:
+                with urlopen(Request(url, headers=headers), timeout=socketTimeout) as remoteFD:
+                    if received and remoteFD.status != 206:
+                        # the server does not resume: from the start again
+                        localFD.seek(0)
+                        localFD.truncate()
+                        digest, received = hashlib.sha256(), 0
+                    # Sometimes repositories do not return Content-Length parameter
+                    try:
+                        if remoteFD.status == 206:
+                            expectedBytes = int(remoteFD.headers["Content-Range"].rsplit("/", 1)[1])
+                        else:
+                            expectedBytes = int(remoteFD.headers["Content-Length"])
+                    except (TypeError, ValueError, IndexError):
+                        expectedBytes = 0
+                    while True:
+                        if deadline and time.time() > deadline:
+                            log.error('Timeout after %s seconds on transfer request for "%s"' % (timeout, url))
+                            return False
+                        data = remoteFD.read(1048576)
+                        if not data:
+                            break
+                        localFD.write(data)
+                        digest.update(data)
+                        received += len(data)
+                        failures = 0
+                if expectedBytes <= 0 or received >= expectedBytes:
+                    break
+                error = "connection closed after %d bytes" % received
+            except HTTPError as x:
+                if x.code == 404:
+                    log.error("URL retrieve: %s does not exist" % url)
+                    return False
+                if x.code == 416:
+                    # the range is not satisfiable: from the start again
+                    localFD.seek(0)
+                    localFD.truncate()
+                    digest, received = hashlib.sha256(), 0
+                error = x
+            except (OSError, HTTPException) as x:
+                error = x
+            failures += 1
+            if failures > retries or (deadline and time.time() > deadline):
+                log.error('URL retrieve: transfer request for "%s" failed: %s' % (url, error))
+                return False
+            log.warn("URL retrieve: %s interrupted after %d bytes (%s), trying again" % (url, received, error))
+            # without progress, wait a bit before trying again
+            time.sleep(min(10, failures - 1))
+
+        if received != expectedBytes and expectedBytes > 0:
             log.error("URL retrieve: expected size does not match the received one")
             return False
-
-        if timeout:
-            signal.alarm(0)
-        if fileName:
-            return True
-        return urlData
-
-    except HTTPError as x:
-        if x.code == 404:
-            log.error("URL retrieve: %s does not exist" % url)
-            if timeout:
-                signal.alarm(0)
+        if sha256 and digest.hexdigest() != sha256.lower():
+            log.error("URL retrieve: SHA-256 of %s does not match (%s)" % (url, digest.hexdigest()))
             return False
-    except URLError:
-        log.error(
-            'Timeout after %s seconds on transfer request for "%s"'
-            % (str(timeout), url)
-        )
-        return False
-    except Exception as x:
-        if x == "Timeout":
-            log.error(
-                'Timeout after %s seconds on transfer request for "%s"'
-                % (str(timeout), url)
-            )
-        if timeout:
-            signal.alarm(0)
-        raise x
+        if not sha256 and expectedBytes <= 0:
+            log.error("URL retrieve: %s can't be verified (no Content-Length, and no SHA-256)" % url)
+            return False
+        if not fileName:
+            return localFD.getvalue()
+        localFD.close()
+        os.replace(partName, fileName)
+        return True
+    finally:
+        localFD.close()
+        if fileName and os.path.exists(partName):
+            os.remove(partName)
 
 
 def safe_listdir(directory, timeout=60):
@@ -156,25 +213,12 @@ def safe_listdir(directory, timeout=60):
         There is no distinction between an empty directory, and a non existent one.
         It will return `[]` in both cases.
 
+    The listing is not cached: the directory can be anywhere (like $X509_CERT_DIR), not only on CVMFS.
+
     :param str directory: directory to list
     :param int timeout: optional timeout, in seconds. Defaults to 60.
     """
-
-    def listdir(directory):
-        try:
-            return os.listdir(directory)
-        except FileNotFoundError:
-            print("%s not found" % directory)
-            return []
-
-    contents = []
-    t = threading.Thread(target=lambda: contents.extend(listdir(directory)))
-    t.daemon = True  # don't delay program's exit
-    t.start()
-    t.join(timeout)
-    if t.is_alive():
-        return None  # timeout
-    return contents
+    return FileSystemProbe.get().listdir(directory, timeout, cache=False)
 
 
 def getSubmitterInfo(ceName):
@@ -405,8 +449,8 @@ class ObjectLoader(object):
             return None, None
 
 
-def getCommand(params, commandName):
-    """Get an instantiated command object for execution.
+def getCommandClass(params, commandName):
+    """Get the class of a command.
     Commands are looked in the following modules in the order:
 
     1. `<CommandExtension>PilotCommands`
@@ -414,31 +458,231 @@ def getCommand(params, commandName):
     """
     extensions = params.commandExtensions
     modules = [m + "Commands" for m in extensions + ["pilot"]]
-    commandObject = None
+    commandClass = None
 
     # Look for commands in the modules in the current directory first
     for module in modules:
         try:
             commandModule = import_module(module)
-            commandObject = getattr(commandModule, commandName)
+            commandClass = getattr(commandModule, commandName)
         except Exception:
             pass
-        if commandObject:
-            return commandObject(params), module
+        if commandClass:
+            return commandClass, module
+
+    # No command found
+    return None, None
+
+
+def getCommand(params, commandName):
+    """Get an instantiated command object for execution (see getCommandClass for the modules searched)."""
+    commandClass, module = getCommandClass(params, commandName)
+    if commandClass:
+        return commandClass(params), module
 
     # No command could be instantiated
     return None, None
 
 
+class RepeatingTimer(Timer):
+    def run(self):
+        while not self.finished.wait(self.interval):
+            self.function(*self.args, **self.kwargs)
+
+
+class LogFile(object):
+    """Output file of the local loggers, kept open and shared by all the loggers writing to it.
+
+    The flush policy is one of:
+
+    - "line": flush after each message (the default)
+    - a number of seconds (e.g. "5"): flush at most every that many seconds
+    - "exit": flush only when the buffer is full, and when the pilot exits
+
+    In all cases the files are flushed at exit (also on SystemExit) and before a fork.
+    """
+
+    _rlock = RLock()
+    # open log files, by path
+    _files = {}
+    flushPolicy = "line"
+    _timer = None
+
+    def __init__(self, path):
+        """c'tor
+
+        :param str path: path of the file, where lines are appended
+        """
+        self.path = path
+        self.fd = None
+        self._checkedAt = None
+        self._open()
+
+    @classmethod
+    def get(cls, path):
+        """The (shared) log file of a path"""
+        with cls._rlock:
+            logFile = cls._files.get(path)
+            if logFile is None:
+                logFile = cls._files[path] = cls(path)
+            return logFile
+
+    def _open(self):
+        self.fd = open(self.path, "a", buffering=65536)
+
+    def _revalidate(self, now):
+        """Re-open the file (at most once per second) if it was removed or replaced, e.g. rotated"""
+        second = int(now)
+        if second == self._checkedAt:
+            return
+        self._checkedAt = second
+        try:
+            replaced = os.stat(self.path).st_ino != os.fstat(self.fd.fileno()).st_ino
+        except OSError:
+            replaced = True
+        if replaced:
+            self.fd.close()
+            self._open()
+
+    @synchronized
+    def write(self, text, now):
+        """Append text, and flush according to the flush policy
+
+        :param str text: the text
+        :param float now: the current time
+        """
+        self._revalidate(now)
+        self.fd.write(text)
+        if self.flushPolicy == "line":
+            self.fd.flush()
+
+    @synchronized
+    def flush(self):
+        if not self.fd.closed:
+            self.fd.flush()
+
+    @synchronized
+    def close(self):
+        self.fd.close()
+
+    @classmethod
+    def flushAll(cls):
+        """Flush all the log files, and the standard output"""
+        with cls._rlock:
+            for logFile in list(cls._files.values()):
+                try:
+                    logFile.flush()
+                except (IOError, OSError, ValueError):
+                    pass
+        try:
+            sys.stdout.flush()
+        except (IOError, OSError, ValueError):
+            pass
+
+    @classmethod
+    def closeAll(cls):
+        """Flush and close all the log files (e.g. before removing them)"""
+        with cls._rlock:
+            for logFile in list(cls._files.values()):
+                logFile.close()
+            cls._files.clear()
+
+    @classmethod
+    def setFlushPolicy(cls, policy):
+        """Set the flush policy of all the log files
+
+        :param str policy: "line", "exit" or a number of seconds
+        """
+        policy = str(policy).strip().lower()
+        if policy not in ("line", "exit"):
+            try:
+                interval = float(policy)
+            except ValueError:
+                raise ValueError("Invalid log flush policy: %s" % policy)
+            if interval <= 0:
+                policy = "line"
+        with cls._rlock:
+            cls.flushPolicy = policy
+            if cls._timer is not None:
+                cls._timer.cancel()
+                cls._timer = None
+            if policy not in ("line", "exit"):
+                cls._timer = RepeatingTimer(interval, cls.flushAll)
+                cls._timer.daemon = True
+                cls._timer.start()
+        cls.flushAll()
+
+
+atexit.register(LogFile.flushAll)
+if hasattr(os, "register_at_fork"):
+    # a forked child must not write again what the parent has buffered
+    os.register_at_fork(before=LogFile.flushAll)
+
+
 class Logger(object):
     """Basic logger object, for use inside the pilot. Just using print."""
 
+    # the timestamp of the messages, down to the second, and the second it is for
+    _datestamp = (None, "")
+    # structured mode (see setStructured): each message is also a JSON record, in the sidecar file
+    structured = False
+    sidecar = None
+    pilotUUID = "unknown"
+
     def __init__(self, name="Pilot", debugFlag=False, pilotOutput="pilot.out"):
         self.debugFlag = debugFlag
         self.name = name
         self.out = pilotOutput
         self._headerTemplate = "{datestamp} {{level}} [{name}] {{message}}"
 
+    @classmethod
+    def datestamp(cls, now):
+        """
+        Timestamp in ISO-8601 format, e.g. 2024-01-31T12:34:56.123456Z
+
+        :param float now: the time
+        :return: the timestamp
+        :rtype: str
+        """
+        second = int(now)
+        cachedSecond, prefix = cls._datestamp
+        if second != cachedSecond:
+            prefix = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(second))
+            cls._datestamp = (second, prefix)
+        return "%s.%06dZ" % (prefix, min(int((now - second) * 1000000), 999999))
+
+    @classmethod
+    def setStructured(cls, pilotUUID, sidecar="pilot.ndjson"):
+        """
+        Switch all the loggers to the structured mode: each message is also written as a JSON record
+        (NDJSON) to the sidecar file, and the remote loggers send records instead of text lines.
+
+        :param str pilotUUID: pilot unique ID, in each record
+        :param str sidecar: path of the NDJSON file (None: no file)
+        """
+        cls.structured = True
+        cls.pilotUUID = pilotUUID
+        cls.sidecar = sidecar
+
+    def makeRecord(self, level, msg, now=None):
+        """
+        A structured log record, one line of compact JSON.
+
+        :param str level: the message level
+        :param msg: the message
+        :param float now: the time of the message
+        :return: the record
+        :rtype: str
+        """
+        record = {
+            "ts": self.datestamp(time.time() if now is None else now),
+            "level": level,
+            "command": self.name,
+            "pilotUUID": self.pilotUUID,
+            "msg": str(msg),
+        }
+        return json.dumps(record, separators=(",", ":"))
+
     @property
     def messageTemplate(self):
         """
@@ -447,27 +691,24 @@ class Logger(object):
         :return: template string
         :rtype: str
         """
-        return self._headerTemplate.format(
-            datestamp=datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
-            name=self.name,
-        )
+        return self._headerTemplate.format(datestamp=self.datestamp(time.time()), name=self.name)
 
     def __outputMessage(self, msg, level, header):
         if self.out:
-            with open(self.out, "a") as outputFile:
-                for _line in str(msg).split("\n"):
-                    if header:
-                        outLine = self.messageTemplate.format(
-                            level=level, message=_line
-                        )
-                        print(outLine)
-                        if self.out:
-                            outputFile.write(outLine + "\n")
-                    else:
-                        print(_line)
-                        outputFile.write(_line + "\n")
-
-        sys.stdout.flush()
+            now = time.time()
+            if header:
+                prefix = "%s %s [%s] " % (self.datestamp(now), level, self.name)
+                text = "".join(prefix + _line + "\n" for _line in str(msg).split("\n"))
+            else:
+                text = str(msg) + "\n"
+            sys.stdout.write(text)
+            LogFile.get(self.out).write(text, now)
+        if self.structured and self.sidecar:
+            now = time.time()
+            LogFile.get(self.sidecar).write(self.makeRecord(level, msg, now) + "\n", now)
+
+        if LogFile.flushPolicy == "line":
+            sys.stdout.flush()
 
     def setDebug(self):
         self.debugFlag = True
@@ -503,21 +744,37 @@ class RemoteLogger(Logger):
         flushInterval=10,
         bufsize=1000,
         wnVO="unknown",
+        queueSize=10,
+        overflowPolicy="dropDebug",
+        compact=False,
+        buffer=None,
     ):
         """
         c'tor
         If flag PilotLoggerOn is not set, the logger will behave just like
         the original Logger object, that means it will just print logs locally on the screen
+
+        :param buffer: a FixedSizeBuffer shared with other loggers (see getRemoteLogPipeline), instead of
+                       a buffer of its own. The buffer parameters are then ignored.
         """
         super(RemoteLogger, self).__init__(name, debugFlag, pilotOutput)
         self.url = url
         self.pilotUUID = pilotUUID
         self.wnVO = wnVO
         self.isPilotLoggerOn = isPilotLoggerOn
-        sendToURL = partial(sendMessage, url, pilotUUID, wnVO, "sendMessage")
-        self.buffer = FixedSizeBuffer(
-            sendToURL, bufsize=bufsize, autoflush=flushInterval
-        )
+        # compact (gzip, JSON) message format, if the server supports it
+        self.compact = compact
+        if buffer is not None:
+            self.buffer = buffer
+        else:
+            sendToURL = partial(sendMessage, url, pilotUUID, wnVO, "sendMessage", compact=compact)
+            self.buffer = FixedSizeBuffer(
+                sendToURL,
+                bufsize=bufsize,
+                autoflush=flushInterval,
+                maxBatches=queueSize,
+                overflowPolicy=overflowPolicy,
+            )
 
     def debug(self, msg, header=True, _sendPilotLog=False):
         # TODO: Send pilot log remotely?
@@ -525,25 +782,49 @@ class RemoteLogger(Logger):
         if (
             self.isPilotLoggerOn and self.debugFlag
         ):  # the -d flag activates this debug flag in CommandBase via PilotParams
-            self.sendMessage(self.messageTemplate.format(level="DEBUG", message=msg))
+            self.sendMessage(self.remoteRecord("DEBUG", msg))
 
     def error(self, msg, header=True, _sendPilotLog=False):
         # TODO: Send pilot log remotely?
         super(RemoteLogger, self).error(msg, header)
         if self.isPilotLoggerOn:
-            self.sendMessage(self.messageTemplate.format(level="ERROR", message=msg))
+            self.sendMessage(self.remoteRecord("ERROR", msg))
 
     def warn(self, msg, header=True, _sendPilotLog=False):
         # TODO: Send pilot log remotely?
         super(RemoteLogger, self).warn(msg, header)
         if self.isPilotLoggerOn:
-            self.sendMessage(self.messageTemplate.format(level="WARNING", message=msg))
+            self.sendMessage(self.remoteRecord("WARNING", msg))
 
     def info(self, msg, header=True, _sendPilotLog=False):
         # TODO: Send pilot log remotely?
         super(RemoteLogger, self).info(msg, header)
         if self.isPilotLoggerOn:
-            self.sendMessage(self.messageTemplate.format(level="INFO", message=msg))
+            self.sendMessage(self.remoteRecord("INFO", msg))
+
+    def remoteRecord(self, level, msg):
+        """
+        What is sent for a message: a JSON record in structured mode, a text line otherwise.
+
+        :param str level: the message level
+        :param msg: the message
+        :return: the record or line (without a newline)
+        :rtype: str
+        """
+        if self.structured:
+            return self.makeRecord(level, msg)
+        return self.messageTemplate.format(level=level, message=msg)
+
+    def write(self, text):
+        """
+        Relay the output of a subprocess. In structured mode each line becomes an OUTPUT record.
+
+        :param str text: the output
+        """
+        if self.structured:
+            text = "".join(self.makeRecord("OUTPUT", line) + "\n" for line in text.splitlines())
+        if text:
+            self.buffer.write(text)
 
     def sendMessage(self, msg):
         """
@@ -561,28 +842,39 @@ class RemoteLogger(Logger):
             super(RemoteLogger, self).error(str(err))
 
 
-def synchronized(func):
-    @wraps(func)
-    def wrapper(self, *args, **kwargs):
-        with self._rlock:
-            return func(self, *args, **kwargs)
-
-    return wrapper
-
-
-class RepeatingTimer(Timer):
-    def run(self):
-        while not self.finished.wait(self.interval):
-            self.function(*self.args, **self.kwargs)
-
-
 class FixedSizeBuffer(object):
     """
     A buffer with a (preferred) fixed number of lines.
-    Once it's full, a message is sent to a remote server and the buffer is renewed.
+    Once it's full, its content is queued for a background thread sending it to a remote server,
+    and the buffer is renewed. Writing to the buffer never waits for the server.
+
+    The buffer is full when it holds bufsize lines, or maxBytes characters (e.g. long output without
+    newlines). With maxLatency, no record waits longer than that in the buffer: the sender thread flushes
+    it at the deadline of its first record. In adaptive mode the
+    number of lines per batch follows the time the server takes to answer: it grows (up to maxScale times
+    bufsize) while sending is slow, fewer and larger requests being cheaper for a busy server, and
+    shrinks (down to minScale times bufsize) while sending is fast, so that the log is more up to date.
     """
 
-    def __init__(self, senderFunc, bufsize=1000, autoflush=10):
+    # how long an explicit flush() waits for the lines to be sent
+    flushTimeout = 60
+    # adaptive mode: sending is slow (s), fast (s), and the bounds of the batch size scale
+    slowLatency = 1.0
+    fastLatency = 0.2
+    minScale = 0.25
+    maxScale = 8
+
+    def __init__(
+        self,
+        senderFunc,
+        bufsize=1000,
+        autoflush=10,
+        maxBatches=10,
+        overflowPolicy="dropDebug",
+        maxBytes=1048576,
+        maxLatency=0,
+        adaptive=False,
+    ):
         """
         Constructor.
 
@@ -592,20 +884,40 @@ class FixedSizeBuffer(object):
         :type bufsize: int
         :param autoflush: buffer flush period in seconds
         :type autoflush: int
+        :param maxBatches: maximum number of buffers waiting to be sent
+        :type maxBatches: int
+        :param overflowPolicy: what to do when too many buffers are waiting, see BatchSender
+        :type overflowPolicy: str
+        :param maxBytes: size of the buffer (in characters), whatever the number of lines
+        :type maxBytes: int
+        :param maxLatency: longest time (in seconds) a record stays in the buffer (0: no limit)
+        :type maxLatency: float
+        :param adaptive: adapt the number of lines per batch to the time taken to send them
+        :type adaptive: bool
         """
 
         self._rlock = RLock()
+        self.sender = BatchSender(
+            senderFunc,
+            maxBatches=maxBatches,
+            overflowPolicy=overflowPolicy,
+            onSent=self._adapt if adaptive else None,
+            onDeadline=self._flushLate,
+        )
         if autoflush > 0:
-            self._timer = RepeatingTimer(autoflush, self.flush)
+            self._timer = RepeatingTimer(autoflush, self.flush, kwargs={"wait": False})
             self._timer.start()
         else:
             self._timer = None
         self.output = StringIO()
         self.bufsize = bufsize
+        self.maxBytes = maxBytes
+        self.maxLatency = maxLatency
+        self.scale = 1.0
         self._nlines = 0
+        self._nbytes = 0
         self.senderFunc = senderFunc
 
-    @synchronized
     def write(self, text):
         """
         Write text to a string buffer. Newline characters are counted and number of lines in the buffer
@@ -616,43 +928,90 @@ class FixedSizeBuffer(object):
         :return: None
         :rtype: None
         """
-        # reopen the buffer in a case we had to flush a partially filled buffer
-        if self.output.closed:
-            self.output = StringIO()
-        self.output.write(text)
-        self._nlines += max(1, text.count("\n"))
+        with self._rlock:
+            # reopen the buffer in a case we had to flush a partially filled buffer
+            if self.output.closed:
+                self.output = StringIO()
+            if self._nlines == 0 and self.maxLatency > 0:
+                # the first record of the batch: it must be sent within maxLatency
+                self.sender.setDeadline(time.time() + self.maxLatency)
+            self.output.write(text)
+            self._nlines += max(1, text.count("\n"))
+            self._nbytes += len(text)
         self.sendFullBuffer()
 
+    @synchronized
+    def _adapt(self, latency):
+        """Adapt the batch size to the time taken to send the last batch (adaptive mode)
+
+        :param float latency: the time taken, in seconds
+        """
+        if latency > self.slowLatency:
+            self.scale = min(self.maxScale, self.scale * 2)
+        elif latency < self.fastLatency:
+            self.scale = max(self.minScale, self.scale / 2)
+
+    @property
+    def limits(self):
+        """Current size of a batch: number of lines and of characters
+
+        :rtype: tuple
+        """
+        # a larger batch can't exceed maxBytes (e.g. the server request size limit)
+        return max(1, int(self.bufsize * self.scale)), int(self.maxBytes * min(1, self.scale))
+
     @synchronized
     def getValue(self):
         content = self.output.getvalue()
         return content
 
-    @synchronized
     def sendFullBuffer(self):
         """
-        Get the buffer content, send a message, close the current buffer and re-create a new one for subsequent writes.
+        Queue the buffer content for sending, close the current buffer and re-create a new one for subsequent writes.
 
         """
 
-        if self._nlines >= self.bufsize:
-            self.flush()
+        with self._rlock:
+            maxLines, maxBytes = self.limits
+            if self._nlines < maxLines and self._nbytes < maxBytes:
+                return
+            self._queueContent()
             self.output = StringIO()
+        # without the lock: the other writers can go on
+        self.sender.waitForRoom()
 
-    @synchronized
-    def flush(self):
-        """
-        Flush the buffer and send log records to a remote server. The buffer is closed as well.
-
-        :return: None
-        :rtype:  None
+    def _queueContent(self):
+        """Queue the buffer content for the sender thread, without waiting, and close the buffer
+        (called with the lock held)
         """
         if not self.output.closed and self._nlines > 0:
             self.output.flush()
             buf = self.getValue()
-            self.senderFunc(buf)
-            self._nlines = 0
+            self.sender.put(buf, wait=False)
+            self._nlines = self._nbytes = 0
             self.output.close()
+        self.sender.setDeadline(None)
+
+    def _flushLate(self):
+        """Flush the buffer at the maxLatency deadline (called by the sender thread: it does not wait)"""
+        with self._rlock:
+            self._queueContent()
+
+    def flush(self, wait=True):
+        """
+        Flush the buffer: its content is queued for the sender thread. The buffer is closed as well.
+
+        :param wait: wait (at most flushTimeout seconds) until all the queued lines are sent
+        :type wait: bool
+        :return: None
+        :rtype:  None
+        """
+        with self._rlock:
+            self._queueContent()
+        # without the lock: writers can go on
+        self.sender.waitForRoom()
+        if wait:
+            self.sender.drain(self.flushTimeout)
 
     def cancelTimer(self):
         """
@@ -663,9 +1022,72 @@ class FixedSizeBuffer(object):
         """
         if self._timer is not None:
             self._timer.cancel()
+        self.sender.setDeadline(None)
+
+
+_pipelineLock = RLock()
 
 
-def sendMessage(url, pilotUUID, wnVO, method, rawMessage):
+def getRemoteLogPipeline(pilotParams):
+    """
+    The remote log pipeline of the pilot, created on first use: one buffer, with one flush timer and
+    one sender thread, shared by the remote loggers of the pilot and of all its commands
+    (each logger tags its messages with its name). The steering script flushes it at exit.
+
+    :param pilotParams: the pilot parameters, where the pipeline is kept
+    :return: the pipeline
+    :rtype: FixedSizeBuffer
+    """
+
+    def sendToURL(url, method, message):
+        sendMessage(url, pilotParams.pilotUUID, pilotParams.wnVO, method, message, compact=pilotParams.loggerCompact)
+
+    with _pipelineLock:
+        if pilotParams.logPipeline is None:
+            # what can't be sent is spooled, and replayed later
+            spooler = RemoteLogSpooler(
+                [pilotParams.loggerURL] + pilotParams.loggerFailoverURLs, sendToURL, pilotUUID=pilotParams.pilotUUID
+            )
+            pilotParams.logPipeline = FixedSizeBuffer(
+                spooler,
+                bufsize=pilotParams.loggerBufsize,
+                autoflush=pilotParams.loggerTimerInterval,
+                maxBatches=pilotParams.loggerQueueSize,
+                overflowPolicy=pilotParams.loggerOverflowPolicy,
+                maxBytes=pilotParams.loggerBufferBytes,
+                maxLatency=pilotParams.loggerMaxLatency,
+                adaptive=pilotParams.loggerFlushPolicy == "adaptive",
+            )
+        return pilotParams.logPipeline
+
+
+def finaliseRemoteLogs(pilotParams, log, exitCode):
+    """
+    Flush the remote log pipeline, wait for it to be sent, and mark the remote pilot log as final.
+    Called once, by the steering script, when the pilot exits.
+
+    :param pilotParams: the pilot parameters
+    :param log: the remote logger of the steering script
+    :param exitCode: the exit code of the pilot
+    """
+    log.info(
+        "Flushing the remote logger buffer for pilot on sys.exit(): %s (exit code:%s)"
+        % (pilotParams.pilotReference, str(exitCode))
+    )
+    pipeline = getRemoteLogPipeline(pilotParams)
+    pipeline.flush()  # flush the buffer unconditionally (on sys.exit()).
+    spooler = pipeline.senderFunc
+    # a last chance for what is spooled, even with the circuit breaker open
+    if not spooler.replay(force=True):
+        log.error("Remote logger: %s spooled lines not sent" % spooler.spooledLines)
+    counters = dict(pipeline.sender.counters, **spooler.counters)
+    message = {"retCode": str(exitCode), "timing": pilotParams.timing.summary(), "remoteLogger": counters}
+    if not spooler.send("finaliseLogs", message, force=not spooler.failures):
+        log.error("Remote logger couldn't be finalised")
+    pipeline.cancelTimer()
+
+
+def sendMessage(url, pilotUUID, wnVO, method, rawMessage, compact=False):
     """
     Invoke a remote method on a Tornado server and pass a JSON message to it.
 
@@ -674,33 +1096,47 @@ def sendMessage(url, pilotUUID, wnVO, method, rawMessage):
     :param str wnVO: VO name, relevant only if not contained in a proxy
     :param str method: a method to be invoked
     :param str rawMessage: a message to be sent, in JSON format
+    :param bool compact: try the compact format first. A server rejecting it (4xx, or an S_ERROR answer)
+                         gets the legacy format, from then on.
     :return: None.
     """
-    caPath = os.getenv("X509_CERT_DIR")
-    cert = os.getenv("X509_USER_PROXY")
+    credentials = PilotCredentials.get()
+    context, isHost = credentials.context, credentials.isHost
+    transport = HTTPSTransport.get(url)
 
-    context = ssl.create_default_context()
-    context.load_verify_locations(capath=caPath)
+    if compact and transport.compactSupported.get(url) is not False:
+        data, headers = encodeMessage(method, rawMessage, pilotUUID, wnVO, isHost, compact=True)
+        try:
+            body = transport.post(url, data, context, headers)
+            if transport.compactSupported.get(url) or not isErrorResponse(body):
+                transport.compactSupported[url] = True
+                return
+        except HTTPError as exc:
+            if transport.compactSupported.get(url) or not 400 <= exc.code < 500:
+                raise
+        # an older server
+        transport.compactSupported[url] = False
 
-    message = json.dumps((json.dumps(rawMessage), pilotUUID, wnVO))
+    data, headers = encodeMessage(method, rawMessage, pilotUUID, wnVO, isHost)
+    transport.post(url, data, context, headers)
 
-    try:
-        context.load_cert_chain(cert)  # this is a proxy
-        raw_data = {"method": method, "args": message}
-    except IsADirectoryError:  # assuming it'a dir containing cert and key
-        context.load_cert_chain(
-            os.path.join(cert, "hostcert.pem"), os.path.join(cert, "hostkey.pem")
-        )
-        raw_data = {"method": method, "args": message, "extraCredentials": '"hosts"'}
 
-    data = urlencode(raw_data).encode("utf-8")  # encode to bytes
+class CommandBase(object):
+    """CommandBase is the base class for every command in the pilot commands toolbox"""
 
-    res = urlopen(url, data, context=context)
-    res.close()
+    # Commands reading the local configuration file (e.g. through dirac-configure or the JobAgent)
+    # need the options pending in the configuration transaction to be written before they run.
+    needsLocalConfig = True
 
+    # Resources (e.g. "installEnv", "pilot.cfg") the command needs and produces, so that independent commands
+    # can run concurrently (see CommandScheduler). None: the command runs alone, in the command list order.
+    # The local cfg file is rewritten in place (by dirac-configure, dirac-wms-cpu-normalization -U...):
+    # a command reading or writing it needs "localConfig", and produces it if it adds options.
+    needs = None
+    produces = None
 
-class CommandBase(object):
-    """CommandBase is the base class for every command in the pilot commands toolbox"""
+    # The command runs the payloads (like LaunchAgent): what only helps the pilot set up stops before it
+    runsPayloads = False
 
     def __init__(self, pilotParams):
         """
@@ -714,24 +1150,24 @@ class CommandBase(object):
 
         self.pp = pilotParams
         self.debugFlag = pilotParams.debugFlag
+        # position in the command list, keeps the order of the configuration options of concurrent commands
+        self.sequence = None
         loggerURL = pilotParams.loggerURL
         # URL present and the flag is set:
         isPilotLoggerOn = pilotParams.pilotLogging and (loggerURL is not None)
-        interval = pilotParams.loggerTimerInterval
-        bufsize = pilotParams.loggerBufsize
 
         if not isPilotLoggerOn:
             self.log = Logger(self.__class__.__name__, debugFlag=self.debugFlag)
         else:
-            # remote logger
+            # remote logger: a view, tagged with the command name, of the pilot log pipeline
             self.log = RemoteLogger(
                 loggerURL,
                 self.__class__.__name__,
                 pilotUUID=pilotParams.pilotUUID,
                 debugFlag=self.debugFlag,
-                flushInterval=interval,
-                bufsize=bufsize,
                 wnVO=pilotParams.wnVO,
+                compact=pilotParams.loggerCompact,
+                buffer=getRemoteLogPipeline(pilotParams),
             )
 
         self.log.isPilotLoggerOn = isPilotLoggerOn
@@ -741,58 +1177,74 @@ class CommandBase(object):
         self.log.debug("Initialized command %s" % self.__class__.__name__)
         self.log.debug("pilotParams option list: %s" % self.pp.optList)
 
-    def executeAndGetOutput(self, cmd, environDict=None):
-        """Execute a command on the worker node and get the output"""
-
-        self.log.info("Executing command %s" % cmd)
-        _p = subprocess.Popen(
-            cmd,
-            shell=True,
-            env=environDict,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            close_fds=False,
-        )
+    def executeAndGetOutput(self, cmd, environDict=None, capture="full", timeout=None):
+        """Execute a command on the worker node and get the output
 
-        # Use non-blocking I/O on the process pipes
-        for fd in [_p.stdout.fileno(), _p.stderr.fileno()]:
-            fl = fcntl.fcntl(fd, fcntl.F_GETFL)
-            fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+        The output is always echoed (and sent to the remote logger, if on), but only what
+        the capture policy asks for is kept in memory and returned.
 
-        outData = ""
-        while True:
-            readfd, _, _ = select.select([_p.stdout, _p.stderr], [], [])
-            dataWasRead = False
-            for stream in readfd:
-                outChunk = stream.read().decode("ascii", "replace")
-                if not outChunk:
-                    continue
-                dataWasRead = True
-
-                if stream == _p.stderr:
-                    sys.stderr.write(outChunk)
-                    sys.stderr.flush()
-                else:
-                    sys.stdout.write(outChunk)
-                    sys.stdout.flush()
-                    if hasattr(self.log, "buffer") and self.log.isPilotLoggerOn:
-                        self.log.buffer.write(outChunk)
-                    outData += outChunk
-            # If no data was read on any of the pipes then the process has finished
-            if not dataWasRead:
-                break
-
-        # Ensure output ends on a newline
-        sys.stdout.write("\n")
-        sys.stdout.flush()
-        sys.stderr.write("\n")
-        sys.stderr.flush()
-
-        # return code
-        returnCode = _p.wait()
-        self.log.debug("Return code of %s: %d" % (cmd, returnCode))
-
-        return (returnCode, outData)
+        :param str cmd: the command to execute
+        :param dict environDict: the environment for the command
+        :param capture: the output capture policy, see OutputCapture:
+                        "full", "lastLine", "none" or a number of lines to keep
+        :param timeout: seconds after which the command (and its process group) is killed
+        :return: (return code, captured standard output)
+        :rtype: tuple
+        """
+        return self.executeInParallel([cmd], environDict, capture, timeout)[0]
+
+    def executeInParallel(self, cmds, environDict=None, capture="full", timeout=None, maxParallel=None):
+        """Execute several commands on the worker node at the same time, and get their output.
+        When more than one command is given, each echoed line is prefixed with the command.
+
+        :param list cmds: the commands to execute
+        :param dict environDict: the environment for the commands
+        :param capture: the output capture policy, see executeAndGetOutput
+        :param timeout: seconds after which each command (and its process group) is killed
+        :param int maxParallel: maximum number of commands running at the same time (None: no limit)
+        :return: (return code, captured standard output) of each command, in order
+        :rtype: list
+        """
+        engine = ProcessEngine(maxParallel)
+        # the remote logger relays the output (as records, in structured mode)
+        buffer = self.log if hasattr(self.log, "buffer") and self.log.isPilotLoggerOn else None
+        for cmd in cmds:
+            self.log.info("Executing command %s" % cmd)
+            prefix = "[%s] " % cmd if len(cmds) > 1 else ""
+            engine.submit(cmd, environDict, timeout, capture, [EchoSink(prefix, buffer)])
+
+        results = []
+        for execution in engine.run():
+            if execution.timedOut:
+                self.log.error("Command %s timed out after %s seconds, killed" % (execution.cmd, timeout))
+            self.log.debug("Return code of %s: %d" % (execution.cmd, execution.returnCode))
+            self.pp.timing.addSubprocess(
+                self.__class__.__name__, execution.cmd, execution.wallTime, execution.rusage, execution.returnCode
+            )
+            results.append((execution.returnCode, execution.output.getValue()))
+        return results
+
+    def addConfigOption(self, path, value):
+        """Add an option to the local configuration transaction (written later by commitLocalConfig)
+
+        :param str path: absolute option path, e.g. /LocalSite/Architecture
+        :param value: option value
+        """
+        self.pp.cfgTransaction.addOption(path, value, self.sequence)
+
+    def addConfigSwitch(self, switch):
+        """Add a dirac-configure switch (e.g. '-n "SiteName"') to the local configuration transaction
+
+        :param str switch: the switch, as it would appear on the dirac-configure command line
+        """
+        self.pp.cfgTransaction.addSwitch(switch, self.sequence)
+
+    def commitLocalConfig(self):
+        """Write the options pending in the local configuration transaction to the local cfg file"""
+        retCode = self.pp.cfgTransaction.commit(self)
+        if retCode:
+            self.log.error("Could not configure DIRAC [ERROR %d]" % retCode)
+            self.exitWithError(retCode)
 
     def exitWithError(self, errorCode):
         """Wrapper around sys.exit()"""
@@ -802,7 +1254,7 @@ class CommandBase(object):
 
         self.log.info("List of child processes of current PID:")
         retCode, _outData = self.executeAndGetOutput(
-            "ps --forest -o pid,%%cpu,%%mem,tty,stat,time,cmd -g %d" % os.getpid()
+            "ps --forest -o pid,%%cpu,%%mem,tty,stat,time,cmd -g %d" % os.getpid(), capture="none"
         )
         if retCode:
             self.log.error("Failed to issue ps [ERROR %d] " % retCode)
@@ -845,9 +1297,317 @@ class CommandBase(object):
         return parsedVersion.split("==")[1] if "==" in parsedVersion else parsedVersion
 
 
+class OptionIndex(object):
+    """
+    Read-only, flattened index of the options of some sections of the pilot JSON file, built in one pass.
+    Nested options are indexed by their path, like "Commands/HTCondorCE". An option found in a section
+    which comes later has a preference over the same option found in earlier sections. When one of several
+    options is looked for (e.g. the commands of a CE type, or else the default ones), the section comes
+    first, then the order of the options. The JSON dict is not modified.
+    """
+
+    def __init__(self, jsonDict, sections):
+        """c'tor
+
+        :param dict jsonDict: the content of the JSON file
+        :param list sections: paths of the sections, like "/Setups/Defaults", by increasing preference
+        """
+        index = {}
+        for rank, path in enumerate(sections):
+            section = self.getSection(jsonDict, path)
+            if isinstance(section, Mapping):
+                self.__flatten(section, "", rank, index)
+        # option: (rank of the section, value)
+        self._index = MappingProxyType(index)
+
+    @staticmethod
+    def getSection(jsonDict, path):
+        """The section at a path, or None if there is none"""
+        section = jsonDict
+        for elem in path.strip("/").split("/"):
+            if not isinstance(section, Mapping) or elem not in section:
+                return None
+            section = section[elem]
+        return section
+
+    def __flatten(self, section, prefix, rank, index):
+        for key, value in section.items():
+            index[prefix + key] = (rank, value)
+            if isinstance(value, Mapping):
+                self.__flatten(value, prefix + key + "/", rank, index)
+
+    def __contains__(self, option):
+        return option in self._index
+
+    def __getitem__(self, option):
+        return self._index[option][1]
+
+    def lookup(self, options, default=None):
+        """Look for an option, or for the first of several options found in the preferred section
+
+        :param options: an option, or a list of options
+        :return: (the option found or None, its value or the default)
+        :rtype: tuple
+        """
+        if isinstance(options, str):
+            options = [options]
+        bestOption, bestRank, bestValue = None, None, default
+        for option in options:
+            entry = self._index.get(option)
+            if entry is not None and (bestRank is None or entry[0] > bestRank):
+                bestOption, (bestRank, bestValue) = option, entry
+        return bestOption, bestValue
+
+    def get(self, options, default=None):
+        """The value of an option (see lookup)"""
+        return self.lookup(options, default)[1]
+
+    def getList(self, options, default=None):
+        """The value of an option, a list or a comma-separated string, as a list of stripped strings"""
+        value = self.get(options)
+        return default if value is None else self.toList(value)
+
+    @staticmethod
+    def toList(value):
+        if isinstance(value, str):
+            value = value.split(",")
+        return [str(pv).strip() for pv in value]
+
+    def flatten(self):
+        """All the options, nested ones included, with their value
+
+        :rtype: dict
+        """
+        return {option: entry[1] for option, entry in self._index.items()}
+
+    @classmethod
+    def fromFlat(cls, options):
+        """The index of options returned by flatten()"""
+        index = cls({}, [])
+        index._index = MappingProxyType({option: (0, value) for option, value in options.items()})
+        return index
+
+    def asDict(self):
+        """The options of the sections (not nested)
+
+        :rtype: dict
+        """
+        return {option: entry[1] for option, entry in self._index.items() if "/" not in option}
+
+
+def optionFlag(value, current):
+    """A command line flag (an option without a value)"""
+    return True
+
+
+def optionString(value, current):
+    return value
+
+
+def optionInt(value, current):
+    """An integer: an invalid value is ignored"""
+    try:
+        return int(value)
+    except ValueError:
+        return current
+
+
+def optionStrictInt(value, current):
+    """An integer: an invalid value raises ValueError"""
+    return int(value)
+
+
+def optionList(value, current):
+    """A comma-separated list"""
+    return value.split(",")
+
+
+def optionAppend(value, current):
+    """An option that can be repeated, each value is added to the list"""
+    return (current or []) + [value]
+
+
+def optionDict(value, current):
+    """Comma-separated name=value pairs, added to the dictionary"""
+    result = dict(current or {})
+    for item in value.split(","):
+        result[item.split("=", 1)[0].strip()] = item.split("=", 1)[1].strip()
+    return result
+
+
+def optionRelease(value, current):
+    """The first of a comma-separated list of releases"""
+    return value.split(",", 1)[0]
+
+
 class PilotParams(object):
     """Class that holds the structure with all the parameters to be used across all the commands"""
 
+    # Pilot command options: (short, long, description, attribute, converter, phase).
+    # Phase 1 options are applied before reading the JSON file, phase 2 ones override it.
+    options = [
+        ("", "requiredTag=", "extra required tags for resource description", "reqtags", optionAppend, 2),
+        ("a:", "gridCEType=", "Grid CE Type (CREAM etc)", "gridCEType", optionString, 1),
+        ("c", "cert", "Use server certificate instead of proxy", "useServerCertificate", optionFlag, 2),
+        ("d", "debug", "Set debug flag", "debugFlag", optionFlag, 1),
+        ("e:", "extraPackages=", "Extra packages to install (comma separated)", "extensions", optionList, 2),
+        ("g:", "loggerURL=", "Remote Logger service URL", "loggerURL", optionString, 2),
+        ("h", "help", "Show this help", None, None, 2),
+        ("k", "keepPP", "Do not clear PYTHONPATH on start", "keepPythonPath", optionFlag, 2),
+        ("l:", "project=", "Project to install", "releaseProject", optionString, 2),
+        ("n:", "name=", "Set <Site> as Site Name", "site", optionString, 2),
+        ("o:", "option=", "Option=value to add", "genericOption", optionString, 2),
+        (
+            "m:",
+            "maxNumberOfProcessors=",
+            "specify a max number of processors to use by the payload inside a pilot",
+            "maxNumberOfProcessors",
+            optionStrictInt,
+            2,
+        ),
+        ("", "modules=", "for installing non-released code", "modules", optionString, 2),
+        (
+            "",
+            "userEnvVariables=",
+            'User-requested environment variables (comma-separated, name and value separated by ":::")',
+            "userEnvVariables",
+            optionString,
+            2,
+        ),
+        ("", "pipInstallOptions=", "Options to pip install", "pipInstallOptions", optionString, 2),
+        ("r:", "release=", "DIRAC release to install", "releaseVersion", optionRelease, 2),
+        ("s:", "section=", "Set base section for relative parsed options", None, None, 2),
+        ("t:", "tag=", "extra tags for resource description", "tags", optionAppend, 2),
+        ("u:", "url=", "Use <url> to download tarballs", None, None, 2),
+        ("x:", "execute=", "Execute instead of JobAgent", "executeCmd", optionString, 2),
+        ("y:", "CEType=", "CE Type (normally InProcess)", "ceType", optionString, 2),
+        ("z", "pilotLogging", "Activate pilot logging system", "pilotLogging", optionFlag, 2),
+        (
+            "",
+            "structuredLogging",
+            "Log structured (NDJSON) records, to pilot.ndjson and the remote logger",
+            "structuredLogging",
+            optionFlag,
+            2,
+        ),
+        ("", "warmUpCVMFS", "Read ahead the DIRAC release in CVMFS, in the background", "warmUpCVMFS", optionFlag, 2),
+        ("", "warmUpManifest=", "Files read first by the CVMFS warm-up", "warmUpManifest", optionString, 2),
+        ("C:", "configurationServer=", "Configuration servers to use", "configServer", optionString, 2),
+        ("D:", "disk=", "Require at least <space> MB available", "minDiskSpace", optionInt, 2),
+        ("E:", "commandExtensions=", "Python modules with extra commands", "commandExtensions", optionList, 2),
+        ("F:", "pilotCFGFile=", "Specify pilot CFG file", "pilotCFGFile", optionString, 1),
+        ("G:", "Group=", "DIRAC Group to use", "userGroup", optionString, 2),
+        ("K:", "certLocation=", "Specify server certificate location", "certsLocation", optionString, 2),
+        ("M:", "MaxCycles=", "Maximum Number of JobAgent cycles to run", "maxCycles", optionInt, 2),
+        ("", "PollingTime=", "JobAgent execution frequency", "pollingTime", optionInt, 2),
+        (
+            "",
+            "StopOnApplicationFailure=",
+            "Stop Job Agent when encounter an application failure",
+            "stopOnApplicationFailure",
+            optionString,
+            2,
+        ),
+        (
+            "",
+            "StopAfterFailedMatches=",
+            "Stop Job Agent after N failed matches",
+            "stopAfterFailedMatches",
+            optionInt,
+            2,
+        ),
+        ("N:", "Name=", "CE Name", "ceName", optionString, 1),
+        ("O:", "OwnerDN=", "Pilot OwnerDN (for private pilots)", "userDN", optionString, 2),
+        ("", "wnVO=", "Bind the resource (WN) to a VO", "wnVO", optionString, 1),
+        ("P:", "pilotProcessors=", "Number of processors allocated to this pilot", "pilotProcessors", optionInt, 2),
+        ("Q:", "Queue=", "Queue name", "queueName", optionString, 1),
+        ("R:", "reference=", "Use this pilot reference", None, None, 2),
+        ("S:", "setup=", "DIRAC Setup to use", "setup", optionString, 1),
+        ("T:", "CPUTime=", "Requested CPU Time", "jobCPUReq", optionString, 2),
+        (
+            "W:",
+            "gateway=",
+            "Configure <gateway> as DIRAC Gateway during installation",
+            "gateway",
+            optionString,
+            2,
+        ),
+        ("X:", "commands=", "Pilot commands to execute", "commands", optionList, 2),
+        ("Z:", "commandOptions=", "Options parsed by command modules", "commandOptions", optionDict, 2),
+        ("", "pilotUUID=", "pilot UUID", "pilotUUID", optionString, 2),
+        ("", "preinstalledEnv=", "preinstalled pilot environment script location", "preinstalledEnv", optionString, 2),
+        (
+            "",
+            "preinstalledEnvPrefix=",
+            "preinstalled pilot environment area prefix",
+            "preinstalledEnvPrefix",
+            optionString,
+            2,
+        ),
+        ("", "architectureScript=", "architecture script to use", "architectureScript", optionString, 2),
+        ("", "CVMFS_locations=", "comma-separated list of CVMS locations", "CVMFS_locations", optionList, 2),
+        (
+            "",
+            "maxParallelCommands=",
+            "Maximum number of pilot commands running concurrently",
+            "maxParallelCommands",
+            optionInt,
+            2,
+        ),
+        (
+            "",
+            "compileConfig",
+            "Write the options resolved from the JSON file for this CE, queue, VO and setup, to <JSON file>.compiled",
+            "compileConfig",
+            optionFlag,
+            1,
+        ),
+        (
+            "",
+            "logFlushPolicy=",
+            "When pilot.out is flushed: line (default), exit or a number of seconds",
+            "logFlushPolicy",
+            optionString,
+            2,
+        ),
+    ]
+
+    # options accepted without any effect, as they always were (-K: the certificate location is --certLocation)
+    ignoredOptions = ("-K",)
+
+    # the parameters resolved from the JSON file, saved in its compiled version
+    compiledParams = (
+        "site",
+        "gridCEType",
+        "ceType",
+        "setup",
+        "commands",
+        "commandExtensions",
+        "configServer",
+        "preferredURLPatterns",
+        "releaseVersion",
+        "releaseProject",
+        "CVMFS_locations",
+        "pilotLogging",
+        "loggerURL",
+        "loggerFailoverURLs",
+        "loggerTimerInterval",
+        "loggerBufsize",
+        "loggerBufferBytes",
+        "loggerMaxLatency",
+        "loggerFlushPolicy",
+        "loggerQueueSize",
+        "loggerOverflowPolicy",
+        "loggerCompact",
+        "structuredLogging",
+        "warmUpCVMFS",
+        "warmUpManifest",
+        "warmUpBudget",
+        "warmUpTime",
+        "maxParallelCommands",
+        "logFlushPolicy",
+    )
+
     def __init__(self):
         """c'tor
 
@@ -860,9 +1620,15 @@ class PilotParams(object):
 
         self.optList = {}
         self.keepPythonPath = False
+        # structured (NDJSON) log records, locally (pilot.ndjson) and remotely
+        self.structuredLogging = False
         self.debugFlag = False
         self.local = False
-        self.pilotJSON = None
+        self._pilotJSON = None
+        # the options of the JSON file applying to this pilot (an OptionIndex)
+        self.jsonOptions = None
+        # compile mode (see writeCompiledConfig): the options resolved from the JSON file are written out
+        self.compileConfig = False
         self.commandExtensions = []
         self.commands = [
             "CheckWorkerNode",
@@ -920,11 +1686,38 @@ class PilotParams(object):
         self.architectureScript = "dirac-platform"
         self.certsLocation = "%s/etc/grid-security" % self.workingDir
         self.pilotCFGFile = "pilot.json"
+        # options for the local configuration file, written in one go by dirac-configure
+        self.cfgTransaction = ConfigTransaction(self)
+        # time and resources used by the commands
+        self.timing = TimingReport()
         self.pilotLogging = False
         self.loggerURL = None
         self.loggerTimerInterval = 0
         self.loggerBufsize = 1000
+        # buffer size in characters, longest time a record is buffered (0: no limit), and flush policy:
+        # "fixed" (batches of loggerBufsize lines) or "adaptive" (following the server response time)
+        self.loggerBufferBytes = 1048576
+        self.loggerMaxLatency = 0
+        self.loggerFlushPolicy = "fixed"
+        # buffers waiting to be sent, and what is dropped when there are too many (see BatchSender)
+        self.loggerQueueSize = 10
+        self.loggerOverflowPolicy = "dropDebug"
+        # compact (gzip, JSON) remote logging messages, for servers supporting them
+        self.loggerCompact = False
+        # tried in turn when the remote logger URL can't be reached
+        self.loggerFailoverURLs = []
+        # the buffer shared by all the remote loggers, see getRemoteLogPipeline
+        self.logPipeline = None
         self.pilotUUID = "unknown"
+        # commands declaring their dependencies can run concurrently (1: one after the other)
+        self.maxParallelCommands = 1
+        # when the local log file (pilot.out) is flushed: "line", "exit" or a number of seconds
+        self.logFlushPolicy = "line"
+        # CVMFS warm-up of the release (see CVMFSWarmUp): manifest, budget in MB and in seconds
+        self.warmUpCVMFS = False
+        self.warmUpManifest = ""
+        self.warmUpBudget = 512
+        self.warmUpTime = 600
         self.modules = ""
         self.userEnvVariables = ""
         self.pipInstallOptions = ""
@@ -938,97 +1731,40 @@ class PilotParams(object):
         self.jobCPUReq = 900  # HS06s, here just a random value
 
         # Set number of allocatable processors from MJF if available
-        try:
-            self.pilotProcessors = int(
-                urlopen(os.path.join(os.environ["JOBFEATURES"], "allocated_cpu")).read()
-            )
-        except Exception:
-            self.pilotProcessors = 1
-
-        # Pilot command options
-        self.cmdOpts = (
-            ("", "requiredTag=", "extra required tags for resource description"),
-            ("a:", "gridCEType=", "Grid CE Type (CREAM etc)"),
-            ("c", "cert", "Use server certificate instead of proxy"),
-            ("d", "debug", "Set debug flag"),
-            ("e:", "extraPackages=", "Extra packages to install (comma separated)"),
-            ("g:", "loggerURL=", "Remote Logger service URL"),
-            ("h", "help", "Show this help"),
-            ("k", "keepPP", "Do not clear PYTHONPATH on start"),
-            ("l:", "project=", "Project to install"),
-            ("n:", "name=", "Set <Site> as Site Name"),
-            ("o:", "option=", "Option=value to add"),
-            (
-                "m:",
-                "maxNumberOfProcessors=",
-                "specify a max number of processors to use by the payload inside a pilot",
-            ),
-            ("", "modules=", "for installing non-released code"),
-            (
-                "",
-                "userEnvVariables=",
-                'User-requested environment variables (comma-separated, name and value separated by ":::")',
-            ),
-            ("", "pipInstallOptions=", "Options to pip install"),
-            ("r:", "release=", "DIRAC release to install"),
-            ("s:", "section=", "Set base section for relative parsed options"),
-            ("t:", "tag=", "extra tags for resource description"),
-            ("u:", "url=", "Use <url> to download tarballs"),
-            ("x:", "execute=", "Execute instead of JobAgent"),
-            ("y:", "CEType=", "CE Type (normally InProcess)"),
-            ("z", "pilotLogging", "Activate pilot logging system"),
-            ("C:", "configurationServer=", "Configuration servers to use"),
-            ("D:", "disk=", "Require at least <space> MB available"),
-            ("E:", "commandExtensions=", "Python modules with extra commands"),
-            ("F:", "pilotCFGFile=", "Specify pilot CFG file"),
-            ("G:", "Group=", "DIRAC Group to use"),
-            ("K:", "certLocation=", "Specify server certificate location"),
-            ("M:", "MaxCycles=", "Maximum Number of JobAgent cycles to run"),
-            ("", "PollingTime=", "JobAgent execution frequency"),
-            (
-                "",
-                "StopOnApplicationFailure=",
-                "Stop Job Agent when encounter an application failure",
-            ),
-            ("", "StopAfterFailedMatches=", "Stop Job Agent after N failed matches"),
-            ("N:", "Name=", "CE Name"),
-            ("O:", "OwnerDN=", "Pilot OwnerDN (for private pilots)"),
-            ("", "wnVO=", "Bind the resource (WN) to a VO"),
-            ("P:", "pilotProcessors=", "Number of processors allocated to this pilot"),
-            ("Q:", "Queue=", "Queue name"),
-            ("R:", "reference=", "Use this pilot reference"),
-            ("S:", "setup=", "DIRAC Setup to use"),
-            ("T:", "CPUTime=", "Requested CPU Time"),
-            (
-                "W:",
-                "gateway=",
-                "Configure <gateway> as DIRAC Gateway during installation",
-            ),
-            ("X:", "commands=", "Pilot commands to execute"),
-            ("Z:", "commandOptions=", "Options parsed by command modules"),
-            ("", "pilotUUID=", "pilot UUID"),
-            ("", "preinstalledEnv=", "preinstalled pilot environment script location"),
-            (
-                "",
-                "preinstalledEnvPrefix=",
-                "preinstalled pilot environment area prefix",
-            ),
-            ("", "architectureScript=", "architecture script to use"),
-            ("", "CVMFS_locations=", "comma-separated list of CVMS locations"),
-        )
-
-        # Possibly get Setup and JSON URL/filename from command line
-        self.__initCommandLine1()
+        self.pilotProcessors = MachineJobFeatures.get().processors or 1
+
+        # The command line is parsed once. Possibly get Setup and JSON URL/filename from it
+        self.optList = self.__parseCommandLine()
+        self.__applyOptions(1)
+        self._cmdLineKey = {
+            "ceName": self.ceName,
+            "queueName": self.queueName,
+            "gridCEType": self.gridCEType,
+            "setup": self.setup,
+        }
 
-        # Get main options from the JSON file. Load JSON first to determine the format used.
-        self.__loadJSON()
-        if "Setups" in self.pilotJSON:
-            self.__initJSON()
-        else:
-            self.__initJSON2()
+        # Get main options from the JSON file, or from its compiled version for this pilot if it is current.
+        # Load JSON first to determine the format used.
+        if self.compileConfig or not self.__loadCompiledConfig():
+            self.__loadJSON()
+            if "Setups" in self.pilotJSON:
+                self.__initJSON()
+            else:
+                self.__initJSON2()
+        if self.compileConfig:
+            # a tool, not a pilot: see dirac-pilot.py
+            return
 
         # Command line can override options from JSON
-        self.__initCommandLine2()
+        self.__applyOptions(2)
+
+        # all the CVMFS locations, and what is looked for in them, probed at once
+        self.locationMap = CVMFSLocationMap(self.CVMFS_locations)
+        self.locationMap.discover(
+            dirs=[os.path.join("etc/grid-security", dirName) for dirName in ("certificates", "vomsdir", "vomses")],
+            files=[self.preinstalledEnvSubPath],
+        )
+        self.log.debug("CVMFS locations, fastest first: %s" % self.locationMap.healthy)
 
         self.__checkSecurityDir("X509_CERT_DIR", "certificates")
         self.__checkSecurityDir("X509_VOMS_DIR", "vomsdir")
@@ -1071,18 +1807,14 @@ class PilotParams(object):
             dirName (str): The target folder
         """
 
-        # Else, try to find it
-        for candidate in self.CVMFS_locations:
-            candidateDir = os.path.join(candidate, "etc/grid-security", dirName)
-            self.log.debug("Candidate directory for %s is %s" % (envName, candidateDir))
-
-            # Checks if the directory exists *and* isn't empty
-            if safe_listdir(candidateDir):
-                self.log.debug("Setting %s=%s" % (envName, candidateDir))
-                # Set the environment variables to the candidate
-                self.__setSecurityDir(envName, candidateDir)
-                break
-            self.log.debug("%s not found or not a directory" % candidateDir)
+        # Else, try to find it: in the fastest CVMFS location where the directory exists *and* isn't empty
+        candidateDir = self.locationMap.find(os.path.join("etc/grid-security", dirName))
+        if candidateDir:
+            self.log.debug("Setting %s=%s" % (envName, candidateDir))
+            # Set the environment variables to the candidate
+            self.__setSecurityDir(envName, candidateDir)
+        else:
+            self.log.debug("etc/grid-security/%s not found in the CVMFS locations" % dirName)
 
             # Check first if the environment variable is set
             # If so, just return
@@ -1096,135 +1828,76 @@ class PilotParams(object):
             self.log.error("Could not find/set %s" % envName)
             sys.exit(1)
 
-    def __initCommandLine1(self):
-        """Parses and interpret options on the command line: first pass (essential things)"""
+    @property
+    def cmdOpts(self):
+        """The command line options, as (short, long, description)"""
+        return tuple(option[:3] for option in self.options)
 
-        self.optList, __args__ = getopt.getopt(
-            sys.argv[1:],
-            "".join([opt[0] for opt in self.cmdOpts]),
-            [opt[1] for opt in self.cmdOpts],
-        )
-        self.log.debug("Options list: %s" % self.optList)
-        for o, v in self.optList:
-            if o == "-N" or o == "--Name":
-                self.ceName = v
-            if o == "-Q" or o == "--Queue":
-                self.queueName = v
-            elif o == "-a" or o == "--gridCEType":
-                self.gridCEType = v
-            elif o == "-d" or o == "--debug":
-                self.debugFlag = True
-            elif o in ("-S", "--setup"):
-                self.setup = v
-            elif o == "-F" or o == "--pilotCFGFile":
-                self.pilotCFGFile = v
-            elif o == "--wnVO":
-                self.wnVO = v
-
-    def __initCommandLine2(self):
-        """
-        Parses and interpret options on the command line: second pass
-        (overriding discovered parameters, for tests/debug)
+    @classmethod
+    def registerOption(cls, shortOpt, longOpt, description, attribute, converter=optionString, phase=2):
         """
+        Add a command line option, e.g. for a command extension. The command line is parsed only once,
+        when the PilotParams are created: options must be registered before (e.g. when the module is imported).
+
+        :param str shortOpt: short option, like "a:" (with a value) or "a" (a flag), or ""
+        :param str longOpt: long option, like "name=" (with a value) or "name" (a flag)
+        :param str description: description of the option
+        :param str attribute: PilotParams attribute set by the option
+        :param converter: function(value, current attribute value) returning the new attribute value
+        :param int phase: 1 (before reading the JSON file) or 2 (overriding it)
+        :raises ValueError: if the option is already defined
+        """
+        for option in cls.options:
+            sameShort = shortOpt and option[0].rstrip(":") == shortOpt.rstrip(":")
+            if sameShort or option[1].rstrip("=") == longOpt.rstrip("="):
+                raise ValueError("Option already defined: %s" % longOpt)
+        cls.options.append((shortOpt, longOpt, description, attribute, converter, phase))
+
+    def __parseCommandLine(self):
+        """Parses the command line, with all the options of the table
 
-        self.optList, __args__ = getopt.getopt(
+        :return: the (option, value) pairs, as returned by getopt
+        :rtype: list
+        """
+        optList, __args__ = getopt.getopt(
             sys.argv[1:],
-            "".join([opt[0] for opt in self.cmdOpts]),
-            [opt[1] for opt in self.cmdOpts],
+            "".join([option[0] for option in self.options]),
+            [option[1] for option in self.options],
         )
+        self.log.debug("Options list: %s" % optList)
+        return optList
+
+    def __applyOptions(self, phase):
+        """
+        Interpret the options on the command line, for a phase: 1 (essential things) or 2
+        (overriding discovered parameters, for tests/debug)
+        """
+        # the attribute set by each flag, and how
+        targets = {}
+        for shortOpt, longOpt, _description, attribute, converter, optionPhase in self.options:
+            if attribute and optionPhase == phase:
+                if shortOpt:
+                    targets["-" + shortOpt.rstrip(":")] = (attribute, converter)
+                targets["--" + longOpt.rstrip("=")] = (attribute, converter)
         for o, v in self.optList:
-            if o == "-E" or o == "--commandExtensions":
-                self.commandExtensions = v.split(",")
-            elif o == "-X" or o == "--commands":
-                self.commands = v.split(",")
-            elif o == "-Z" or o == "--commandOptions":
-                for i in v.split(","):
-                    self.commandOptions[i.split("=", 1)[0].strip()] = i.split("=", 1)[
-                        1
-                    ].strip()
-            elif o == "-e" or o == "--extraPackages":
-                self.extensions = v.split(",")
-            elif o == "-n" or o == "--name":
-                self.site = v
-            elif o == "-y" or o == "--CEType":
-                self.ceType = v
-            elif o == "-k" or o == "--keepPP":
-                self.keepPythonPath = True
-            elif o in ("-C", "--configurationServer"):
-                self.configServer = v
-            elif o in ("-G", "--Group"):
-                self.userGroup = v
-            elif o in ("-x", "--execute"):
-                self.executeCmd = v
-            elif o in ("-O", "--OwnerDN"):
-                self.userDN = v
-            elif o == "-m" or o == "--maxNumberOfProcessors":
-                self.maxNumberOfProcessors = int(v)
-            elif o == "-D" or o == "--disk":
-                try:
-                    self.minDiskSpace = int(v)
-                except ValueError:
-                    pass
-            elif o == "-r" or o == "--release":
-                self.releaseVersion = v.split(",", 1)[0]
-            elif o in ("-l", "--project"):
-                self.releaseProject = v
-            elif o in ("-W", "--gateway"):
-                self.gateway = v
-            elif o == "-c" or o == "--cert":
-                self.useServerCertificate = True
-            elif o == "-C" or o == "--certLocation":
-                self.certsLocation = v
-            elif o == "-M" or o == "--MaxCycles":
-                try:
-                    self.maxCycles = int(v)
-                except ValueError:
-                    pass
-            elif o == "--PollingTime":
-                try:
-                    self.pollingTime = int(v)
-                except ValueError:
-                    pass
-            elif o == "--StopOnApplicationFailure":
-                self.stopOnApplicationFailure = v
-            elif o == "--StopAfterFailedMatches":
-                try:
-                    self.stopAfterFailedMatches = int(v)
-                except ValueError:
-                    pass
-            elif o in ("-T", "--CPUTime"):
-                self.jobCPUReq = v
-            elif o == "-P" or o == "--pilotProcessors":
-                try:
-                    self.pilotProcessors = int(v)
-                except BaseException:
-                    pass
-            elif o == "-z" or o == "--pilotLogging":
-                self.pilotLogging = True
-            elif o == "-g" or o == "--loggerURL":
-                self.loggerURL = v
-            elif o == "--pilotUUID":
-                self.pilotUUID = v
-            elif o in ("-o", "--option"):
-                self.genericOption = v
-            elif o in ("-t", "--tag"):
-                self.tags.append(v)
-            elif o == "--requiredTag":
-                self.reqtags.append(v)
-            elif o == "--modules":
-                self.modules = v
-            elif o == "--userEnvVariables":
-                self.userEnvVariables = v
-            elif o == "--pipInstallOptions":
-                self.pipInstallOptions = v
-            elif o == "--preinstalledEnv":
-                self.preinstalledEnv = v
-            elif o == "--preinstalledEnvPrefix":
-                self.preinstalledEnvPrefix = v
-            elif o == "--architectureScript":
-                self.architectureScript = v
-            elif o == "--CVMFS_locations":
-                self.CVMFS_locations = v.split(",")
+            if o not in targets or o in self.ignoredOptions:
+                continue
+            attribute, converter = targets[o]
+            setattr(self, attribute, converter(v, getattr(self, attribute, None)))
+
+    @property
+    def pilotJSON(self):
+        """The content of the JSON file: with a compiled configuration, it is only loaded if a command needs it.
+        It is a read-only mapping (a LazyJSONObject), whose sections are shared by all the commands:
+        use pilotJSON.copy() for a plain dict that can be modified.
+        """
+        if self._pilotJSON is None:
+            self.__loadJSON()
+        return self._pilotJSON
+
+    @pilotJSON.setter
+    def pilotJSON(self, value):
+        self._pilotJSON = value
 
     def __loadJSON(self):
         """
@@ -1234,10 +1907,89 @@ class PilotParams(object):
         """
 
         self.log.debug("JSON file loaded: %s" % self.pilotCFGFile)
-        with open(self.pilotCFGFile, "r") as fp:
-            # We save the parsed JSON in case pilot commands need it
-            # to read their own options
-            self.pilotJSON = json.load(fp)
+        # We save the parsed JSON in case pilot commands need it
+        # to read their own options: a large file is only decoded as needed
+        self.pilotJSON = LazyJSONObject.load(self.pilotCFGFile)
+
+    @property
+    def compiledConfigFile(self):
+        """The compiled configuration of the JSON file, for a CE, queue, VO and setup"""
+        return self.pilotCFGFile + ".compiled"
+
+    def readJSONTimestamp(self):
+        """The timestamp of the JSON file (its first field), without parsing the whole file
+
+        :return: the timestamp, or None if it is not found
+        :rtype: str
+        """
+        with open(self.pilotCFGFile, "rb") as fp:
+            match = re.search(rb'"timestamp"\s*:\s*"([^"]*)"', fp.read(4096))
+        return match.group(1).decode() if match else None
+
+    def __compiledConfigKey(self, legacy):
+        """What the compiled configuration depends on, besides the JSON file timestamp"""
+        # as given on the command line
+        key = dict(self._cmdLineKey)
+        # only the VO-based schema depends on the VO
+        key["vo"] = None if legacy else self.__getVO()
+        return key
+
+    def writeCompiledConfig(self):
+        """
+        Write the compiled configuration of the JSON file for this pilot (CE, queue, VO and setup): the parameters
+        resolved from it, and its options. The pilots use it instead of the JSON file while its timestamp is unchanged.
+
+        :return: the compiled configuration file
+        :rtype: str
+        """
+        legacy = "Setups" in self.pilotJSON
+        compiled = {
+            "timestamp": self.pilotJSON.get("timestamp"),
+            "legacy": legacy,
+            "key": self.__compiledConfigKey(legacy),
+            "params": {name: getattr(self, name) for name in self.compiledParams},
+            "options": self.jsonOptions.flatten(),
+        }
+        if compiled["timestamp"] is None:
+            self.log.warn("No timestamp in %s: the compiled configuration can't be used" % self.pilotCFGFile)
+        with open(self.compiledConfigFile + ".tmp", "w") as fp:
+            json.dump(compiled, fp)
+        os.rename(self.compiledConfigFile + ".tmp", self.compiledConfigFile)
+        self.log.info("Compiled configuration written to %s" % self.compiledConfigFile)
+        return self.compiledConfigFile
+
+    def __loadCompiledConfig(self):
+        """
+        Set the parameters from the compiled configuration of the JSON file, if there is one for this pilot,
+        compiled from the current JSON file.
+
+        :return: True if the compiled configuration was used
+        :rtype: bool
+        """
+        try:
+            with open(self.compiledConfigFile, "r") as fp:
+                compiled = json.load(fp)
+        except (IOError, ValueError):
+            return False
+        try:
+            timestamp = self.readJSONTimestamp()
+        except IOError:
+            timestamp = None
+        current = (
+            timestamp is not None
+            and compiled.get("timestamp") == timestamp
+            and compiled.get("key") == self.__compiledConfigKey(compiled.get("legacy"))
+        )
+        if not current:
+            self.log.debug("Compiled configuration %s not current, ignored" % self.compiledConfigFile)
+            return False
+        for name, value in compiled["params"].items():
+            setattr(self, name, value)
+        self.jsonOptions = OptionIndex.fromFlat(compiled["options"])
+        if str(self.jsonOptions.get("PilotLogLevel", "INFO")).lower() == "debug":
+            self.debugFlag = True
+        self.log.debug("Using the compiled configuration %s (%s)" % (self.compiledConfigFile, timestamp))
+        return True
 
     def __initJSON2(self):
         """
@@ -1252,13 +2004,17 @@ class PilotParams(object):
         # Commands first. In the new format they can be either in Defaults/Pilot
         # section or in a VO section (voname/self.setup/Pilot). They are published as a list in a dict
         # keyed by a CE type.
-        pilotOptions = self.getPilotOptionsDict()
-        self.log.debug("PilotOptionsDict %s " % pilotOptions)
+        pilotOptions = self.jsonOptions = OptionIndex(self.pilotJSON, self.__getSearchPaths())
+        self.log.debug("PilotOptionsDict %s " % pilotOptions.asDict())
         # remote logging (the default value is self.pilotLogging, a bool)
         pilotLogging = pilotOptions.get("RemoteLogging")
         if pilotLogging is not None:
             self.pilotLogging = pilotLogging.upper() == "TRUE"
         self.loggerURL = pilotOptions.get("RemoteLoggerURL")
+        failoverURLs = pilotOptions.get("RemoteLoggerFailoverURLs", self.loggerFailoverURLs)
+        if not isinstance(failoverURLs, list):
+            failoverURLs = failoverURLs.split(",")
+        self.loggerFailoverURLs = [url.strip() for url in failoverURLs if url.strip()]
         # logger buffer flush interval in seconds.
         self.loggerTimerInterval = int(
             pilotOptions.get("RemoteLoggerTimerInterval", self.loggerTimerInterval)
@@ -1267,6 +2023,35 @@ class PilotParams(object):
         self.loggerBufsize = max(
             1, int(pilotOptions.get("RemoteLoggerBufsize", self.loggerBufsize))
         )
+        structuredLogging = pilotOptions.get("StructuredLogging")
+        if structuredLogging is not None:
+            self.structuredLogging = self.structuredLogging or str(structuredLogging).upper() == "TRUE"
+        warmUpCVMFS = pilotOptions.get("WarmUpCVMFS")
+        if warmUpCVMFS is not None:
+            self.warmUpCVMFS = self.warmUpCVMFS or str(warmUpCVMFS).upper() == "TRUE"
+        self.warmUpManifest = pilotOptions.get("WarmUpManifest", self.warmUpManifest)
+        self.warmUpBudget = int(pilotOptions.get("WarmUpBudget", self.warmUpBudget))
+        self.warmUpTime = float(pilotOptions.get("WarmUpTime", self.warmUpTime))
+        loggerCompact = pilotOptions.get("RemoteLoggerCompact")
+        if loggerCompact is not None:
+            self.loggerCompact = str(loggerCompact).upper() == "TRUE"
+        # logger buffer size in characters, maximum latency in seconds, and flush policy
+        self.loggerBufferBytes = max(1, int(pilotOptions.get("RemoteLoggerBufferBytes", self.loggerBufferBytes)))
+        self.loggerMaxLatency = float(pilotOptions.get("RemoteLoggerMaxLatency", self.loggerMaxLatency))
+        flushPolicy = pilotOptions.get("RemoteLoggerFlushPolicy", self.loggerFlushPolicy)
+        if flushPolicy in ("fixed", "adaptive"):
+            self.loggerFlushPolicy = flushPolicy
+        else:
+            self.log.error("Invalid RemoteLoggerFlushPolicy %s, using %s" % (flushPolicy, self.loggerFlushPolicy))
+        # logger queue size in buffers, and overflow policy
+        self.loggerQueueSize = max(1, int(pilotOptions.get("RemoteLoggerQueueSize", self.loggerQueueSize)))
+        overflowPolicy = pilotOptions.get("RemoteLoggerOverflowPolicy", self.loggerOverflowPolicy)
+        if overflowPolicy in BatchSender.overflowPolicies:
+            self.loggerOverflowPolicy = overflowPolicy
+        else:
+            self.log.error(
+                "Invalid RemoteLoggerOverflowPolicy %s, using %s" % (overflowPolicy, self.loggerOverflowPolicy)
+            )
         # logger CE white list
         loggerCEsWhiteList = pilotOptions.get("RemoteLoggerCEsWhiteList")
         # restrict remote logging to whitelisted CEs ([] or None => no restriction)
@@ -1281,11 +2066,14 @@ class PilotParams(object):
                 self.log.debug(
                     "JSON: Remote logging disabled for this CE: %s" % self.ceName
                 )
+        self.maxParallelCommands = int(pilotOptions.get("MaxParallelCommands", self.maxParallelCommands))
+        self.logFlushPolicy = pilotOptions.get("LogFlushPolicy", self.logFlushPolicy)
         pilotLogLevel = pilotOptions.get("PilotLogLevel", "INFO")
         if pilotLogLevel.lower() == "debug":
             self.debugFlag = True
         self.log.debug("JSON: Remote logging: %s" % self.pilotLogging)
         self.log.debug("JSON: Remote logging URL: %s" % self.loggerURL)
+        self.log.debug("JSON: Remote logging failover URLs: %s" % self.loggerFailoverURLs)
         self.log.debug(
             "JSON: Remote logging buffer flush interval in sec.(0: disabled): %s"
             % self.loggerTimerInterval
@@ -1294,21 +2082,31 @@ class PilotParams(object):
         self.log.debug(
             "JSON: Remote logging buffer size (lines): %s" % self.loggerBufsize
         )
+        self.log.debug(
+            "JSON: Remote logging queue size (buffers): %s, overflow policy: %s"
+            % (self.loggerQueueSize, self.loggerOverflowPolicy)
+        )
+        self.log.debug("JSON: Remote logging compact messages: %s" % self.loggerCompact)
+        self.log.debug("JSON: Structured logging: %s" % self.structuredLogging)
+        self.log.debug(
+            "JSON: CVMFS warm-up: %s, manifest: %s, budget: %s MB, %s s"
+            % (self.warmUpCVMFS, self.warmUpManifest, self.warmUpBudget, self.warmUpTime)
+        )
+        self.log.debug(
+            "JSON: Remote logging buffer size (characters): %s, maximum latency (s, 0: none): %s, flush policy: %s"
+            % (self.loggerBufferBytes, self.loggerMaxLatency, self.loggerFlushPolicy)
+        )
 
         # CE type if present, then Defaults, otherwise as defined in the code:
-        if "Commands" in pilotOptions:
-            for key in [self.gridCEType, "Defaults"]:
-                commands = pilotOptions["Commands"].get(key)
-                if commands is not None:
-                    if isinstance(commands, list):
-                        self.commands = commands
-                    else:
-                        # TODO: This is a workaround until the pilot JSON syncroniser is fixed
-                        self.commands = [elem.strip() for elem in commands.split(",")]
-                    self.log.debug(
-                        "Selecting commands from JSON for Grid CE type %s" % key
-                    )
-                    break
+        key, commands = pilotOptions.lookup(["Commands/%s" % self.gridCEType, "Commands/Defaults"])
+        if commands is not None:
+            if isinstance(commands, list):
+                self.commands = commands
+            else:
+                # TODO: This is a workaround until the pilot JSON syncroniser is fixed
+                self.commands = [elem.strip() for elem in commands.split(",")]
+            key = key.split("/", 1)[1]
+            self.log.debug("Selecting commands from JSON for Grid CE type %s" % key)
         else:
             key = "CodeDefaults"
 
@@ -1353,6 +2151,11 @@ class PilotParams(object):
             )
         self.log.debug("CVMFS locations: %s" % self.CVMFS_locations)
 
+    @property
+    def preinstalledEnvSubPath(self):
+        """Where the preinstalled environment script of the release is, in a CVMFS location"""
+        return os.path.join(self.releaseProject.lower() + "dirac", self.releaseVersion or "pro", _arch, "diracosrc")
+
     def getPilotOptionsDict(self):
         """
         Get pilot option dictionary by searching paths in a certain order (commands, logging etc.).
@@ -1361,7 +2164,7 @@ class PilotParams(object):
         :rtype: dict
         """
 
-        return self.getOptionForPaths(self.__getSearchPaths(), self.pilotJSON)
+        return OptionIndex(self.pilotJSON, self.__getSearchPaths()).asDict()
 
     def __getVO(self):
         """
@@ -1385,8 +2188,12 @@ class PilotParams(object):
         cert = os.getenv("X509_USER_PROXY")
         if cert:
             try:
-                with open(cert, "rb") as fp:
-                    return getVO(fp.read())
+                credentials = PilotCredentials.get(cert)
+                self.log.debug("Credentials of %s, %s seconds left" % (credentials.identity, credentials.timeLeft))
+                if credentials.vo:
+                    return credentials.vo
+                if not credentials.isHost:
+                    self.log.error("No VOMS extension in the proxy, setting vo to 'unknown'")
             except IOError as err:
                 self.log.error(
                     "Could not read a proxy, setting vo to 'unknown': %s"
@@ -1421,7 +2228,7 @@ class PilotParams(object):
     @staticmethod
     def getOptionForPaths(paths, inDict):
         """
-        Get the preferred option from an input dict passed and a path list. It modifies the inDict.
+        Get the preferred option from an input dict passed and a path list (see OptionIndex).
 
         :param list paths: list of paths to walk through to get a preferred option. An option found in
         a path which comes later has a preference over options found in earlier paths.
@@ -1429,13 +2236,7 @@ class PilotParams(object):
         :return: dict
         """
 
-        outDict = {}
-        for path in paths:
-            target = inDict
-            for elem in path.strip("/").split("/"):
-                target = target.setdefault(elem, {})
-            outDict.update(target)
-        return outDict
+        return OptionIndex(inDict, paths).asDict()
 
     def __initJSON(self):
         """Retrieve pilot parameters from the content of json file. The file should be something like:
@@ -1484,222 +2285,41 @@ class PilotParams(object):
         The file must contain at least the Defaults section. Missing values are taken from the Defaults setup."""
 
         self.__ceType()
+        # the options of the setup, and else of the Defaults setup
+        sections = ["/Defaults", "/Setups/Defaults", "/Setups/%s" % self.setup]
+        options = self.jsonOptions = OptionIndex(self.pilotJSON, sections)
 
         # Commands first
         # FIXME: pilotSynchronizer() should publish these as comma-separated lists. We are ready for that.
-        try:
-            if isinstance(
-                self.pilotJSON["Setups"][self.setup]["Commands"][self.gridCEType], str
-            ):
-                self.commands = [
-                    str(pv).strip()
-                    for pv in self.pilotJSON["Setups"][self.setup]["Commands"][
-                        self.gridCEType
-                    ].split(",")
-                ]
-            else:
-                self.commands = [
-                    str(pv).strip()
-                    for pv in self.pilotJSON["Setups"][self.setup]["Commands"][
-                        self.gridCEType
-                    ]
-                ]
-        except KeyError:
-            try:
-                if isinstance(
-                    self.pilotJSON["Setups"][self.setup]["Commands"]["Defaults"], str
-                ):
-                    self.commands = [
-                        str(pv).strip()
-                        for pv in self.pilotJSON["Setups"][self.setup]["Commands"][
-                            "Defaults"
-                        ].split(",")
-                    ]
-                else:
-                    self.commands = [
-                        str(pv).strip()
-                        for pv in self.pilotJSON["Setups"][self.setup]["Commands"][
-                            "Defaults"
-                        ]
-                    ]
-            except KeyError:
-                try:
-                    if isinstance(
-                        self.pilotJSON["Setups"]["Defaults"]["Commands"][
-                            self.gridCEType
-                        ],
-                        str,
-                    ):
-                        self.commands = [
-                            str(pv).strip()
-                            for pv in self.pilotJSON["Setups"]["Defaults"]["Commands"][
-                                self.gridCEType
-                            ].split(",")
-                        ]
-                    else:
-                        self.commands = [
-                            str(pv).strip()
-                            for pv in self.pilotJSON["Setups"]["Defaults"]["Commands"][
-                                self.gridCEType
-                            ]
-                        ]
-                except KeyError:
-                    try:
-                        if isinstance(
-                            self.pilotJSON["Defaults"]["Commands"]["Defaults"], str
-                        ):
-                            self.commands = [
-                                str(pv).strip()
-                                for pv in self.pilotJSON["Defaults"]["Commands"][
-                                    "Defaults"
-                                ].split(",")
-                            ]
-                        else:
-                            self.commands = [
-                                str(pv).strip()
-                                for pv in self.pilotJSON["Defaults"]["Commands"][
-                                    "Defaults"
-                                ]
-                            ]
-                    except KeyError:
-                        pass
+        self.commands = options.getList(["Commands/%s" % self.gridCEType, "Commands/Defaults"], self.commands)
         self.log.debug("Commands: %s" % self.commands)
 
         # CommandExtensions
         # pilotSynchronizer() can publish this as a comma separated list. We are ready for that.
-        try:
-            if isinstance(
-                self.pilotJSON["Setups"][self.setup]["CommandExtensions"], str
-            ):  # In the specific setup?
-                self.commandExtensions = [
-                    str(pv).strip()
-                    for pv in self.pilotJSON["Setups"][self.setup][
-                        "CommandExtensions"
-                    ].split(",")
-                ]
-            else:
-                self.commandExtensions = [
-                    str(pv).strip()
-                    for pv in self.pilotJSON["Setups"][self.setup]["CommandExtensions"]
-                ]
-        except KeyError:
-            try:
-                if isinstance(
-                    self.pilotJSON["Setups"]["Defaults"]["CommandExtensions"], str
-                ):  # Or in the defaults section?
-                    self.commandExtensions = [
-                        str(pv).strip()
-                        for pv in self.pilotJSON["Setups"]["Defaults"][
-                            "CommandExtensions"
-                        ].split(",")
-                    ]
-                else:
-                    self.commandExtensions = [
-                        str(pv).strip()
-                        for pv in self.pilotJSON["Setups"]["Defaults"][
-                            "CommandExtensions"
-                        ]
-                    ]
-            except KeyError:
-                pass
+        self.commandExtensions = options.getList("CommandExtensions", self.commandExtensions)
         self.log.debug("Commands extesions: %s" % self.commandExtensions)
 
         # CS URL(s)
         # pilotSynchronizer() can publish this as a comma separated list. We are ready for that
-        try:
-            if isinstance(
-                self.pilotJSON["ConfigurationServers"], str
-            ):  # Generic, there may also be setup-specific ones
-                self.configServer = ",".join(
-                    [
-                        str(pv).strip()
-                        for pv in self.pilotJSON["ConfigurationServers"].split(",")
-                    ]
-                )
-            else:  # it's a list, we suppose
-                self.configServer = ",".join(
-                    [str(pv).strip() for pv in self.pilotJSON["ConfigurationServers"]]
-                )
-        except KeyError:
-            pass
-        try:  # now trying to see if there is setup-specific ones
-            if isinstance(
-                self.pilotJSON["Setups"][self.setup]["ConfigurationServer"], str
-            ):  # In the specific setup?
-                self.configServer = ",".join(
-                    [
-                        str(pv).strip()
-                        for pv in self.pilotJSON["Setups"][self.setup][
-                            "ConfigurationServer"
-                        ].split(",")
-                    ]
-                )
-            else:  # it's a list, we suppose
-                self.configServer = ",".join(
-                    [
-                        str(pv).strip()
-                        for pv in self.pilotJSON["Setups"][self.setup][
-                            "ConfigurationServer"
-                        ]
-                    ]
-                )
-        except KeyError:  # and if it doesn't exist
-            try:
-                if isinstance(
-                    self.pilotJSON["Setups"]["Defaults"]["ConfigurationServer"], str
-                ):  # Is there one in the defaults section?
-                    self.configServer = ",".join(
-                        [
-                            str(pv).strip()
-                            for pv in self.pilotJSON["Setups"]["Defaults"][
-                                "ConfigurationServer"
-                            ].split(",")
-                        ]
-                    )
-                else:  # it's a list, we suppose
-                    self.configServer = ",".join(
-                        [
-                            str(pv).strip()
-                            for pv in self.pilotJSON["Setups"]["Defaults"][
-                                "ConfigurationServer"
-                            ]
-                        ]
-                    )
-            except KeyError:
-                pass
+        # Generic, there may also be setup-specific ones
+        configServers = options.getList("ConfigurationServer")
+        if configServers is None and "ConfigurationServers" in self.pilotJSON:
+            configServers = options.toList(self.pilotJSON["ConfigurationServers"])
+        if configServers is not None:
+            self.configServer = ",".join(configServers)
         self.log.debug("CS list: %s" % self.configServer)
 
         # Version
         # There may be a list of versions specified (in a string, comma separated). We just want the first one.
-        dVersion = None
-        try:
-            dVersion = [
-                dv.strip()
-                for dv in self.pilotJSON["Setups"][self.setup]["Version"].split(",", 1)
-            ]
-        except KeyError:
-            try:
-                dVersion = [
-                    dv.strip()
-                    for dv in self.pilotJSON["Setups"]["Defaults"]["Version"].split(
-                        ",", 1
-                    )
-                ]
-            except KeyError:
-                self.log.warn("Could not find a version in the JSON file configuration")
+        dVersion = options.get("Version")
         if dVersion is not None:
+            dVersion = [dv.strip() for dv in dVersion.split(",", 1)]
             self.releaseVersion = str(dVersion[0])
+        else:
+            self.log.warn("Could not find a version in the JSON file configuration")
         self.log.debug("Version: %s -> %s" % (dVersion, self.releaseVersion))
 
-        try:
-            self.releaseProject = str(self.pilotJSON["Setups"][self.setup]["Project"])
-        except KeyError:
-            try:
-                self.releaseProject = str(
-                    self.pilotJSON["Setups"]["Defaults"]["Project"]
-                )
-            except KeyError:
-                pass
+        self.releaseProject = str(options.get("Project", self.releaseProject))
         self.log.debug("Release project: %s" % self.releaseProject)
 
     def __ceType(self):
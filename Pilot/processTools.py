@@ -0,0 +1,442 @@
+"""Execution of the processes started by the pilot commands, and of their timing report"""
+
+import codecs
+import json
+import os
+import resource
+import selectors
+import signal
+import subprocess
+import sys
+import time
+from collections import deque
+from contextlib import contextmanager
+from threading import RLock
+
+from threadTools import synchronized
+
+
+def waitForProcess(process, block=True):
+    """Wait for a subprocess.Popen process to finish, and get its resource usage.
+
+    :param process: the subprocess.Popen object
+    :param bool block: if False, do not wait for a process that is still running
+    :return: (return code, resource.struct_rusage of the process and its waited-for children, or None).
+             The return code is None if the process is still running.
+    :rtype: tuple
+    """
+    try:
+        pid, status, rusage = os.wait4(process.pid, 0 if block else os.WNOHANG)
+    except ChildProcessError:
+        # not (or no longer) our child, e.g. already reaped
+        return (process.wait() if block else process.poll()), None
+    if not pid:
+        return None, None
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return process.returncode, rusage
+
+
+class TimingReport(object):
+    """
+    Wall-clock time, CPU time and peak memory of the pilot commands, and of the processes they execute.
+
+    The report is (re)written to a JSON file (by default pilot.timing.json) each time a command ends,
+    so it is available even if the pilot is killed later, e.g. while running the JobAgent.
+    Times are in seconds, memory (maximum resident set size) in kB; "start" is relative to the pilot start.
+    """
+
+    def __init__(self, fileName="pilot.timing.json", startTime=None):
+        """
+        c'tor
+
+        :param str fileName: the JSON report file (None: do not write it)
+        :param float startTime: the pilot start time (epoch), by default now
+        """
+        self._rlock = RLock()
+        self.fileName = fileName
+        self.startTime = startTime or time.time()
+        self.info = {}
+        self.commands = []
+        self._subprocesses = {}
+
+    @synchronized
+    def addSubprocess(self, commandName, cmd, wallTime, rusage, returnCode):
+        """
+        Record a process executed by a command.
+
+        :param str commandName: name of the command executing it
+        :param str cmd: the command line
+        :param float wallTime: wall-clock time
+        :param rusage: resource usage of the process (resource.struct_rusage or None if unknown)
+        :param int returnCode: its return code
+        """
+        record = {"cmd": cmd, "wallTime": round(wallTime, 3), "returnCode": returnCode}
+        if rusage is not None:
+            record.update(
+                {
+                    "userCPU": round(rusage.ru_utime, 3),
+                    "systemCPU": round(rusage.ru_stime, 3),
+                    "maxRSS": rusage.ru_maxrss,
+                }
+            )
+        self._subprocesses.setdefault(commandName, []).append(record)
+
+    @contextmanager
+    def measure(self, commandName):
+        """
+        Context manager measuring the execution of a command (in the current thread).
+
+        :param str commandName: the command name
+        """
+        start = time.time()
+        startUsage = resource.getrusage(resource.RUSAGE_THREAD)
+        try:
+            yield
+        finally:
+            usage = resource.getrusage(resource.RUSAGE_THREAD)
+            with self._rlock:
+                subprocesses = self._subprocesses.pop(commandName, [])
+                record = {
+                    "name": commandName,
+                    "start": round(start - self.startTime, 3),
+                    "wallTime": round(time.time() - start, 3),
+                    # this process, plus the processes executed by the command
+                    "userCPU": round(
+                        usage.ru_utime - startUsage.ru_utime + sum(sp.get("userCPU", 0) for sp in subprocesses), 3
+                    ),
+                    "systemCPU": round(
+                        usage.ru_stime - startUsage.ru_stime + sum(sp.get("systemCPU", 0) for sp in subprocesses), 3
+                    ),
+                    "maxRSS": max(
+                        [resource.getrusage(resource.RUSAGE_SELF).ru_maxrss]
+                        + [sp.get("maxRSS", 0) for sp in subprocesses]
+                    ),
+                    "subprocesses": subprocesses,
+                }
+                self.commands.append(record)
+            self.write()
+
+    @synchronized
+    def summary(self):
+        """
+        Short summary, e.g. for the remote logger.
+
+        :return: wall-clock time of each command, and the time elapsed since the pilot start
+        :rtype: dict
+        """
+        return {
+            "commands": [[record["name"], record["wallTime"]] for record in self.commands],
+            "elapsed": round(time.time() - self.startTime, 3),
+        }
+
+    @synchronized
+    def write(self):
+        """Write the report to its JSON file"""
+        if not self.fileName:
+            return
+        report = dict(self.info)
+        report.update({"pilotStartTime": self.startTime, "commands": self.commands})
+        try:
+            with open(self.fileName + ".tmp", "w") as fd:
+                json.dump(report, fd, indent=1)
+            os.rename(self.fileName + ".tmp", self.fileName)
+        except (IOError, OSError) as exc:
+            print("Could not write the timing report %s: %s" % (self.fileName, exc))
+
+
+class OutputCapture(object):
+    """Keep (part of) the standard output of a command, with a bounded memory footprint.
+
+    The policy is one of:
+
+    - "full": keep everything (the default of executeAndGetOutput)
+    - a positive integer N: keep only the last N lines (ring buffer)
+    - "lastLine": keep only the last non-blank line
+    - "none": keep nothing, the output is only echoed
+    """
+
+    # longest incomplete line kept, for commands writing e.g. progress bars without newlines
+    maxLineLength = 65536
+
+    def __init__(self, policy="full"):
+        """c'tor
+
+        :param policy: "full", "lastLine", "none" or the number of lines to keep
+        """
+        if policy in ("full", "none"):
+            maxLines = None
+        elif policy == "lastLine":
+            maxLines = 1
+        elif isinstance(policy, int) and not isinstance(policy, bool) and policy > 0:
+            maxLines = policy
+        else:
+            raise ValueError("Invalid output capture policy: %r" % (policy,))
+        self.policy = policy
+        self._chunks = []
+        self._lines = deque(maxlen=maxLines) if maxLines else None
+        self._partial = ""
+
+    def write(self, text):
+        """Add a chunk of (decoded) output
+
+        :param str text: the output chunk
+        """
+        if self.policy == "none" or not text:
+            return
+        if self._lines is None:
+            self._chunks.append(text)
+            return
+        lines = (self._partial + text).split("\n")
+        self._partial = lines.pop()[-self.maxLineLength :]
+        for line in lines:
+            if self.policy == "lastLine" and not line.strip():
+                continue
+            self._lines.append(line)
+
+    def getValue(self):
+        """Get what was kept of the output
+
+        :return: the output
+        :rtype: str
+        """
+        if self._lines is None:
+            return "".join(self._chunks)
+        lines = list(self._lines)
+        if self._partial and (self.policy != "lastLine" or self._partial.strip()):
+            lines.append(self._partial)
+        if self.policy == "lastLine":
+            lines = lines[-1:]
+        elif self._partial:
+            lines = lines[-self._lines.maxlen :]
+        return "\n".join(lines)
+
+
+class EchoSink(object):
+    """Output sink echoing the output of a command to the standard output and error of the pilot.
+
+    With a prefix (e.g. when several commands run at the same time), only complete lines are echoed,
+    each one with the prefix.
+    """
+
+    def __init__(self, prefix="", buffer=None):
+        """c'tor
+
+        :param str prefix: prefix of each line
+        :param buffer: buffer of the remote logger, where the standard output is also written
+        """
+        self.prefix = prefix
+        self.buffer = buffer
+        self._partial = {"stdout": "", "stderr": ""}
+
+    def write(self, streamName, text):
+        """Echo a chunk of output
+
+        :param str streamName: "stdout" or "stderr"
+        :param str text: the output chunk
+        """
+        stream = sys.stderr if streamName == "stderr" else sys.stdout
+        if self.prefix:
+            lines = (self._partial[streamName] + text).split("\n")
+            self._partial[streamName] = lines.pop()
+            text = "".join("%s%s\n" % (self.prefix, line) for line in lines)
+        if text:
+            stream.write(text)
+            stream.flush()
+        if self.buffer is not None and streamName == "stdout":
+            self.buffer.write(text)
+
+    def flush(self):
+        """End the output"""
+        for streamName in ["stdout", "stderr"]:
+            # Ensure output ends on a newline
+            if self.prefix and self._partial[streamName]:
+                self.write(streamName, "\n")
+            elif not self.prefix:
+                stream = sys.stderr if streamName == "stderr" else sys.stdout
+                stream.write("\n")
+                stream.flush()
+
+
+class ProcessExecution(object):
+    """A command executed by the ProcessEngine, and its outcome"""
+
+    def __init__(self, cmd, environDict=None, timeout=None, capture="full", sinks=None):
+        """c'tor
+
+        :param str cmd: the command (run through the shell)
+        :param dict environDict: the environment for the command
+        :param timeout: seconds after which the process group of the command is killed (None: no limit)
+        :param capture: the output capture policy, see OutputCapture
+        :param list sinks: objects with write(streamName, text) and flush() methods, getting all the output
+        """
+        self.cmd = cmd
+        self.environDict = environDict
+        self.timeout = timeout
+        self.output = OutputCapture(capture)
+        self.sinks = sinks or []
+        self.process = None
+        self.startTime = None
+        self.wallTime = None
+        self.returnCode = None
+        self.rusage = None
+        self.timedOut = False
+        self.killedAt = None
+
+    @property
+    def finished(self):
+        """True once the process has been reaped"""
+        return self.wallTime is not None
+
+
+class ProcessEngine(object):
+    """Execute commands as subprocesses, several at the same time, following their output with a selector.
+
+    The output of each process is decoded (UTF-8) and passed to its sinks and capture as it comes.
+    A process with a timeout runs in a new process group (session), which is killed as a whole when
+    the timeout expires: first with SIGTERM, then with SIGKILL after killGracePeriod seconds.
+    """
+
+    killGracePeriod = 5
+    # how often processes that closed their output, but did not exit yet, are checked
+    pollInterval = 0.1
+
+    def __init__(self, maxParallel=None):
+        """c'tor
+
+        :param int maxParallel: maximum number of processes running at the same time (None: no limit)
+        """
+        self.maxParallel = maxParallel
+        self.executions = []
+
+    def submit(self, cmd, environDict=None, timeout=None, capture="full", sinks=None):
+        """Add a command to execute (when run() is called)
+
+        :return: the execution, whose returnCode, output etc. are set once run() returns
+        :rtype: ProcessExecution
+        """
+        execution = ProcessExecution(cmd, environDict, timeout, capture, sinks)
+        self.executions.append(execution)
+        return execution
+
+    def _start(self, execution, selector):
+        """Start the process of an execution, and register its pipes"""
+        execution.startTime = time.time()
+        execution.process = subprocess.Popen(
+            execution.cmd,
+            shell=True,
+            env=execution.environDict,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            close_fds=False,
+            start_new_session=execution.timeout is not None,
+        )
+        for streamName, stream in [("stdout", execution.process.stdout), ("stderr", execution.process.stderr)]:
+            # multi-byte characters may be split across reads
+            decoder = codecs.getincrementaldecoder("utf-8")("replace")
+            selector.register(stream.fileno(), selectors.EVENT_READ, (execution, streamName, decoder))
+
+    @staticmethod
+    def _dispatch(execution, streamName, text):
+        """Pass a chunk of output to the sinks and capture of an execution"""
+        if not text:
+            return
+        for sink in execution.sinks:
+            sink.write(streamName, text)
+        if streamName == "stdout":
+            execution.output.write(text)
+
+    def _kill(self, execution, now):
+        """Kill the process group of an execution, gently first"""
+        if execution.killedAt is None:
+            execution.timedOut = True
+            execution.killedAt = now
+            sig = signal.SIGTERM
+        else:
+            sig = signal.SIGKILL
+        try:
+            os.killpg(execution.process.pid, sig)
+        except OSError:
+            pass
+
+    def run(self):
+        """Execute all the submitted commands, and wait for all of them to finish
+
+        :return: the executions, in submission order
+        :rtype: list
+        """
+        # poll(), unlike select(), works with any file descriptor number and any file type
+        selector = selectors.PollSelector() if hasattr(selectors, "PollSelector") else selectors.DefaultSelector()
+        pending = [execution for execution in self.executions if not execution.finished]
+        running = []
+        # fds registered by each running execution
+        streams = {}
+        try:
+            while pending or running:
+                while pending and (not self.maxParallel or len(running) < self.maxParallel):
+                    execution = pending.pop(0)
+                    self._start(execution, selector)
+                    running.append(execution)
+                    streams[id(execution)] = 2
+
+                now = time.time()
+                timeout = None
+                for execution in running:
+                    if streams[id(execution)] == 0:
+                        # output closed, waiting for the process to exit
+                        timeout = self.pollInterval
+                    if execution.timeout is not None:
+                        if execution.killedAt is None:
+                            deadline = execution.startTime + execution.timeout
+                        else:
+                            deadline = execution.killedAt + self.killGracePeriod
+                        if deadline <= now:
+                            self._kill(execution, now)
+                            deadline = now + self.killGracePeriod
+                        timeout = deadline - now if timeout is None else min(timeout, deadline - now)
+
+                for key, _events in selector.select(timeout):
+                    execution, streamName, decoder = key.data
+                    data = os.read(key.fd, 65536)
+                    self._dispatch(execution, streamName, decoder.decode(data, final=not data))
+                    if not data:
+                        # the pipe itself is closed with the Popen object
+                        selector.unregister(key.fd)
+                        streams[id(execution)] -= 1
+
+                for execution in list(running):
+                    if streams[id(execution)] == 0 or execution.killedAt is not None:
+                        if self._reap(execution, selector, streams):
+                            running.remove(execution)
+        finally:
+            selector.close()
+        return self.executions
+
+    def _reap(self, execution, selector, streams):
+        """Reap the process of an execution if it finished
+
+        :return: True if it did
+        """
+        returnCode, rusage = waitForProcess(execution.process, block=False)
+        if returnCode is None:
+            return False
+        # processes left in the group may still hold the pipes open: do not wait for them
+        if streams[id(execution)]:
+            for stream in [execution.process.stdout, execution.process.stderr]:
+                if stream.fileno() in selector.get_map():
+                    selector.unregister(stream.fileno())
+            streams[id(execution)] = 0
+        if execution.killedAt is not None:
+            # what is left of the process group
+            try:
+                os.killpg(execution.process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        execution.returnCode = returnCode
+        execution.rusage = rusage
+        execution.wallTime = time.time() - execution.startTime
+        for sink in execution.sinks:
+            sink.flush()
+        return True
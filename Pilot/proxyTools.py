@@ -1,13 +1,210 @@
 """few functions for dealing with proxies"""
 
+import calendar
 import re
-from base64 import b16decode
+import time
+from base64 import b16decode, b64decode
+from binascii import Error as BinasciiError
 from subprocess import PIPE, Popen
 
 VOMS_FQANS_OID = b"1.3.6.1.4.1.8005.100.100.4"
 VOMS_EXTENSION_OID = b"1.3.6.1.4.1.8005.100.100.5"
 
 RE_OPENSSL_ANS1_FORMAT = re.compile(br"^\s*\d+:d=(\d+)\s+hl=")
+# the line ends may be "\r\n" (files written on Windows)
+RE_PEM_CERTIFICATE = re.compile(
+    br"-----BEGIN CERTIFICATE-----\r?\n(.+?)\r?\n-----END CERTIFICATE-----", flags=re.DOTALL
+)
+RE_FQAN_VO = re.compile(br"^/([a-zA-Z0-9]+)/Role=")
+
+# DER tags
+DER_CONSTRUCTED = 0x20
+DER_OCTET_STRING = 0x04
+DER_OBJECT = 0x06
+
+
+def parseDER(data):
+    """Decode DER data, as "openssl asn1parse" does, without starting it
+
+    Args:
+        data (bytes): DER encoded data
+
+    Raises:
+        ValueError: The data is not valid DER
+
+    Returns:
+        list: The (depth, tag, value) of each element, in order. The value of a constructed
+              element is its content, already decoded in the elements following it.
+    """
+    elements = []
+    # the end offsets of the enclosing constructed elements
+    ends = [len(data)]
+    offset = 0
+    while offset < len(data):
+        while offset >= ends[-1]:
+            ends.pop()
+        if offset + 2 > ends[-1]:
+            raise ValueError("Truncated DER element at offset %d" % offset)
+        tag = data[offset]
+        if tag & 0x1F == 0x1F:
+            raise ValueError("Unsupported DER tag at offset %d" % offset)
+        length = data[offset + 1]
+        offset += 2
+        if length & 0x80:
+            nbytes = length & 0x7F
+            if nbytes == 0 or nbytes > 4:
+                raise ValueError("Unsupported DER length at offset %d" % offset)
+            length = int.from_bytes(data[offset : offset + nbytes], "big")
+            offset += nbytes
+        end = offset + length
+        if end > ends[-1]:
+            raise ValueError("Truncated DER element at offset %d" % offset)
+        elements.append((len(ends) - 1, tag, data[offset:end]))
+        if tag & DER_CONSTRUCTED:
+            ends.append(end)
+        else:
+            offset = end
+    return elements
+
+
+def encodeOID(oid):
+    """DER value of an object identifier
+
+    Args:
+        oid (bytes): The dotted object identifier, like VOMS_EXTENSION_OID
+
+    Returns:
+        bytes: The value of its OBJECT element
+    """
+    arcs = [int(arc) for arc in oid.split(b".")]
+    value = bytearray([40 * arcs[0] + arcs[1]])
+    for arc in arcs[2:]:
+        chunk = [arc & 0x7F]
+        arc >>= 7
+        while arc:
+            chunk.append(0x80 | (arc & 0x7F))
+            arc >>= 7
+        value.extend(reversed(chunk))
+    return bytes(value)
+
+
+def decodeOID(value):
+    """Dotted object identifier of the value of an OBJECT element (the reverse of encodeOID)"""
+    arcs = [min(value[0] // 40, 2), value[0] - 40 * min(value[0] // 40, 2)]
+    arc = 0
+    for byte in value[1:]:
+        arc = (arc << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            arcs.append(arc)
+            arc = 0
+    return ".".join(str(arc) for arc in arcs)
+
+
+VOMS_FQANS_DER = encodeOID(VOMS_FQANS_OID)
+VOMS_EXTENSION_DER = encodeOID(VOMS_EXTENSION_OID)
+
+# attribute names in the DNs
+DN_ATTRIBUTES = {
+    encodeOID(b"2.5.4.3"): "CN",
+    encodeOID(b"2.5.4.6"): "C",
+    encodeOID(b"2.5.4.7"): "L",
+    encodeOID(b"2.5.4.8"): "ST",
+    encodeOID(b"2.5.4.10"): "O",
+    encodeOID(b"2.5.4.11"): "OU",
+    encodeOID(b"0.9.2342.19200300.100.1.25"): "DC",
+    encodeOID(b"0.9.2342.19200300.100.1.1"): "UID",
+    encodeOID(b"1.2.840.113549.1.9.1"): "emailAddress",
+}
+DER_UTC_TIME = 0x17
+DER_GENERALIZED_TIME = 0x18
+
+
+def children(elements, index):
+    """Indices of the elements directly inside the (constructed) element at index"""
+    depth = elements[index][0]
+    indices = []
+    for i in range(index + 1, len(elements)):
+        if elements[i][0] <= depth:
+            break
+        if elements[i][0] == depth + 1:
+            indices.append(i)
+    return indices
+
+
+def decodeDN(elements, index):
+    """The DN ("/O=.../CN=...") of the Name element at index"""
+    dn = ""
+    for rdn in children(elements, index):
+        for attribute in children(elements, rdn):
+            oid, value = [elements[i][2] for i in children(elements, attribute)[:2]]
+            dn += "/%s=%s" % (DN_ATTRIBUTES.get(oid) or decodeOID(oid), value.decode("utf-8", "replace"))
+    return dn
+
+
+def decodeTime(tag, value):
+    """Seconds since the epoch of a UTCTime or GeneralizedTime value"""
+    value = value.decode("ascii").rstrip("Z")
+    if tag == DER_UTC_TIME:
+        # years 1950 to 2049
+        value = ("19" if int(value[:2]) >= 50 else "20") + value
+    return calendar.timegm(time.strptime(value[:14], "%Y%m%d%H%M%S"))
+
+
+def getCertificatesInfo(proxy_data):
+    """Subject, issuer and end of validity of the certificates of a chain, decoded without openssl
+
+    Args:
+        proxy_data (bytes): Bytes for the proxy chain (PEM)
+
+    Raises:
+        ValueError: A certificate can't be decoded
+
+    Returns:
+        list: A dict (subject, issuer, notAfter in seconds since the epoch) for each certificate, in order
+    """
+    certificates = []
+    for pem in RE_PEM_CERTIFICATE.findall(proxy_data):
+        try:
+            elements = parseDER(b64decode(pem))
+            fields = children(elements, 1)
+            # skip the version, if present
+            if elements[fields[0]][1] == 0xA0:
+                fields = fields[1:]
+            issuer, validity, subject = fields[2:5]
+            notAfterTag, notAfter = elements[children(elements, validity)[1]][1:]
+            certificates.append(
+                {
+                    "subject": decodeDN(elements, subject),
+                    "issuer": decodeDN(elements, issuer),
+                    "notAfter": decodeTime(notAfterTag, notAfter),
+                }
+            )
+        except (BinasciiError, IndexError) as exc:
+            raise ValueError("Invalid certificate: %s" % exc)
+    return certificates
+
+
+def getIdentity(certificates):
+    """The DN of the owner of a proxy chain: the subject of the first certificate that is not a proxy
+
+    Args:
+        certificates (list): As returned by getCertificatesInfo
+
+    Returns:
+        str: A DN (None if there is no certificate)
+    """
+    for cert in certificates:
+        # a proxy has the DN of its issuer, with an additional CN
+        if not cert["subject"].startswith(cert["issuer"] + "/CN="):
+            return cert["subject"]
+    return certificates[-1]["subject"] if certificates else None
+
+
+def findObject(value, elements):
+    """Index of the first OBJECT IDENTIFIER element of a given (encoded) value, None if there is none"""
+    for i, (_depth, tag, content) in enumerate(elements):
+        if tag == DER_OBJECT and content == value:
+            return i
 
 
 def parseASN1(data):
@@ -26,7 +223,51 @@ def findExtension(oid, lines):
 
 
 def getVO(proxy_data):
-    """Fetches the VO in a chain certificate
+    """Fetches the VO in a chain certificate.
+    The certificates are decoded in Python, openssl is only used for those that can't be,
+    or if no PEM certificate is found.
+
+    Args:
+        proxy_data (bytes): Bytes for the proxy chain
+
+    Raises:
+        Exception: Any error related to openssl
+        NotImplementedError: Not documented error
+
+    Returns:
+        str: A VO
+    """
+
+    pems = RE_PEM_CERTIFICATE.findall(proxy_data)
+    if not pems:
+        return getVOWithOpenSSL(proxy_data)
+    for pem in pems:
+        try:
+            cert_info = parseDER(b64decode(pem))
+            # Look for the VOMS extension: its value is the OCTET STRING after the OID
+            idx_voms = findObject(VOMS_EXTENSION_DER, cert_info)
+            if idx_voms is None:
+                continue
+            voms_extension = parseDER(cert_info[idx_voms + 1][2])
+        except (BinasciiError, ValueError, IndexError):
+            return getVOWithOpenSSL(proxy_data)
+        # Look for the attribute names, inside the element enclosing the OID
+        idx_fqans = findObject(VOMS_FQANS_DER, voms_extension)
+        if idx_fqans is None:
+            continue
+        initial_depth = voms_extension[idx_fqans][0] - 1
+        for depth, tag, content in voms_extension[idx_fqans:]:
+            if depth <= initial_depth:
+                break
+            # Look for a role, if it exists the VO is the first element
+            match = tag == DER_OCTET_STRING and RE_FQAN_VO.match(content)
+            if match:
+                return match.groups()[0].decode()
+    raise NotImplementedError("Something went very wrong")
+
+
+def getVOWithOpenSSL(proxy_data):
+    """Fetches the VO in a chain certificate, with openssl
 
     Args:
         proxy_data (bytes): Bytes for the proxy chain
@@ -39,7 +280,9 @@ def getVO(proxy_data):
         str: A VO
     """
 
-    chain = re.findall(br"-----BEGIN CERTIFICATE-----\n.+?\n-----END CERTIFICATE-----", proxy_data, flags=re.DOTALL)
+    chain = re.findall(
+        br"-----BEGIN CERTIFICATE-----\r?\n.+?\r?\n-----END CERTIFICATE-----", proxy_data, flags=re.DOTALL
+    )
     for cert in chain:
         proc = Popen(["openssl", "x509", "-outform", "der"], stdin=PIPE, stdout=PIPE)
         out, _ = proc.communicate(cert)
@@ -0,0 +1,397 @@
+"""Sending of the remote log batches, and their spool"""
+
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import deque
+from threading import RLock
+
+from threadTools import synchronized
+
+
+class BatchSender(object):
+    """
+    Sends batches of log lines from a dedicated thread, so that writers never wait for the server.
+    The batches wait in a bounded queue. When it is full, the overflow policy decides what is lost:
+
+    - "dropDebug": the DEBUG lines (of the queued batches and the new one) first, then the oldest batches
+    - "dropOldest": the oldest batch
+    - "block": the new batch waits (at most blockTimeout seconds) for room, then it is dropped. The writer
+      waits for it in waitForRoom(), that a caller holding a lock calls once it is released.
+
+    The sender thread also calls onDeadline at the time given to setDeadline(), e.g. to flush a buffer.
+    """
+
+    overflowPolicies = ("dropDebug", "dropOldest", "block")
+
+    def __init__(
+        self, senderFunc, maxBatches=10, overflowPolicy="dropDebug", blockTimeout=10, onSent=None, onDeadline=None
+    ):
+        """
+        Constructor.
+
+        :param senderFunc: a function used to send a message
+        :type senderFunc: func
+        :param maxBatches: maximum number of batches waiting to be sent
+        :type maxBatches: int
+        :param overflowPolicy: what to do when the queue is full, one of overflowPolicies
+        :type overflowPolicy: str
+        :param blockTimeout: with the "block" policy, the longest time (in seconds) a writer waits
+        :type blockTimeout: float
+        :param onSent: function called with the time (in seconds) taken to send each batch
+        :type onSent: func
+        :param onDeadline: function called (by the sender thread) at the deadline set by setDeadline()
+        :type onDeadline: func
+        """
+        if overflowPolicy not in self.overflowPolicies:
+            raise ValueError("Invalid overflow policy: %s" % overflowPolicy)
+        self.senderFunc = senderFunc
+        self.maxBatches = max(1, maxBatches)
+        self.overflowPolicy = overflowPolicy
+        self.blockTimeout = blockTimeout
+        self.onSent = onSent
+        self.onDeadline = onDeadline
+        self._batches = deque()
+        # "block" policy: the batches waiting for room in the queue, with the time they are dropped
+        self._blocked = deque()
+        self._deadline = None
+        self._cond = threading.Condition()
+        self._thread = None
+        # a batch is being sent
+        self._sending = False
+        # line counters
+        self.queuedLines = 0
+        self.sentLines = 0
+        self.droppedLines = 0
+        self.failedLines = 0
+
+    @staticmethod
+    def countLines(text):
+        return max(1, text.count("\n")) if text else 0
+
+    def _dropDebugLines(self, batch):
+        """The batch without its DEBUG lines (which are counted as dropped)"""
+        kept = "".join(
+            line for line in batch.splitlines(True) if " DEBUG [" not in line and '"level":"DEBUG"' not in line
+        )
+        self.droppedLines += self.countLines(batch) - self.countLines(kept)
+        return kept
+
+    def _makeRoom(self, batch):
+        """Apply the "drop" overflow policies, with the queue full (called with the condition held)
+
+        :return: the batch to queue, or None if it is dropped
+        """
+        if self.overflowPolicy == "dropDebug":
+            batches = [self._dropDebugLines(queued) for queued in self._batches]
+            self._batches = deque(queued for queued in batches if queued)
+            batch = self._dropDebugLines(batch)
+            if not batch:
+                return None
+        while len(self._batches) >= self.maxBatches:
+            self.droppedLines += self.countLines(self._batches.popleft())
+        return batch
+
+    def _unblock(self):
+        """Drop the blocked batches waiting for too long, and queue the others while there is room
+        (called with the condition held)
+        """
+        now = time.time()
+        while self._blocked and self._blocked[0][0] <= now:
+            self.droppedLines += self.countLines(self._blocked.popleft()[1])
+        while self._blocked and len(self._batches) < self.maxBatches:
+            batch = self._blocked.popleft()[1]
+            self._batches.append(batch)
+            self.queuedLines += self.countLines(batch)
+
+    def _startThread(self):
+        """Start the sender thread, if it is not running (called with the condition held)"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="RemoteLoggerSender")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def put(self, batch, wait=True):
+        """Queue a batch, to be sent by the sender thread
+
+        :param str batch: the (log) lines
+        :param bool wait: with the "block" policy, wait for room (see waitForRoom)
+        """
+        with self._cond:
+            if self.overflowPolicy == "block":
+                # in order, after those already waiting
+                self._blocked.append((time.time() + self.blockTimeout, batch))
+                self._unblock()
+            else:
+                if len(self._batches) >= self.maxBatches:
+                    batch = self._makeRoom(batch)
+                    if batch is None:
+                        return
+                self._batches.append(batch)
+                self.queuedLines += self.countLines(batch)
+            self._startThread()
+        if wait:
+            self.waitForRoom()
+
+    def waitForRoom(self):
+        """With the "block" policy, wait (at most blockTimeout seconds) until the blocked batches are queued:
+        those still waiting then are dropped. Nothing to do with the other policies.
+        """
+        deadline = time.time() + self.blockTimeout
+        with self._cond:
+            while self._blocked:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+                self._unblock()
+            self._unblock()
+
+    def setDeadline(self, deadline):
+        """Have the sender thread call onDeadline at a given time
+
+        :param deadline: the time (epoch), None to cancel it
+        :type deadline: float
+        """
+        with self._cond:
+            self._deadline = deadline
+            if deadline is not None:
+                self._startThread()
+            self._cond.notify_all()
+
+    def _run(self):
+        """Body of the sender thread: it stops when there is nothing left to send, and no deadline"""
+        while True:
+            with self._cond:
+                self._sending = False
+                self._cond.notify_all()
+                while True:
+                    late = self._deadline is not None and self._deadline <= time.time()
+                    if late or self._batches:
+                        break
+                    if self._deadline is None:
+                        self._thread = None
+                        return
+                    self._cond.wait(self._deadline - time.time())
+                if late:
+                    self._deadline = batch = None
+                else:
+                    batch = self._batches.popleft()
+                    # room for a blocked batch
+                    self._unblock()
+                    self._sending = True
+                    self._cond.notify_all()
+            if late:
+                # without the condition: onDeadline may queue a batch
+                try:
+                    self.onDeadline()
+                except Exception as exc:
+                    sys.stderr.write("Remote logger: deadline not handled: %s\n" % exc)
+                continue
+            try:
+                start = time.time()
+                self.senderFunc(batch)
+                self.sentLines += self.countLines(batch)
+                if self.onSent is not None:
+                    self.onSent(time.time() - start)
+            except Exception as exc:
+                self.failedLines += self.countLines(batch)
+                sys.stderr.write("Remote logger: message not sent: %s\n" % exc)
+
+    def drain(self, timeout=None):
+        """Wait until all the queued batches are sent (or failed)
+
+        :param timeout: the longest time to wait, in seconds (None: no limit)
+        :return: True if there is nothing left to send
+        :rtype: bool
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._batches or self._blocked or self._sending:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    @property
+    def counters(self):
+        """Line counters: queued, sent, dropped, failed (to send) and waiting (in the queue)
+
+        :rtype: dict
+        """
+        with self._cond:
+            return {
+                "queued": self.queuedLines,
+                "sent": self.sentLines,
+                "dropped": self.droppedLines,
+                "failed": self.failedLines,
+                "waiting": sum(self.countLines(batch) for batch in self._batches)
+                + sum(self.countLines(batch) for _, batch in self._blocked),
+            }
+
+
+class RemoteLogSpooler(object):
+    """
+    Sender of the remote log pipeline, for when the logging service is slow or down.
+
+    Batches that could not be sent (to the logging URL, nor to any of the failover URLs) are appended to
+    a local spool file, instead of being lost. After failureThreshold consecutive failures the circuit
+    breaker opens: no request is made for a while, new batches go straight to the spool. The delay grows
+    exponentially (with jitter, so that many pilots do not retry all at once) up to maxDelay.
+    Once a request succeeds again the spool is replayed, oldest batch first, before new batches.
+    The spool file is named after the pilot UUID: a pilot only replays what it spooled itself.
+    """
+
+    failureThreshold = 3
+    baseDelay = 5
+    maxDelay = 600
+    # the spool file is fsync'ed at most every fsyncInterval seconds (and before a replay)
+    fsyncInterval = 5
+    maxSpoolSize = 100 * 1024 * 1024
+
+    def __init__(self, urls, sendFunc, spoolFile=None, pilotUUID="unknown"):
+        """
+        Constructor.
+
+        :param list urls: the logging service URL, then the failover URLs
+        :param sendFunc: function(url, method, message) sending a message, raising an exception on failure
+        :param str spoolFile: path of the spool file (default: pilot.remotelog.<pilotUUID>.spool)
+        :param str pilotUUID: the UUID of the pilot sending the batches
+        """
+        self.urls = [url for url in urls if url]
+        self.sendFunc = sendFunc
+        self.spoolFile = os.path.abspath(spoolFile or "pilot.remotelog.%s.spool" % pilotUUID)
+        self._rlock = RLock()
+        # the URL that worked last
+        self.activeURL = 0
+        self.failures = 0
+        # time before which the circuit breaker is open (no request)
+        self.retryAt = 0
+        self._spool = None
+        self._spoolSize = 0
+        self._replayOffset = 0
+        self._lastSync = 0
+        self.spooledLines = 0
+        self.replayedLines = 0
+        self.droppedLines = 0
+        if os.path.exists(self.spoolFile):
+            if pilotUUID == "unknown":
+                # possibly from another pilot: it can't be sent in the name of this one
+                os.remove(self.spoolFile)
+            else:
+                # left by a previous attempt of this pilot: replayed with the rest
+                self._spoolSize = os.path.getsize(self.spoolFile)
+
+    @property
+    def isOpen(self):
+        """True if the circuit breaker is holding requests back"""
+        return time.time() < self.retryAt
+
+    @synchronized
+    def send(self, method, message, force=False):
+        """Send a message to the logging service, or to a failover URL
+
+        :param str method: the method to invoke
+        :param message: the message
+        :param bool force: try even if the circuit breaker is open
+        :return: True if sent
+        :rtype: bool
+        """
+        if not force and self.isOpen:
+            return False
+        for i in range(len(self.urls)):
+            index = (self.activeURL + i) % len(self.urls)
+            try:
+                self.sendFunc(self.urls[index], method, message)
+            except Exception as exc:
+                sys.stderr.write("Remote logger: %s failed: %s\n" % (self.urls[index], exc))
+                continue
+            self.activeURL = index
+            self.failures = 0
+            self.retryAt = 0
+            return True
+        self.failures += 1
+        if self.failures >= self.failureThreshold:
+            delay = min(self.maxDelay, self.baseDelay * 2 ** (self.failures - self.failureThreshold))
+            self.retryAt = time.time() + delay * random.uniform(0.5, 1)
+        return False
+
+    @synchronized
+    def __call__(self, batch):
+        """Send a batch of log lines (the senderFunc of the pipeline), spooling it if it can't be sent
+
+        :param str batch: the log lines
+        """
+        # keep the order: what is already in the spool goes first
+        if (self._spoolSize > self._replayOffset and not self.replay()) or not self.send("sendMessage", batch):
+            self._append(batch)
+
+    def _append(self, batch):
+        """Append a batch to the spool file"""
+        record = (json.dumps(batch) + "\n").encode("utf-8")
+        if self._spoolSize + len(record) > self.maxSpoolSize:
+            self.droppedLines += BatchSender.countLines(batch)
+            return
+        if self._spool is None:
+            self._spool = open(self.spoolFile, "ab")
+        self._spool.write(record)
+        self._spoolSize += len(record)
+        self.spooledLines += BatchSender.countLines(batch)
+        now = time.time()
+        if now - self._lastSync >= self.fsyncInterval:
+            self._sync(now)
+
+    def _sync(self, now=None):
+        if self._spool is not None:
+            self._spool.flush()
+            os.fsync(self._spool.fileno())
+        self._lastSync = now or time.time()
+
+    @synchronized
+    def replay(self, force=False):
+        """Send the spooled batches, oldest first, stopping at the first failure
+
+        :param bool force: try even if the circuit breaker is open
+        :return: True if the spool is now empty
+        :rtype: bool
+        """
+        if self._spoolSize <= self._replayOffset:
+            return True
+        self._sync()
+        with open(self.spoolFile, "rb") as spool:
+            spool.seek(self._replayOffset)
+            for record in spool:
+                if not record.endswith(b"\n"):
+                    # torn write (the pilot was killed while spooling): ignored
+                    break
+                batch = json.loads(record.decode("utf-8"))
+                if not self.send("sendMessage", batch, force=force):
+                    return False
+                force = False
+                self._replayOffset += len(record)
+                self.replayedLines += BatchSender.countLines(batch)
+        # all sent: start again from an empty spool
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+        os.remove(self.spoolFile)
+        self._spoolSize = self._replayOffset = 0
+        return True
+
+    @property
+    def counters(self):
+        """Line counters: spooled, replayed, dropped (spool full), and the consecutive failures
+
+        :rtype: dict
+        """
+        with self._rlock:
+            return {
+                "spooled": self.spooledLines,
+                "replayed": self.replayedLines,
+                "spoolDropped": self.droppedLines,
+                "failures": self.failures,
+            }
@@ -0,0 +1,125 @@
+"""Scheduler of the pilot commands"""
+
+import queue
+import threading
+
+from pilotTools import getCommandClass
+
+
+class CommandScheduler(object):
+    """
+    Runs the pilot commands, concurrently when they declare that they do not depend on each other.
+
+    Commands declare the resources they need and produce (CommandBase.needs and CommandBase.produces,
+    e.g. "installEnv" or "pilot.cfg"). A command waits for all the previous commands (in the order of
+    the command list) producing a resource it needs, and for the previous commands needing or producing
+    a resource it produces. Commands not declaring their resources (e.g. from extensions) run alone in the main
+    thread, after all the previous commands, before all the following ones: with no declarations, or with
+    maxWorkers=1, the commands run one after the other in the order of the command list, as they always did.
+    """
+
+    def __init__(self, pilotParams, maxWorkers=1):
+        """
+        c'tor
+
+        :param pilotParams: the pilot parameters, giving the commands and their extensions
+        :param int maxWorkers: maximum number of commands running at the same time
+        """
+        self.commands = list(pilotParams.commands)
+        self.maxWorkers = maxWorkers
+        commandClasses = [getCommandClass(pilotParams, commandName)[0] for commandName in self.commands]
+        # the commands running the payloads (LaunchAgent) run alone too
+        self.payloads = [getattr(cls, "runsPayloads", False) for cls in commandClasses]
+        self.concurrent = [
+            getattr(cls, "needs", None) is not None
+            and getattr(cls, "produces", None) is not None
+            and not self.payloads[index]
+            for index, cls in enumerate(commandClasses)
+        ]
+        self.dependencies = self._buildDependencies(commandClasses)
+
+    def _buildDependencies(self, commandClasses):
+        """
+        Build the dependency graph.
+
+        :return: for each command, the set of the (previous) commands it depends on
+        :rtype: list
+        """
+        dependencies = []
+        producers = {}
+        consumers = {}
+        lastBarrier = None
+        for index, cls in enumerate(commandClasses):
+            if not self.concurrent[index]:
+                dependencies.append(set(range(index)))
+                lastBarrier = index
+                continue
+            deps = set() if lastBarrier is None else {lastBarrier}
+            for resource in cls.needs:
+                deps.update(producers.get(resource, []))
+            for resource in cls.produces:
+                deps.update(consumers.get(resource, []))
+                deps.update(producers.get(resource, []))
+            for resource in cls.needs:
+                consumers.setdefault(resource, []).append(index)
+            for resource in cls.produces:
+                producers.setdefault(resource, []).append(index)
+            dependencies.append(deps)
+        return dependencies
+
+    def run(self, runCommand, beforePayloads=None):
+        """
+        Run all the commands. An exception (including SystemExit) raised by a command is raised again here,
+        once the commands still running are over: no more commands are started.
+
+        :param runCommand: function executing a command, called with its position in the command list
+                           and its name
+        :param beforePayloads: function called like runCommand just before a command running the payloads
+                               (CommandBase.runsPayloads, e.g. LaunchAgent), once all the previous commands are over
+        """
+        if self.maxWorkers <= 1:
+            for index, commandName in enumerate(self.commands):
+                if beforePayloads and self.payloads[index]:
+                    beforePayloads(index, commandName)
+                runCommand(index, commandName)
+            return
+
+        def worker(index):
+            try:
+                runCommand(index, self.commands[index])
+                results.put((index, None))
+            except BaseException as exc:  # pylint: disable=broad-except
+                results.put((index, exc))
+
+        results = queue.Queue()
+        pending = list(range(len(self.commands)))
+        running = set()
+        done = set()
+        while pending or running:
+            for index in list(pending):
+                if len(running) >= self.maxWorkers:
+                    break
+                if not self.dependencies[index] <= done:
+                    continue
+                pending.remove(index)
+                if not self.concurrent[index]:
+                    # all previous commands are done, and the following ones wait for this one
+                    if beforePayloads and self.payloads[index]:
+                        beforePayloads(index, self.commands[index])
+                    runCommand(index, self.commands[index])
+                    done.add(index)
+                    continue
+                running.add(index)
+                # daemon threads: a command stuck in a system call can't delay an exit requested by another one
+                thread = threading.Thread(target=worker, args=(index,), name=self.commands[index])
+                thread.daemon = True
+                thread.start()
+            if running:
+                index, exc = results.get()
+                running.discard(index)
+                if exc is not None:
+                    # the other commands can't go on while the pilot exits
+                    while running:
+                        running.discard(results.get()[0])
+                    raise exc
+                done.add(index)
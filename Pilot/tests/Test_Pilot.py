@@ -14,8 +14,17 @@ import unittest
 
 sys.path.insert(0, os.getcwd() + "/Pilot")
 
-from pilotCommands import CheckWorkerNode, ConfigureSite, NagiosProbes
-from pilotTools import PilotParams
+from pilotCommands import (
+    CheckWNCapabilities,
+    CheckWorkerNode,
+    ConfigureArchitectureWithoutCLI,
+    ConfigureCPURequirements,
+    ConfigureSite,
+    NagiosProbes,
+)
+from cfgTools import CFG
+from mjfTools import MachineJobFeatures
+from pilotTools import CommandBase, LogFile, PilotParams, getCommand
 
 
 class PilotTestCase(unittest.TestCase):
@@ -51,6 +60,8 @@ class PilotTestCase(unittest.TestCase):
         os.environ["X509_USER_PROXY"] = os.getcwd()
 
     def tearDown(self):
+        # pilot.out is removed below
+        LogFile.closeAll()
         for fileProd in [
             "pilot.json",
             "Nagios1",
@@ -181,6 +192,134 @@ class CommandsTestCase(PilotTestCase):
         cs = ConfigureSite(pp)
         self.assertEqual(cs.execute(), None)
 
+    def test_ConfigTransaction(self):
+        """Test that the configuration commands end up in a single dirac-configure call"""
+        sys.argv[1:] = ["--Name", "grid1.example.com", "--Queue", "queue1", "-o", "/LocalSite/GridCE=override"]
+        pp = PilotParams()
+        pp.configureScript = "echo"
+        cs = ConfigureSite(pp)
+        ca = ConfigureArchitectureWithoutCLI(pp)
+
+        with mock.patch.object(ConfigureSite, "executeAndGetOutput", return_value=(0, "")) as mockExec:
+            cs.execute()
+            ca.execute()
+            mockExec.assert_not_called()
+            self.assertFalse(pp.cfgTransaction.isEmpty())
+
+            cs.commitLocalConfig()
+            mockExec.assert_called_once()
+            configureCmd = mockExec.call_args[0][0]
+            self.assertTrue(configureCmd.startswith("echo "))
+            self.assertTrue(configureCmd.endswith("-FDMH -O pilot.cfg --cfg pilot.cfg"))
+            # the options keep the order of the sequential calls (later ones override the former)
+            self.assertLess(
+                configureCmd.index("-o /LocalSite/GridCE=grid1.example.com"), configureCmd.index("override")
+            )
+            self.assertLess(configureCmd.index("/LocalSite/CEQueue=queue1"), configureCmd.index("/LocalSite/Platform="))
+            self.assertTrue(pp.cfgTransaction.isEmpty())
+
+            # nothing pending: nothing to execute
+            cs.commitLocalConfig()
+            mockExec.assert_called_once()
+
+    def test_nativeConfigWriter(self):
+        """Test that with the default command list, pilot.cfg is only updated natively after ConfigureBasics"""
+        sys.argv[1:] = ["--Name", "grid1.example.com", "--Queue", "queue1", "-c"]
+        pp = PilotParams()
+        # as created by ConfigureBasics
+        with open(pp.localConfigFile, "w") as fp:
+            fp.write("DIRAC\n{\n  Setup = TestSetup\n}\n")
+        self.addCleanup(os.remove, pp.localConfigFile)
+        self.addCleanup(MachineJobFeatures.clear)
+        outputs = {
+            "dirac-resource-get-parameters": '{"Tag": ["tag1"], "MaxRAM": "2048"}',
+            "dirac-wms-get-wn-parameters": "4 2048 1",
+            "dirac-platform": "Linux_x86_64_glibc-2.17",
+            "dirac-wms-cpu-normalization": "Estimated CPU power is 10.5 HS06",
+            "dirac-wms-get-queue-cpu-time": "CPU time left determined as 1000",
+        }
+        executed = []
+
+        def executeAndGetOutput(cmd, environDict=None, capture="all"):
+            executed.append(cmd)
+            return 0, outputs.get(cmd.split(" ")[0], "")
+
+        commands = [
+            "CheckWorkerNode",
+            "InstallDIRAC",
+            "ConfigureBasics",
+            "RegisterPilot",
+            "CheckCECapabilities",
+            "CheckWNCapabilities",
+            "ConfigureSite",
+            "ConfigureArchitecture",
+            "ConfigureCPURequirements",
+            "LaunchAgent",
+        ]
+        with mock.patch.dict(os.environ), mock.patch.object(
+            CommandBase, "executeAndGetOutput", side_effect=executeAndGetOutput
+        ):
+            os.environ.pop("JOBFEATURES", None)
+            os.environ.pop("MACHINEFEATURES", None)
+            MachineJobFeatures.clear()
+            # as dirac-pilot.py runs them (the installation, and the JobAgent, are not tested here)
+            for sequence, commandName in enumerate(commands):
+                command = getCommand(pp, commandName)[0]
+                command.sequence = sequence
+                if command.needsLocalConfig:
+                    command.commitLocalConfig()
+                if commandName not in ("CheckWorkerNode", "InstallDIRAC", "ConfigureBasics", "LaunchAgent"):
+                    command.execute()
+
+        self.assertTrue(pp.cfgTransaction.isEmpty())
+        self.assertFalse([cmd for cmd in executed if cmd.startswith(pp.configureScript)])
+        cfg = CFG().loadFromFile(pp.localConfigFile)
+        self.assertEqual(cfg.getOption("/LocalSite/Site"), "site.example.com")
+        self.assertEqual(cfg.getOption("/LocalInstallation/CEName"), "grid1.example.com")
+        self.assertEqual(cfg.getOption("/DIRAC/Security/UseServerCertificate"), "yes")
+        self.assertEqual(cfg.getOption("/LocalSite/Architecture"), "Linux_x86_64_glibc-2.17")
+        self.assertEqual(cfg.getOption("/LocalSite/CPUTimeLeft"), "10500")
+        self.assertEqual(cfg.getOption("/Resources/Computing/CEDefaults/NumberOfGPUs"), "1")
+
+    def test_MachineJobFeatures(self):
+        """Test that CheckWNCapabilities and ConfigureCPURequirements take what MJF has, without asking DIRAC"""
+        jobFeatures = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, jobFeatures)
+        self.addCleanup(MachineJobFeatures.clear)
+        for key, value in [("allocated_cpu", "8"), ("max_rss_bytes", "17179869184"), ("hs06_job", "80")]:
+            with open(os.path.join(jobFeatures, key), "w") as fp:
+                fp.write(value + "\n")
+        with open(os.path.join(jobFeatures, "wall_limit_secs"), "w") as fp:
+            fp.write("86400\n")
+        with mock.patch.dict(os.environ, {"JOBFEATURES": jobFeatures}):
+            MachineJobFeatures.clear()
+            pp = PilotParams()
+        self.assertEqual(pp.pilotProcessors, 8)
+
+        # no GPUs in MJF: they are still probed
+        with mock.patch.object(CheckWNCapabilities, "executeAndGetOutput", return_value=(0, "4 2048 2")) as mockExec:
+            CheckWNCapabilities(pp).execute()
+            mockExec.assert_called_once()
+        self.assertEqual(pp.pilotProcessors, 8)
+        options = [(path, value) for _sequence, path, value in pp.cfgTransaction.pending]
+        self.assertIn(("/Resources/Computing/CEDefaults/NumberOfGPUs", "2"), options)
+        self.assertIn(("/Resources/Computing/CEDefaults/MaxRAM", "16384"), options)
+
+        # unless the queue defines them
+        pp.queueParameters["NumberOfGPUs"] = "1"
+        with mock.patch.object(CheckWNCapabilities, "executeAndGetOutput") as mockExec:
+            CheckWNCapabilities(pp).execute()
+            mockExec.assert_not_called()
+        self.assertEqual(pp.pilotProcessors, 8)
+
+        with mock.patch.object(ConfigureCPURequirements, "executeAndGetOutput") as mockExec:
+            ConfigureCPURequirements(pp).execute()
+            mockExec.assert_not_called()
+        options = [(path, value) for _sequence, path, value in pp.cfgTransaction.pending]
+        self.assertIn(("/Resources/Computing/CEDefaults/MaxRAM", "16384"), options)
+        self.assertIn(("/LocalSite/CPUNormalizationFactor", "10.0"), options)
+        self.assertEqual(pp.jobCPUReq, 864000)
+
     def test_NagiosProbes(self):
         """Test NagiosProbes command"""
         pp = PilotParams()
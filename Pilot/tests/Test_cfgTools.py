@@ -0,0 +1,141 @@
+"""Tests for the DIRAC configuration files reader and writer (cfgTools)"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+sys.path.insert(0, os.getcwd() + "/Pilot")
+
+from cfgTools import CFG, ConfigTransaction, splitConfigOption
+
+
+# As written by dirac-configure (an empty value is followed by a space)
+PILOT_CFG = """DIRAC
+{
+  Setup = DIRAC-Certification
+  Configuration
+  {
+    Servers = dips://lbcertifdirac70.cern.ch:9135/Configuration/Server
+  }
+  Security
+  {
+    UseServerCertificate = no
+  }
+}
+LocalSite
+{
+  ReleaseProject =\x20
+  ReleaseVersion = v8.0.30
+  CVMFS_locations = /cvmfs/grid.cern.ch
+  CVMFS_locations += /cvmfs/dirac.egi.eu
+}
+Resources
+{
+  Computing
+  {
+    CEDefaults
+    {
+      #Tags from the queue
+      Tag = MultiProcessor
+      Tag += WholeNode
+      VirtualOrganization = gridpp
+    }
+  }
+}
+"""
+
+
+class TestCFG(unittest.TestCase):
+    def setUp(self):
+        self.testDir = tempfile.mkdtemp()
+        self.cfgFile = os.path.join(self.testDir, "pilot.cfg")
+        with open(self.cfgFile, "w") as fd:
+            fd.write(PILOT_CFG)
+
+    def tearDown(self):
+        shutil.rmtree(self.testDir)
+
+    def test_roundTrip(self):
+        cfg = CFG().loadFromFile(self.cfgFile)
+        self.assertEqual(str(cfg), PILOT_CFG)
+        self.assertEqual(cfg.getOption("/DIRAC/Setup"), "DIRAC-Certification")
+        self.assertEqual(cfg.getOption("/LocalSite/CVMFS_locations"), "/cvmfs/grid.cern.ch, /cvmfs/dirac.egi.eu")
+        self.assertEqual(cfg.getOption("/LocalSite/ReleaseProject"), "")
+        self.assertEqual(cfg.getOption("/LocalSite/Missing", "default"), "default")
+        self.assertIsNone(cfg.getOption("/DIRAC/Configuration"))
+
+        # a different layout, same content
+        compact = "# comment\nDIRAC {\n Setup=DIRAC-Certification\n}\nLocalSite\n{\nTag = a,b\n}\n"
+        cfg = CFG().loadFromBuffer(compact)
+        self.assertEqual(
+            str(cfg), "#comment\nDIRAC\n{\n  Setup = DIRAC-Certification\n}\nLocalSite\n{\n  Tag = a\n  Tag += b\n}\n"
+        )
+        self.assertEqual(str(CFG().loadFromBuffer(str(cfg))), str(cfg))
+
+        with self.assertRaises(ValueError):
+            CFG().loadFromBuffer("DIRAC\n{\n  Setup = x\n")
+
+    def test_setOptionInPath(self):
+        cfg = CFG().loadFromFile(self.cfgFile)
+        cfg.setOptionInPath("/LocalSite/ReleaseVersion", "v8.0.31")
+        cfg.setOptionInPath("/LocalSite/BatchSystemInfo/Parameters/Queue", "long")
+        cfg.setOptionInPath("/Resources/Computing/CEDefaults/Tag", "GPU,MultiProcessor")
+        self.assertEqual(cfg.getOption("/LocalSite/ReleaseVersion"), "v8.0.31")
+        self.assertEqual(cfg.getOption("/LocalSite/BatchSystemInfo/Parameters/Queue"), "long")
+        serialized = str(cfg)
+        # existing options keep their place, new ones are appended to their section
+        self.assertLess(serialized.index("ReleaseVersion"), serialized.index("CVMFS_locations"))
+        self.assertIn("      Tag = GPU\n      Tag += MultiProcessor\n", serialized)
+        self.assertIn("  BatchSystemInfo\n  {\n    Parameters\n    {\n      Queue = long\n", serialized)
+        with self.assertRaises(KeyError):
+            cfg.setOptionInPath("/LocalSite/ReleaseVersion/Sub", "x")
+
+    def test_writeToFile(self):
+        os.chmod(self.cfgFile, 0o640)
+        link = os.path.join(self.testDir, "dirac.cfg")
+        os.symlink(self.cfgFile, link)
+        cfg = CFG().loadFromFile(link)
+        cfg.setOptionInPath("/LocalSite/CPUTimeLeft", "12345")
+        cfg.writeToFile(link)
+        self.assertTrue(os.path.islink(link))
+        self.assertEqual(os.stat(self.cfgFile).st_mode & 0o777, 0o640)
+        self.assertEqual(sorted(os.listdir(self.testDir)), ["dirac.cfg", "pilot.cfg"])
+        self.assertEqual(CFG().loadFromFile(self.cfgFile).getOption("/LocalSite/CPUTimeLeft"), "12345")
+
+    def test_splitConfigOption(self):
+        self.assertEqual(splitConfigOption("/LocalSite/X = a"), ("/LocalSite/X", "a"))
+        self.assertEqual(splitConfigOption("/LocalSite/X=a=b"), ("/LocalSite/X", "a=b"))
+        self.assertIsNone(splitConfigOption("/LocalSite/X"))
+
+    def test_transactionNativeCommit(self):
+        pp = MagicMock(localConfigFile=self.cfgFile, configureScript="dirac-configure", debugFlag=False)
+        command = MagicMock()
+        transaction = ConfigTransaction(pp)
+        transaction.addOption("/LocalSite/GridCE", "ce1.example.com")
+        transaction.addOption("/LocalSite/GridCE", "ce2.example.com")
+        transaction.addOption("/Resources/Computing/CEDefaults/NumberOfProcessors", 8)
+        self.assertEqual(transaction.commit(command), 0)
+        command.executeAndGetOutput.assert_not_called()
+        cfg = CFG().loadFromFile(self.cfgFile)
+        self.assertEqual(cfg.getOption("/LocalSite/GridCE"), "ce2.example.com")
+        self.assertEqual(cfg.getOption("/Resources/Computing/CEDefaults/NumberOfProcessors"), "8")
+        self.assertEqual(cfg.getOption("/DIRAC/Setup"), "DIRAC-Certification")
+
+        # a switch needs dirac-configure
+        command.executeAndGetOutput.return_value = (0, "")
+        transaction.addOption("/LocalSite/GridCE", "ce3.example.com")
+        transaction.addSwitch('-n "Some.Site.org"')
+        self.assertEqual(transaction.commit(command), 0)
+        command.executeAndGetOutput.assert_called_once()
+        self.assertTrue(
+            command.executeAndGetOutput.call_args[0][0].startswith(
+                'dirac-configure -o /LocalSite/GridCE=ce3.example.com -n "Some.Site.org" -FDMH'
+            )
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
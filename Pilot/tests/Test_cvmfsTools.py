@@ -0,0 +1,124 @@
+"""Tests for the CVMFS locations and warm-up (cvmfsTools)"""
+
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.getcwd() + "/Pilot")
+
+from cvmfsTools import CVMFSLocationMap, CVMFSWarmUp
+from fileSystemTools import FileSystemProbe
+
+
+class TestCVMFSLocationMap(unittest.TestCase):
+    def setUp(self):
+        self.testDir = tempfile.mkdtemp()
+        self.release = threading.Event()
+        self.slow, self.fast, self.stuck = [os.path.join(self.testDir, name) for name in ("slow", "fast", "stuck")]
+        for location in (self.slow, self.fast):
+            os.makedirs(os.path.join(location, "etc/grid-security/vomses"))
+            with open(os.path.join(location, "etc/grid-security/vomses/vo"), "w") as fp:
+                fp.write('"vo" "voms.example.org" "15000" "/DC=org/CN=voms" "vo"\n')
+        os.makedirs(os.path.join(self.slow, "etc/grid-security/certificates"))
+        with open(os.path.join(self.slow, "etc/grid-security/certificates/ca.pem"), "w") as fp:
+            fp.write("CA")
+
+        def listdir(path):
+            if path == self.slow:
+                time.sleep(0.2)
+            elif path.startswith(self.stuck):
+                self.release.wait()
+            return os.listdir(path)
+
+        self.probes = FileSystemProbe()
+        self.probes.operations = dict(FileSystemProbe.operations, listdir=listdir)
+
+    def tearDown(self):
+        self.release.set()
+        shutil.rmtree(self.testDir)
+
+    def test_discover(self):
+        locations = [self.slow, os.path.join(self.testDir, "missing"), self.stuck, self.fast]
+        locationMap = CVMFSLocationMap(locations, self.probes)
+        start = time.time()
+        dirs = ["etc/grid-security/%s" % name for name in ("certificates", "vomsdir", "vomses")]
+        self.assertEqual(locationMap.discover(dirs, timeout=1), [self.fast, self.slow])
+        # concurrently: one deadline for all
+        self.assertLess(time.time() - start, 3)
+        self.assertIsNone(locationMap.latency[self.stuck])
+
+        vomses = os.path.join(self.fast, "etc/grid-security/vomses")
+        self.assertEqual(locationMap.find("etc/grid-security/vomses"), vomses)
+        self.assertEqual(locationMap.find("etc/grid-security/certificates"), os.path.join(self.slow, dirs[0]))
+        self.assertIsNone(locationMap.find("etc/grid-security/vomsdir"))
+        self.assertEqual(locationMap.find("etc/grid-security/vomses/vo", isFile=True), os.path.join(vomses, "vo"))
+        # all from the cache
+        calls = self.probes.hits
+        locationMap.find("etc/grid-security/vomses")
+        self.assertGreater(self.probes.hits, calls)
+
+
+class TestCVMFSWarmUp(unittest.TestCase):
+    def setUp(self):
+        self.testDir = tempfile.mkdtemp()
+        package = os.path.join(self.testDir, "lib/python3.11/site-packages/DIRAC")
+        os.makedirs(package)
+        os.makedirs(os.path.join(self.testDir, "bin"))
+        for i in range(20):
+            with open(os.path.join(package, "module%d.py" % i), "w") as fp:
+                fp.write("x" * 1000)
+        with open(os.path.join(package, "README"), "w") as fp:
+            fp.write("not read ahead")
+        with open(os.path.join(self.testDir, "bin/dirac-configure"), "w") as fp:
+            fp.write("#!/bin/sh\n")
+        self.manifest = os.path.join(self.testDir, "warmup.manifest")
+        with open(self.manifest, "w") as fp:
+            fp.write("# recorded\nbin/dirac-configure\nlib/python3.11/site-packages/DIRAC/module3.py\nbin/missing\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.testDir)
+
+    def test_warmUp(self):
+        warmUp = CVMFSWarmUp(self.testDir, self.manifest, threads=2)
+        warmUp.start()
+        self.assertTrue(warmUp.wait(10))
+        summary = warmUp.summary
+        # the manifest (module3.py once), then the Python files
+        self.assertEqual(summary["files"], 21)
+        self.assertEqual(summary["bytes"], 20010)
+        self.assertEqual(summary["errors"], 1)
+
+    def test_fullQueue(self):
+        warmUp = CVMFSWarmUp(self.testDir, threads=2)
+        # no room for the end marks: the readers end anyway, long before maxTime
+        warmUp._paths = queue.Queue(1)
+        warmUp.start()
+        self.assertTrue(warmUp.wait(10))
+        self.assertEqual(warmUp.summary["files"], 20)
+
+    def test_budget(self):
+        warmUp = CVMFSWarmUp(self.testDir, maxBytes=4500, threads=1)
+        warmUp.start()
+        self.assertTrue(warmUp.wait(10))
+        self.assertTrue(warmUp.stopped)
+        self.assertEqual(warmUp.summary["bytes"], 5000)
+
+    def test_manifestFromTrace(self):
+        root = "/cvmfs/dirac.egi.eu/dirac/v8.0.30/Linux-x86_64"
+        trace = [
+            '123 openat(AT_FDCWD, "%s/lib/python3.11/os.py", O_RDONLY|O_CLOEXEC) = 3' % root,
+            '123 openat(AT_FDCWD, "%s/lib/missing.py", O_RDONLY|O_CLOEXEC) = -1 ENOENT (No such file)' % root,
+            '124 open("/etc/hosts", O_RDONLY) = 4',
+            '124 open("%s/bin/python", O_RDONLY) = 5' % root,
+            '125 openat(AT_FDCWD, "%s/lib/python3.11/os.py", O_RDONLY|O_CLOEXEC) = 3' % root,
+        ]
+        self.assertEqual(CVMFSWarmUp.manifestFromTrace(trace, root + "/"), ["lib/python3.11/os.py", "bin/python"])
+
+
+if __name__ == "__main__":
+    unittest.main()
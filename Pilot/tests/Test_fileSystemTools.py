@@ -0,0 +1,114 @@
+"""Tests for the file system probes (fileSystemTools)"""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.getcwd() + "/Pilot")
+
+from fileSystemTools import FileSystemProbe
+from pilotTools import safe_listdir
+
+
+class TestFileSystemProbe(unittest.TestCase):
+    def setUp(self):
+        self.testDir = tempfile.mkdtemp()
+        self.release = threading.Event()
+        self.probes = FileSystemProbe()
+        # a stuck mount: blocks until released
+        self.probes.operations = dict(FileSystemProbe.operations, hang=lambda path: self.release.wait())
+
+    def tearDown(self):
+        self.release.set()
+        FileSystemProbe.clear()
+        shutil.rmtree(self.testDir)
+
+    def test_operations(self):
+        path = os.path.join(self.testDir, "diracosrc")
+        with open(path, "w") as fp:
+            fp.write("export DIRACOS=/cvmfs\n")
+        self.assertEqual(self.probes.listdir(self.testDir), ["diracosrc"])
+        self.assertTrue(self.probes.isfile(path))
+        self.assertFalse(self.probes.isfile(self.testDir))
+        self.assertTrue(self.probes.isdir(self.testDir))
+        self.assertEqual(self.probes.stat(path).st_size, 22)
+        self.assertEqual(self.probes.readHead(path, 6), b"export")
+        self.assertEqual(self.probes.listdir(os.path.join(self.testDir, "missing")), [])
+        self.assertIsNone(self.probes.stat(os.path.join(self.testDir, "missing")))
+        self.assertEqual(safe_listdir(self.testDir), ["diracosrc"])
+
+        # cached
+        os.remove(path)
+        self.assertTrue(self.probes.isfile(path))
+        self.assertEqual(self.probes.hits, 1)
+        self.probes.invalidate(path)
+        self.assertFalse(self.probes.isfile(path))
+
+    def test_cache(self):
+        missing = os.path.join(self.testDir, "missing")
+        self.assertEqual(self.probes.listdir(missing), [])
+        self.assertIsNone(self.probes.stat(missing))
+        # failures are not cached
+        os.mkdir(missing)
+        open(os.path.join(missing, "file"), "w").close()
+        self.assertEqual(self.probes.listdir(missing), ["file"])
+        self.assertIsNotNone(self.probes.stat(missing))
+        self.assertEqual(self.probes.hits, 0)
+        # the callers get their own list
+        self.probes.listdir(missing).append("changed")
+        self.assertEqual(self.probes.listdir(missing), ["file"])
+        self.assertEqual(self.probes.hits, 2)
+        # and can do without the cache
+        open(os.path.join(missing, "other"), "w").close()
+        self.assertEqual(self.probes.listdir(missing), ["file"])
+        self.assertEqual(sorted(self.probes.listdir(missing, cache=False)), ["file", "other"])
+        self.assertEqual(sorted(safe_listdir(missing)), ["file", "other"])
+        os.remove(os.path.join(missing, "other"))
+        self.assertEqual(safe_listdir(missing), ["file"])
+
+    def test_negativeCache(self):
+        self.probes.negativeCacheTTL = 0.5
+        path = os.path.join(self.testDir, "later")
+        self.assertFalse(self.probes.isfile(path))
+        open(path, "w").close()
+        self.assertFalse(self.probes.isfile(path))
+        self.assertEqual(self.probes.hits, 1)
+        # the file is seen once the negative result expires, the positive one is kept
+        time.sleep(0.6)
+        self.assertTrue(self.probes.isfile(path))
+        time.sleep(0.6)
+        self.assertTrue(self.probes.isfile(path))
+        self.assertEqual(self.probes.hits, 2)
+
+    def test_timeout(self):
+        self.probes.maxStuck = 2
+        start = time.time()
+        self.assertEqual(self.probes.probe("hang", "/cvmfs/stuck", 0.2), (False, None))
+        # the same probe: waited for again, not started again
+        self.assertEqual(self.probes.probe("hang", "/cvmfs/stuck", 0.2), (False, None))
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(self.probes._stuck, 1)
+        # the stuck worker does not block the others
+        self.assertEqual(self.probes.listdir(self.testDir), [])
+        self.assertEqual(self.probes.probe("hang", "/cvmfs/other", 0.2), (False, None))
+        # too many stuck probes: no new one
+        self.assertEqual(self.probes.probe("hang", "/cvmfs/third", 10), (False, None))
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(self.probes.timeouts, 4)
+
+        # unstuck: the results are kept
+        self.release.set()
+        self.assertEqual(self.probes.probe("hang", "/cvmfs/stuck", 5), (True, True))
+        for _ in range(50):
+            if not self.probes._stuck:
+                break
+            time.sleep(0.1)
+        self.assertEqual(self.probes._stuck, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+"""Tests for the lazily decoded JSON (jsonTools)"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+sys.path.insert(0, os.getcwd() + "/Pilot")
+
+from jsonTools import LazyJSONObject
+
+
+class TestLazyJSONObject(unittest.TestCase):
+    def setUp(self):
+        self.testDir = tempfile.mkdtemp()
+        self.path = os.path.join(self.testDir, "pilot.json")
+        self.pilotJSON = {
+            "timestamp": "2024-01-31T12:34:56",
+            "Tricky": 'a "quoted" \\ {brace} [bracket]',
+            "CEs": {"ce%d" % i: {"Site": "Site{%d}" % i, "Queues": {"q": {"Tag": ["]", {}]}}} for i in range(50)},
+            "Empty": {},
+            "ConfigurationServers": ["dips://cs.example.org:9135"],
+            "Last": {"Value": -1.5e3, "Flag": True, "None": None},
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.testDir)
+
+    def load(self, **kwargs):
+        with open(self.path, "w") as fp:
+            json.dump(self.pilotJSON, fp, **kwargs)
+        return LazyJSONObject.load(self.path)
+
+    def toDict(self, value):
+        if isinstance(value, (dict, LazyJSONObject)):
+            return {key: self.toDict(value[key]) for key in value}
+        return value
+
+    def checkCopy(self, pilotJSON):
+        copy = pilotJSON.copy()
+        self.assertIs(type(copy), dict)
+        self.assertEqual(copy, self.pilotJSON)
+        # the copy can be modified, the object is not
+        copy["CEs"]["ce7"]["Site"] = "Changed"
+        del copy["Last"]
+        self.assertEqual(pilotJSON["CEs"]["ce7"]["Site"], "Site{7}")
+        self.assertIn("Last", pilotJSON)
+
+    def test_small(self):
+        # below the threshold: the same read-only mapping, of the file read at once
+        pilotJSON = self.load()
+        self.assertIsInstance(pilotJSON, LazyJSONObject)
+        self.assertEqual(pilotJSON["CEs"]["ce7"]["Site"], "Site{7}")
+        self.assertIs(type(pilotJSON["CEs"]), dict)
+        self.assertEqual(pilotJSON, self.pilotJSON)
+        self.checkCopy(pilotJSON)
+        with open(self.path, "w") as fp:
+            json.dump(["not", "an", "object"], fp)
+        self.assertEqual(LazyJSONObject.load(self.path), ["not", "an", "object"])
+
+    @patch.object(LazyJSONObject, "lazyThreshold", 100)
+    def test_lazy(self):
+        for kwargs in [{"indent": 2}, {"separators": (",", ":")}]:
+            pilotJSON = self.load(**kwargs)
+            self.assertIsInstance(pilotJSON, LazyJSONObject)
+            # only what is asked for is built, in any order
+            self.assertEqual(pilotJSON["CEs"]["ce7"]["Site"], "Site{7}")
+            self.assertIsInstance(pilotJSON["CEs"], LazyJSONObject)
+            self.assertEqual(pilotJSON["Last"], self.pilotJSON["Last"])
+            self.assertEqual(pilotJSON["Tricky"], self.pilotJSON["Tricky"])
+            self.assertNotIn("Missing", pilotJSON)
+            self.assertEqual(pilotJSON.get("Missing", "default"), "default")
+            with self.assertRaises(KeyError):
+                pilotJSON["CEs"]["ce50"]
+            self.assertEqual(len(pilotJSON["CEs"]), 50)
+            self.checkCopy(pilotJSON)
+            self.checkCopy(self.load(**kwargs))
+            with patch.object(LazyJSONObject, "lazyThreshold", 1):
+                self.assertEqual(self.toDict(self.load(**kwargs)), self.pilotJSON)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+"""Tests for the Machine/Job Features (mjfTools)"""
+
+import os
+import shutil
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest.mock import patch
+
+sys.path.insert(0, os.getcwd() + "/Pilot")
+
+from fileSystemTools import FileSystemProbe
+from mjfTools import MachineJobFeatures
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    """http.server.ThreadingHTTPServer, that is only in Python >= 3.7"""
+
+    daemon_threads = True
+
+
+class TestMachineJobFeatures(unittest.TestCase):
+    def setUp(self):
+        self.testDir = tempfile.mkdtemp()
+        self.jobFeatures = os.path.join(self.testDir, "job")
+        self.machineFeatures = os.path.join(self.testDir, "machine")
+        self.now = int(time.time())
+        self.keys = {
+            self.jobFeatures: {
+                "allocated_cpu": "4",
+                "cpu_limit_secs": "40000",
+                "wall_limit_secs": "20000",
+                "jobstart_secs": str(self.now - 1000),
+                "max_rss_bytes": "8589934592",
+                "job_id": "1234.ce.example.org",
+            },
+            self.machineFeatures: {"total_cpu": "32", "hs06": "320.5", "shutdowntime": str(self.now + 15000)},
+        }
+        for directory, keys in self.keys.items():
+            os.makedirs(directory)
+            for key, value in keys.items():
+                with open(os.path.join(directory, key), "w") as fp:
+                    fp.write(value + "\n")
+
+    def tearDown(self):
+        MachineJobFeatures.clear()
+        FileSystemProbe.clear()
+        shutil.rmtree(self.testDir)
+
+    def test_files(self):
+        mjf = MachineJobFeatures(self.jobFeatures, self.machineFeatures)
+        self.assertEqual(mjf.features["job_id"], "1234.ce.example.org")
+        self.assertEqual(mjf.features["hs06"], 320.5)
+        self.assertNotIn("db12", mjf.features)
+        self.assertEqual(mjf.processors, 4)
+        self.assertEqual(mjf.maxRAM, 8192)
+        self.assertAlmostEqual(mjf.hs06, 320.5 / 32)
+        self.assertEqual(mjf.shutdownTime, self.now + 15000)
+        # the CPU limit shared by the processors, minus what elapsed
+        self.assertAlmostEqual(mjf.cpuTimeLeft, 9000, delta=5)
+        # cached
+        os.remove(os.path.join(self.jobFeatures, "allocated_cpu"))
+        self.assertEqual(mjf.processors, 4)
+        mjf.read()
+        self.assertIsNone(mjf.processors)
+        # the wall-clock limit (19000 s left), capped by the shutdown time
+        self.assertAlmostEqual(mjf.cpuTimeLeft, 15000, delta=5)
+
+    def test_lock(self):
+        release = threading.Event()
+        probes = FileSystemProbe()
+        # a slow file system
+        probes.operations = dict(FileSystemProbe.operations, readHead=lambda path, size: release.wait(5) and b"1")
+        mjf = MachineJobFeatures(self.jobFeatures, timeout=5, probes=probes)
+        reader = threading.Thread(target=lambda: mjf.features)
+        reader.start()
+        time.sleep(0.2)
+        # the lock is not held while waiting for the keys
+        self.assertTrue(mjf._rlock.acquire(timeout=0.5))
+        mjf._rlock.release()
+        release.set()
+        reader.join(5)
+        self.assertEqual(mjf.processors, 1)
+
+    def test_none(self):
+        with patch.dict(os.environ):
+            os.environ.pop("JOBFEATURES", None)
+            os.environ.pop("MACHINEFEATURES", None)
+            mjf = MachineJobFeatures.get()
+        self.assertIs(MachineJobFeatures.get(), mjf)
+        self.assertEqual(mjf.features, {})
+        self.assertIsNone(mjf.processors)
+        self.assertIsNone(mjf.cpuTimeLeft)
+
+    def test_http(self):
+        keys = {"/job": self.keys[self.jobFeatures], "/slow": self.keys[self.machineFeatures]}
+
+        class MJFHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                directory, key = self.path.rsplit("/", 1)
+                if directory == "/slow":
+                    time.sleep(5)
+                value = keys.get(directory, {}).get(key)
+                if value is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(value.encode())
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("localhost", 0), MJFHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = "http://localhost:%d" % server.server_address[1]
+
+        start = time.time()
+        mjf = MachineJobFeatures(url + "/job", url + "/slow", timeout=1.5)
+        self.assertEqual(mjf.processors, 4)
+        self.assertEqual(mjf.features["wall_limit_secs"], 20000)
+        self.assertNotIn("max_swap_bytes", mjf.features)
+        # the machine features are too slow: missing
+        self.assertNotIn("hs06", mjf.features)
+        self.assertLess(time.time() - start, 4)
+        # read by the workers of the probe service, not by a thread per key
+        self.assertLessEqual(mjf.probes._workers - mjf.probes._stuck, FileSystemProbe.maxWorkers)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,209 @@
+"""Tests for the tools in pilotTools (not related to the pilot logger)"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest.mock import MagicMock
+
+sys.path.insert(0, os.getcwd() + "/Pilot")
+
+from pilotTools import LogFile, Logger, RemoteLogger, retrieveUrlTimeout
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    """http.server.ThreadingHTTPServer, that is only in Python >= 3.7"""
+
+    daemon_threads = True
+
+
+class TestLogger(unittest.TestCase):
+    def setUp(self):
+        self.testDir = tempfile.mkdtemp()
+        self.logFile = os.path.join(self.testDir, "pilot.out")
+
+    def tearDown(self):
+        LogFile.setFlushPolicy("line")
+        LogFile.closeAll()
+        shutil.rmtree(self.testDir)
+
+    def read(self):
+        with open(self.logFile) as fd:
+            return fd.read()
+
+    def test_format(self):
+        Logger("Pilot", pilotOutput=self.logFile).info("first\nsecond")
+        Logger("CheckWorkerNode", pilotOutput=self.logFile).error("third", header=False)
+        lines = self.read().split("\n")
+        for line, name in [(lines[0], "first"), (lines[1], "second")]:
+            self.assertRegex(line, r"^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\.\d{6}Z INFO \[Pilot\] %s$" % name)
+        self.assertEqual(lines[2:], ["third", ""])
+        self.assertEqual(len(LogFile._files), 1)
+        self.assertEqual(Logger.datestamp(86400.5), "1970-01-02T00:00:00.500000Z")
+        message = Logger().messageTemplate.format(level="DEBUG", message="x")
+        self.assertTrue(re.match(r"\S+Z DEBUG \[Pilot\] x$", message))
+
+    def test_structured(self):
+        sidecar = os.path.join(self.testDir, "pilot.ndjson")
+        Logger.setStructured("uuid", sidecar)
+        try:
+            Logger("CheckWorkerNode", pilotOutput=self.logFile).info("first\nsecond")
+            buffer = MagicMock()
+            remote = RemoteLogger("https://localhost", "Pilot", pilotUUID="uuid", flushInterval=0, buffer=buffer)
+            remote.debugFlag = True
+            remote.debug("remote")
+            remote.write("out1\nout2\n")
+        finally:
+            Logger.structured, Logger.sidecar, Logger.pilotUUID = False, None, "unknown"
+            LogFile.flushAll()
+        # the text log is unchanged
+        self.assertIn("INFO [CheckWorkerNode] first", self.read())
+        with open(sidecar) as fd:
+            records = [json.loads(line) for line in fd]
+        self.assertEqual(records[0]["msg"], "first\nsecond")
+        self.assertEqual(records[0]["level"], "INFO")
+        self.assertEqual(records[0]["command"], "CheckWorkerNode")
+        self.assertEqual(records[0]["pilotUUID"], "uuid")
+        self.assertRegex(records[0]["ts"], r"^\S+Z$")
+        self.assertEqual(records[1]["msg"], "remote")
+        # the remote batches are NDJSON
+        sent = "".join(call[0][0] for call in buffer.write.call_args_list)
+        records = [json.loads(line) for line in sent.splitlines()]
+        self.assertEqual(
+            [(record["level"], record["msg"]) for record in records],
+            [("DEBUG", "remote"), ("OUTPUT", "out1"), ("OUTPUT", "out2")],
+        )
+
+    def test_flushPolicy(self):
+        LogFile.setFlushPolicy("exit")
+        log = Logger("Pilot", pilotOutput=self.logFile)
+        log.info("buffered")
+        self.assertEqual(self.read(), "")
+        LogFile.flushAll()
+        self.assertIn("buffered", self.read())
+
+        LogFile.setFlushPolicy("0.1")
+        log.info("periodic")
+        time.sleep(0.5)
+        self.assertIn("periodic", self.read())
+
+        with self.assertRaises(ValueError):
+            LogFile.setFlushPolicy("sometimes")
+
+        # a removed file is re-created (checked once per second)
+        LogFile.setFlushPolicy("line")
+        os.remove(self.logFile)
+        LogFile.get(self.logFile)._checkedAt = None
+        log.info("again")
+        self.assertIn("again", self.read())
+
+
+class DownloadHandler(BaseHTTPRequestHandler):
+    """Stand-in for a download server, with Range support, that can drop connections"""
+
+    protocol_version = "HTTP/1.1"
+    content = bytes(range(256)) * 40000
+    # connections dropped after that many bytes, in turn
+    drops = []
+    ranges = True
+    # without Content-Length: the end of the content is when the connection is closed
+    length = True
+    requests = []
+
+    def do_GET(self):
+        if self.path != "/installer.sh":
+            self.send_error(404)
+            return
+        start = 0
+        rangeHeader = self.headers.get("Range")
+        self.requests.append(rangeHeader)
+        if rangeHeader and self.ranges:
+            start = int(rangeHeader.split("=")[1].rstrip("-"))
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, len(self.content) - 1, len(self.content)))
+        else:
+            self.send_response(200)
+        if self.length:
+            self.send_header("Content-Length", str(len(self.content) - start))
+        else:
+            self.close_connection = True
+        self.end_headers()
+        body = self.content[start:]
+        if self.drops:
+            body = body[: self.drops.pop(0)]
+            self.close_connection = True
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestRetrieveUrl(unittest.TestCase):
+    def setUp(self):
+        self.testDir = tempfile.mkdtemp()
+        self.fileName = os.path.join(self.testDir, "installer.sh")
+        self.server = ThreadingHTTPServer(("localhost", 0), DownloadHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://localhost:%d/installer.sh" % self.server.server_address[1]
+        self.sha256 = hashlib.sha256(DownloadHandler.content).hexdigest()
+        self.log = MagicMock()
+        DownloadHandler.drops = []
+        DownloadHandler.ranges = True
+        DownloadHandler.length = True
+        DownloadHandler.requests = []
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.testDir)
+
+    def test_download(self):
+        self.assertTrue(retrieveUrlTimeout(self.url, self.fileName, self.log, sha256=self.sha256))
+        with open(self.fileName, "rb") as fp:
+            self.assertEqual(fp.read(), DownloadHandler.content)
+        self.assertEqual(os.listdir(self.testDir), ["installer.sh"])
+        self.assertEqual(retrieveUrlTimeout(self.url, None, self.log), DownloadHandler.content)
+
+        self.assertFalse(retrieveUrlTimeout(self.url + ".missing", self.fileName + ".missing", self.log))
+        # wrong checksum: nothing left behind
+        self.assertFalse(retrieveUrlTimeout(self.url, self.fileName + ".bad", self.log, sha256="0" * 64))
+        self.assertEqual(os.listdir(self.testDir), ["installer.sh"])
+
+    def test_resume(self):
+        DownloadHandler.drops = [3000000, 5000000]
+        self.assertTrue(retrieveUrlTimeout(self.url, self.fileName, self.log, sha256=self.sha256))
+        with open(self.fileName, "rb") as fp:
+            self.assertEqual(fp.read(), DownloadHandler.content)
+        self.assertEqual(DownloadHandler.requests, [None, "bytes=3000000-", "bytes=8000000-"])
+
+        # no Range support: from the start again
+        DownloadHandler.drops = [3000000]
+        DownloadHandler.ranges = False
+        self.assertTrue(retrieveUrlTimeout(self.url, self.fileName, self.log, sha256=self.sha256))
+
+        # too many failures in a row (without progress)
+        DownloadHandler.drops = [0] * 3
+        self.assertFalse(retrieveUrlTimeout(self.url, self.fileName + ".new", self.log, retries=2))
+        self.assertNotIn("installer.sh.new.part", os.listdir(self.testDir))
+
+    def test_unknownLength(self):
+        DownloadHandler.length = False
+        # verified by its checksum only
+        self.assertTrue(retrieveUrlTimeout(self.url, self.fileName, self.log, sha256=self.sha256))
+        self.assertFalse(retrieveUrlTimeout(self.url, self.fileName + ".new", self.log))
+        # closed early: not taken for the end of the content
+        DownloadHandler.drops = [3000000]
+        self.assertFalse(retrieveUrlTimeout(self.url, self.fileName + ".new", self.log, sha256=self.sha256))
+        self.assertEqual(os.listdir(self.testDir), ["installer.sh"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+"""Tests for the execution and the timing of the processes (processTools)"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.getcwd() + "/Pilot")
+
+from processTools import OutputCapture, ProcessEngine, TimingReport, waitForProcess
+
+
+class TestTimingReport(unittest.TestCase):
+    def setUp(self):
+        self.testDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.testDir)
+
+    def test_measure(self):
+        reportFile = os.path.join(self.testDir, "pilot.timing.json")
+        timing = TimingReport(reportFile)
+        timing.info = {"ceName": "ce.example.com"}
+
+        with timing.measure("CheckWorkerNode"):
+            process = subprocess.Popen("exit 3", shell=True)
+            returnCode, rusage = waitForProcess(process)
+            self.assertEqual(returnCode, 3)
+            self.assertEqual(process.returncode, 3)
+            timing.addSubprocess("CheckWorkerNode", "exit 3", 0.1, rusage, returnCode)
+        with self.assertRaises(SystemExit):
+            with timing.measure("LaunchAgent"):
+                sys.exit(0)
+
+        with open(reportFile) as fd:
+            report = json.load(fd)
+        self.assertEqual(report["ceName"], "ce.example.com")
+        self.assertEqual([record["name"] for record in report["commands"]], ["CheckWorkerNode", "LaunchAgent"])
+        record = report["commands"][0]
+        for key in ["start", "wallTime", "userCPU", "systemCPU", "maxRSS"]:
+            self.assertGreaterEqual(record[key], 0)
+        self.assertEqual(record["subprocesses"][0]["returnCode"], 3)
+        self.assertIn("maxRSS", record["subprocesses"][0])
+        self.assertEqual([name for name, _wallTime in timing.summary()["commands"]], ["CheckWorkerNode", "LaunchAgent"])
+
+
+class TestOutputCapture(unittest.TestCase):
+    chunks = ["first line\nsecond", " line\n", "\n", "{\"Tag\": [\"GPU\"]}", "\n\n"]
+
+    def capture(self, policy):
+        output = OutputCapture(policy)
+        for chunk in self.chunks:
+            output.write(chunk)
+        return output.getValue()
+
+    def test_policies(self):
+        self.assertEqual(self.capture("full"), "".join(self.chunks))
+        self.assertEqual(self.capture("none"), "")
+        self.assertEqual(self.capture("lastLine"), '{"Tag": ["GPU"]}')
+        self.assertEqual(self.capture(3), '\n{"Tag": ["GPU"]}\n')
+        self.assertEqual(self.capture(100), "".join(self.chunks)[:-1])
+
+        # an incomplete last line is kept too
+        output = OutputCapture(2)
+        for chunk in ["a\nb\nc\n", "d"]:
+            output.write(chunk)
+        self.assertEqual(output.getValue(), "c\nd")
+        output = OutputCapture("lastLine")
+        output.write("8 16000\n  ")
+        self.assertEqual(output.getValue(), "8 16000")
+
+        for policy in ["tail", 0, True]:
+            with self.assertRaises(ValueError):
+                OutputCapture(policy)
+
+
+class TestProcessEngine(unittest.TestCase):
+    class ListSink(object):
+        def __init__(self):
+            self.chunks = []
+            self.flushed = False
+
+        def write(self, streamName, text):
+            self.chunks.append((streamName, text))
+
+        def flush(self):
+            self.flushed = True
+
+    def test_run(self):
+        engine = ProcessEngine()
+        sink = self.ListSink()
+        start = time.time()
+        first = engine.submit("sleep 1; echo first; echo oops >&2", sinks=[sink])
+        second = engine.submit("sleep 1; printf 'h\\303'; sleep 0.1; printf '\\251llo\\n'; exit 4", capture="lastLine")
+        self.assertEqual(engine.run(), [first, second])
+        # both at the same time
+        self.assertLess(time.time() - start, 1.9)
+        self.assertEqual((first.returnCode, first.output.getValue()), (0, "first\n"))
+        self.assertEqual(sorted(sink.chunks), [("stderr", "oops\n"), ("stdout", "first\n")])
+        self.assertTrue(sink.flushed)
+        self.assertEqual((second.returnCode, second.output.getValue()), (4, "h\u00e9llo"))
+        self.assertIsNotNone(second.rusage)
+
+    def test_timeout(self):
+        engine = ProcessEngine(maxParallel=1)
+        engine.killGracePeriod = 1
+        # the background sleep keeps the pipes open, it is killed with its process group
+        hanging = engine.submit("sleep 30 & echo started; trap '' TERM; sleep 30", timeout=0.5)
+        quick = engine.submit("echo done", timeout=10)
+        start = time.time()
+        engine.run()
+        self.assertLess(time.time() - start, 5)
+        self.assertTrue(hanging.timedOut)
+        self.assertEqual(hanging.returnCode, -9)
+        self.assertEqual(hanging.output.getValue(), "started\n")
+        self.assertFalse(quick.timedOut)
+        self.assertEqual((quick.returnCode, quick.output.getValue()), (0, "done\n"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,12 +1,48 @@
 import os
 import shutil
+from base64 import b64encode
 import sys
 import unittest
 from unittest.mock import patch
 
 sys.path.insert(0, os.getcwd() + "/Pilot")
 
-from proxyTools import getVO, parseASN1
+from proxyTools import (
+    VOMS_EXTENSION_OID,
+    VOMS_FQANS_OID,
+    encodeOID,
+    getVO,
+    getVOWithOpenSSL,
+    parseASN1,
+    parseDER,
+)
+
+
+def der(tag, *contents):
+    """A DER element"""
+    content = b"".join(contents)
+    length = len(content)
+    if length < 0x80:
+        return bytes([tag, length]) + content
+    nbytes = (length.bit_length() + 7) // 8
+    return bytes([tag, 0x80 | nbytes]) + length.to_bytes(nbytes, "big") + content
+
+
+def syntheticProxy(fqans):
+    """A PEM certificate with just enough structure: a VOMS extension with these FQANs (if any)"""
+    extensions = [der(0x30, der(0x06, encodeOID(b"2.5.29.19")), der(0x04, der(0x30)))]
+    if fqans:
+        attribute = der(
+            0x30,
+            der(0x06, encodeOID(VOMS_FQANS_OID)),
+            der(0x31, der(0x30, der(0xA0, b"\x86\x05voms:"), der(0x30, *[der(0x04, fqan) for fqan in fqans]))),
+        )
+        ac = der(0x30, der(0x30, der(0x02, b"\x01"), der(0x30, attribute)), der(0x03, b"\x00" + b"s" * 200))
+        extensions.append(der(0x30, der(0x06, encodeOID(VOMS_EXTENSION_OID)), der(0x04, der(0x30, der(0x30, ac)))))
+    tbs = der(0x30, der(0xA0, der(0x02, b"\x02")), der(0x02, b"\x2a"), der(0xA3, der(0x30, *extensions)))
+    data = b64encode(der(0x30, tbs, der(0x30), der(0x03, b"\x00sig")))
+    lines = [data[i : i + 64] for i in range(0, len(data), 64)]
+    return b"-----BEGIN CERTIFICATE-----\n" + b"\n".join(lines) + b"\n-----END CERTIFICATE-----\n"
 
 
 class TestProxyTools(unittest.TestCase):
@@ -36,7 +72,7 @@ class TestProxyTools(unittest.TestCase):
             data = fp.read()
         os.remove(cert)
         with self.assertRaises(Exception) as exc:
-            getVO(data)
+            getVOWithOpenSSL(data)
 
         self.assertEqual(str(exc.exception), msg)
 
@@ -45,8 +81,60 @@ class TestProxyTools(unittest.TestCase):
         msg = "command not found: openssl"
         popenMock.side_effect = OSError(msg)
         with self.assertRaises(OSError) as exc:
-            getVO(data)
+            getVOWithOpenSSL(data)
         self.assertEqual(str(exc.exception), msg)
+        # the certificates are decoded without openssl
+        self.assertEqual(getVO(data), "fakevo")
+
+    @patch("proxyTools.Popen")
+    def test_getVOSynthetic(self, popenMock):
+        """The VO of synthetic proxies, found without starting openssl"""
+        popenMock.side_effect = OSError("command not found: openssl")
+        plain = syntheticProxy([])
+        voms = syntheticProxy([b"/othervo", b"/somevo/Role=NULL/Capability=NULL"])
+        self.assertEqual(getVO(plain + voms + plain), "somevo")
+        with self.assertRaises(NotImplementedError):
+            getVO(plain + plain)
+        with self.assertRaises(NotImplementedError):
+            getVO(syntheticProxy([b"/novo"]))
+
+    @patch("proxyTools.getVOWithOpenSSL")
+    def test_getVOFallback(self, openSSLMock):
+        """openssl decodes what parseDER can't"""
+        openSSLMock.return_value = "fakevo"
+        # indefinite length (BER)
+        data = b64encode(b"\x30\x80\x02\x01\x01\x00\x00")
+        data = b"-----BEGIN CERTIFICATE-----\n" + data + b"\n-----END CERTIFICATE-----"
+        self.assertEqual(getVO(data), "fakevo")
+        openSSLMock.assert_called_once_with(data)
+        # no PEM certificate found
+        openSSLMock.reset_mock()
+        self.assertEqual(getVO(b"not a certificate"), "fakevo")
+        openSSLMock.assert_called_once_with(b"not a certificate")
+
+    @patch("proxyTools.Popen")
+    def test_getVOWindowsLineEnds(self, popenMock):
+        """PEM files with "\\r\\n" line ends"""
+        popenMock.side_effect = OSError("command not found: openssl")
+        plain = syntheticProxy([]).replace(b"\n", b"\r\n")
+        voms = syntheticProxy([b"/somevo/Role=NULL/Capability=NULL"]).replace(b"\n", b"\r\n")
+        self.assertEqual(getVO(plain + voms), "somevo")
+
+    def test_parseDER(self):
+        self.assertEqual(
+            parseDER(der(0x30, der(0x02, b"\x01"), der(0x30, der(0x04, b"x" * 200)), der(0x05))),
+            [
+                (0, 0x30, der(0x02, b"\x01") + der(0x30, der(0x04, b"x" * 200)) + der(0x05)),
+                (1, 0x02, b"\x01"),
+                (1, 0x30, der(0x04, b"x" * 200)),
+                (2, 0x04, b"x" * 200),
+                (1, 0x05, b""),
+            ],
+        )
+        self.assertEqual(encodeOID(b"1.2.840.113549"), bytes.fromhex("2a864886f70d"))
+        for data in [b"\x30\x05\x02\x01", b"\x04", b"\x30\x03\x04\x05xx"]:
+            with self.assertRaises(ValueError):
+                parseDER(data)
 
     @patch("proxyTools.Popen")
     def test_parseASN1Fails(self, popenMock):
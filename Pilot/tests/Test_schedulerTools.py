@@ -0,0 +1,116 @@
+"""Tests for the pilot commands scheduler (schedulerTools)"""
+
+import os
+import sys
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+
+sys.path.insert(0, os.getcwd() + "/Pilot")
+
+from schedulerTools import CommandScheduler
+
+
+class TestCommandScheduler(unittest.TestCase):
+    commands = [
+        "CheckWorkerNode",
+        "InstallDIRAC",
+        "ConfigureBasics",
+        "RegisterPilot",
+        "CheckCECapabilities",
+        "CheckWNCapabilities",
+        "ConfigureSite",
+        "ConfigureArchitecture",
+        "ConfigureCPURequirements",
+        "LaunchAgent",
+    ]
+
+    def test_dependencies(self):
+        pp = MagicMock(commands=self.commands, commandExtensions=[])
+        deps = dict(zip(self.commands, CommandScheduler(pp).dependencies))
+        self.assertEqual(deps["CheckWorkerNode"], set())
+        self.assertEqual(deps["InstallDIRAC"], set())
+        self.assertEqual(deps["ConfigureBasics"], {1})
+        self.assertEqual(deps["RegisterPilot"], {1, 2})
+        # pilot.cfg is rewritten in place: its readers and its writers do not overlap
+        self.assertEqual(deps["CheckCECapabilities"], {1, 2, 3})
+        self.assertEqual(deps["CheckWNCapabilities"], {1, 2, 3, 4})
+        self.assertEqual(deps["ConfigureSite"], {2, 3, 4, 5})
+        self.assertEqual(deps["ConfigureArchitecture"], {1, 2, 3, 4, 5, 6})
+        self.assertEqual(deps["ConfigureCPURequirements"], {1, 2, 3, 4, 5, 6, 7})
+        # not declared: waits for everything
+        self.assertEqual(deps["LaunchAgent"], set(range(9)))
+
+        # unknown commands run in order
+        pp.commands = ["CheckWorkerNode", "NotACommand", "InstallDIRAC"]
+        self.assertEqual(CommandScheduler(pp).dependencies, [set(), {0}, {1}])
+
+    def test_run(self):
+        pp = MagicMock(commands=self.commands, commandExtensions=[])
+        executed = []
+        overlap = threading.Event()
+        installing = threading.Event()
+
+        def runCommand(index, commandName):
+            if commandName == "InstallDIRAC":
+                installing.set()
+                # CheckWorkerNode does not wait for InstallDIRAC
+                overlap.wait(5)
+            elif commandName == "CheckWorkerNode":
+                if installing.wait(5):
+                    overlap.set()
+            executed.append(commandName)
+            if commandName == "LaunchAgent":
+                raise SystemExit(0)
+
+        scheduler = CommandScheduler(pp, maxWorkers=4)
+        with self.assertRaises(SystemExit):
+            scheduler.run(runCommand)
+        self.assertTrue(overlap.is_set())
+        self.assertEqual(sorted(executed), sorted(self.commands))
+        for index, commandName in enumerate(self.commands):
+            for dep in scheduler.dependencies[index]:
+                self.assertLess(executed.index(self.commands[dep]), executed.index(commandName))
+
+        # one worker: the command list order
+        executed = []
+        overlap.set()
+        with self.assertRaises(SystemExit):
+            CommandScheduler(pp, maxWorkers=1).run(runCommand)
+        self.assertEqual(executed, self.commands)
+
+    def test_exit(self):
+        pp = MagicMock(commands=self.commands[:2], commandExtensions=[])
+        installed = threading.Event()
+
+        def runCommand(index, commandName):
+            if commandName == "CheckWorkerNode":
+                raise SystemExit(1)
+            time.sleep(0.5)
+            installed.set()
+
+        # the running commands end before the exit
+        with self.assertRaises(SystemExit):
+            CommandScheduler(pp, maxWorkers=4).run(runCommand)
+        self.assertTrue(installed.is_set())
+
+    def test_beforePayloads(self):
+        # a command of an extension, running alone (not declaring its resources), is not LaunchAgent
+        commands = ["NotACommand"] + self.commands
+        pp = MagicMock(commands=commands, commandExtensions=[])
+        for maxWorkers in (1, 4):
+            executed = []
+            calls = []
+
+            def beforePayloads(index, commandName):
+                # e.g. the CVMFS warm-up stops: after all the previous commands, before LaunchAgent
+                calls.append((commandName, sorted(executed)))
+
+            CommandScheduler(pp, maxWorkers=maxWorkers).run(lambda i, name: executed.append(name), beforePayloads)
+            self.assertEqual(calls, [("LaunchAgent", sorted(commands[:-1]))])
+            self.assertEqual(executed[-1], "LaunchAgent")
+
+
+if __name__ == "__main__":
+    unittest.main()
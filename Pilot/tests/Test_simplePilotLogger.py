@@ -1,17 +1,22 @@
 #!/usr/bin/env python
 
+import copy
 import json
 import os
 import random
+import shutil
 import string
 import sys
 import tempfile
+import threading
+import time
 import unittest
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
 sys.path.insert(0, os.getcwd() + "/Pilot")
 
-from pilotTools import CommandBase, Logger, PilotParams
+from pilotTools import CommandBase, FixedSizeBuffer, Logger, OptionIndex, PilotParams
+from remoteLogTools import BatchSender, RemoteLogSpooler
 
 
 class TestPilotParams(unittest.TestCase):
@@ -33,11 +38,87 @@ class TestPilotParams(unittest.TestCase):
         pp = PilotParams()
 
         argvmock.__getitem__.assert_called()
-        self.assertEqual(argvmock.__getitem__.call_count, 2)  # 2 getopt calls
+        self.assertEqual(argvmock.__getitem__.call_count, 1)  # 1 getopt call
         self.assertTrue(pp.pilotLogging)
         self.assertEqual(pp.loggerURL, "dummyURL")
         self.assertTrue(pp.debugFlag)
 
+    @patch("platform.uname", side_effect=AssertionError("platform.uname() called"))
+    @patch("sys.argv")
+    def test_pilotParamsPlatform(self, argvmock, unameMock):
+        # platform.uname() may run a subprocess (that tests mock): the arch is known at import
+        argvmock.__getitem__.return_value = ["-z", "-d", "-g", "dummyURL", "-F", "tests/pilot.json"]
+        for var in ["X509_CERT_DIR", "X509_VOMS_DIR", "X509_VOMSES", "X509_USER_PROXY"]:
+            os.environ[var] = os.getcwd()
+        pp = PilotParams()
+
+        arch = "%s-%s" % (os.uname().sysname, os.uname().machine)
+        self.assertEqual(pp.preinstalledEnvSubPath.split(os.sep)[-2], arch)
+        unameMock.assert_not_called()
+
+    @patch("sys.argv")
+    def test_optionTable(self, argvmock):
+        argvmock.__getitem__.return_value = [
+            "-F",
+            "tests/pilot.json",
+            "--Name=myCE",
+            "-t",
+            "tag1",
+            "--tag",
+            "tag2",
+            "-Z",
+            "a=1, b = 2",
+            "-r",
+            "v8.0.1,v8.0.0",
+            "-D",
+            "notANumber",
+            "--maxParallelCommands=2",
+            "-k",
+            "--myExtensionOption=value",
+        ]
+        os.environ["X509_CERT_DIR"] = os.getcwd()
+        os.environ["X509_VOMS_DIR"] = os.getcwd()
+        os.environ["X509_VOMSES"] = os.getcwd()
+        os.environ["X509_USER_PROXY"] = os.getcwd()
+        PilotParams.registerOption("", "myExtensionOption=", "An option of an extension", "myExtensionOption")
+        try:
+            with self.assertRaises(ValueError):
+                PilotParams.registerOption("d", "dryRun", "Already used short option", "dryRun")
+            pp = PilotParams()
+        finally:
+            PilotParams.options.pop()
+
+        self.assertEqual(pp.ceName, "myCE")
+        self.assertEqual(pp.tags, ["tag1", "tag2"])
+        self.assertEqual(pp.commandOptions, {"a": "1", "b": "2"})
+        self.assertEqual(pp.releaseVersion, "v8.0.1")
+        # invalid values are ignored
+        self.assertEqual(pp.minDiskSpace, 2560)
+        self.assertEqual(pp.maxParallelCommands, 2)
+        self.assertTrue(pp.keepPythonPath)
+        self.assertEqual(getattr(pp, "myExtensionOption"), "value")
+        self.assertEqual(pp.optList[1], ("--Name", "myCE"))
+        self.assertEqual(len(pp.cmdOpts), len(PilotParams.options))
+
+    @patch("sys.argv")
+    def test_compatibleOptions(self, argvmock):
+        """The flags behave as they did with the previous parser"""
+        for var in ["X509_CERT_DIR", "X509_VOMS_DIR", "X509_VOMSES", "X509_USER_PROXY"]:
+            os.environ[var] = os.getcwd()
+        argvmock.__getitem__.return_value = ["-F", "tests/pilot.json", "-K", "/ignored", "-M", "many"]
+        pp = PilotParams()
+        # -K was never used, an invalid number of cycles is ignored
+        self.assertEqual(pp.certsLocation, "%s/etc/grid-security" % pp.workingDir)
+        self.assertEqual(pp.maxCycles, 10)
+
+        argvmock.__getitem__.return_value = ["-F", "tests/pilot.json", "--certLocation", "/certs"]
+        self.assertEqual(PilotParams().certsLocation, "/certs")
+
+        # an invalid number of processors stops the pilot
+        argvmock.__getitem__.return_value = ["-F", "tests/pilot.json", "-m", "many"]
+        with self.assertRaises(ValueError):
+            PilotParams()
+
     def test_getOptionForPaths(self):
         """Test option preference by path (later paths have higher preference)"""
 
@@ -54,13 +135,38 @@ class TestPilotParams(unittest.TestCase):
         ]
         with open(jsonFile, "r") as fp:
             jsonDict = json.load(fp)
+        original = copy.deepcopy(jsonDict)
         res = PilotParams.getOptionForPaths(paths, jsonDict)
+        # the missing sections are not added
+        self.assertEqual(jsonDict, original)
         self.assertEqual(res["RemoteLogging"], "False")
         self.assertEqual(res["UploadSE"], "UKI-LT2-IC-HEP-disk")
         del jsonDict[vo]["Pilot"]["RemoteLogging"]  # remove a vo-specific settings, a default value is False:
         res = PilotParams.getOptionForPaths(paths, jsonDict)
         self.assertEqual(res["RemoteLogging"], "False")
 
+    def test_optionIndex(self):
+        """The section comes first, then the order of the options"""
+        jsonDict = {
+            "Defaults": {"Commands": {"Defaults": "a"}},
+            "Setups": {
+                "Defaults": {"Commands": {"CREAM": "b, c"}, "Version": "v1,v0", "NagiosProbes": ["n"]},
+                "MySetup": {"Commands": {"Defaults": ["d"]}, "Version": "v2"},
+            },
+        }
+        index = OptionIndex(jsonDict, ["/Defaults", "/Setups/Defaults", "/Setups/MySetup", "/Setups/Missing"])
+        self.assertEqual(index.getList(["Commands/CREAM", "Commands/Defaults"]), ["d"])
+        self.assertEqual(index.lookup(["Commands/HTCondorCE", "Commands/Defaults"]), ("Commands/Defaults", ["d"]))
+        index = OptionIndex(jsonDict, ["/Defaults", "/Setups/Defaults"])
+        self.assertEqual(index.getList(["Commands/CREAM", "Commands/Defaults"]), ["b", "c"])
+        self.assertEqual(index.getList(["Commands/ARC", "Commands/Defaults"]), ["a"])
+        self.assertEqual(index.get("Version"), "v1,v0")
+        self.assertEqual(index.getList("NagiosProbes"), ["n"])
+        self.assertIsNone(index.get("Project"))
+        self.assertEqual(index.get("Project", "DIRAC"), "DIRAC")
+        self.assertEqual(set(index.asDict()), {"Commands", "Version", "NagiosProbes"})
+        self.assertNotIn("Missing", jsonDict["Setups"])
+
     @patch.object(PilotParams, "_PilotParams__getSearchPaths")
     @patch("sys.argv")
     def test_pilotOptions(self, argvmock, mockPaths):
@@ -106,6 +212,48 @@ class TestPilotParams(unittest.TestCase):
         self.assertEqual(", ".join(pp.commands), lTESTcommands)
         self.assertEqual(pp.releaseVersion, "VAR_DIRAC_VERSION")
 
+    @patch("sys.argv")
+    def test_compiledConfig(self, argvmock):
+        testDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, testDir)
+        jsonFile = os.path.join(testDir, "pilot.json")
+        shutil.copy(os.path.join(os.path.dirname(__file__), "../../tests/CI/pilot_newSchema.json"), jsonFile)
+        for var in ["X509_CERT_DIR", "X509_VOMS_DIR", "X509_VOMSES", "X509_USER_PROXY"]:
+            os.environ[var] = os.getcwd()
+        args = ["-F", jsonFile, "-N", "TEST_type_CE", "--gridCEType", "TEST", "--wnVO", "gridpp"]
+        argvmock.__getitem__.return_value = args
+        expected = PilotParams()
+
+        argvmock.__getitem__.return_value = args + ["--compileConfig"]
+        self.assertEqual(PilotParams().writeCompiledConfig(), jsonFile + ".compiled")
+
+        # pilot.json is not parsed
+        argvmock.__getitem__.return_value = args
+        with patch.object(PilotParams, "_PilotParams__loadJSON", side_effect=AssertionError) as loadMock:
+            pp = PilotParams()
+        loadMock.assert_not_called()
+        for name in PilotParams.compiledParams:
+            self.assertEqual(getattr(pp, name), getattr(expected, name), name)
+        self.assertEqual(pp.jsonOptions.flatten(), expected.jsonOptions.flatten())
+        self.assertEqual(pp.commands, expected.commands)
+        # but it can still be read
+        self.assertEqual(pp.pilotJSON, expected.pilotJSON)
+
+        # another queue, or a new pilot.json: the compiled configuration is not used
+        for newArgs in [args + ["-Q", "otherQueue"], ["-S", "Other"] + args]:
+            argvmock.__getitem__.return_value = newArgs
+            with patch.object(PilotParams, "_PilotParams__initJSON2") as initMock:
+                PilotParams()
+            initMock.assert_called_once()
+        with open(jsonFile) as fp:
+            content = fp.read().replace("2023-02-13T14:34:26.725499", "2023-02-14T09:00:00.000000")
+        with open(jsonFile, "w") as fp:
+            fp.write(content)
+        argvmock.__getitem__.return_value = args
+        with patch.object(PilotParams, "_PilotParams__initJSON2") as initMock:
+            PilotParams()
+        initMock.assert_called_once()
+
 
 class TestCommandBase(unittest.TestCase):
     def setUp(self):
@@ -121,6 +269,29 @@ class TestCommandBase(unittest.TestCase):
         os.remove(self.stdout_mock.name)
         os.remove(self.stderr_mock.name)
 
+    @patch("sys.argv")
+    def test_remoteLogPipeline(self, argvmock):
+        for var in ["X509_CERT_DIR", "X509_VOMS_DIR", "X509_VOMSES", "X509_USER_PROXY"]:
+            os.environ[var] = os.getcwd()
+        argvmock.__getitem__.return_value = ["-z", "-g", "dummyURL", "-F", "tests/pilot.json"]
+        pp = PilotParams()
+        pp.loggerTimerInterval = 60
+        timers = threading.active_count()
+
+        commands = [CommandBase(pp), CommandBase(pp)]
+        # one buffer, and one flush timer, for all the commands
+        self.assertIs(commands[0].log.buffer, commands[1].log.buffer)
+        self.assertIs(commands[0].log.buffer, pp.logPipeline)
+        self.assertEqual(threading.active_count(), timers + 1)
+        pp.logPipeline.sender.senderFunc = MagicMock()
+        try:
+            commands[0].log.info("from the first command")
+            self.assertIn("INFO [CommandBase] from the first command\n", pp.logPipeline.getValue())
+            pp.logPipeline.flush()
+            pp.logPipeline.sender.senderFunc.assert_called_once()
+        finally:
+            pp.logPipeline.cancelTimer()
+
     @patch(("sys.argv"))
     @patch("subprocess.Popen")
     def test_executeAndGetOutput(self, popenMock, argvmock):
@@ -159,5 +330,205 @@ class TestCommandBase(unittest.TestCase):
             self.stderr_mock.truncate()
 
 
+class TestFixedSizeBuffer(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.unblock = threading.Event()
+
+    def slowSender(self, message):
+        # an unreachable server
+        self.unblock.wait(10)
+        self.sent.append(message)
+
+    @staticmethod
+    def waitForSending(sender):
+        for _ in range(100):
+            if sender._sending:
+                return
+            time.sleep(0.05)
+
+    def test_nonBlockingWrite(self):
+        buf = FixedSizeBuffer(self.slowSender, bufsize=2, autoflush=0, maxBatches=2, overflowPolicy="dropOldest")
+        start = time.time()
+        for i in range(10):
+            buf.write("line %d\n" % i)
+            if i == 1:
+                self.waitForSending(buf.sender)
+        # the writer did not wait for the server
+        self.assertLess(time.time() - start, 1)
+        counters = buf.sender.counters
+        # one batch being sent, two waiting, the others dropped
+        self.assertEqual(counters["waiting"], 4)
+        self.assertEqual(counters["dropped"], 4)
+        self.unblock.set()
+        buf.flush()
+        self.assertEqual(self.sent, ["line 0\nline 1\n", "line 6\nline 7\n", "line 8\nline 9\n"])
+        self.assertEqual(buf.sender.counters, {"queued": 10, "sent": 6, "dropped": 4, "failed": 0, "waiting": 0})
+
+    def test_flushPolicy(self):
+        self.unblock.set()
+        buf = FixedSizeBuffer(self.slowSender, bufsize=100, autoflush=0, maxBytes=50, maxLatency=0.3)
+        # one "line", but too many characters
+        buf.write("x" * 60)
+        self.assertTrue(buf.sender.drain(5))
+        self.assertEqual(self.sent, ["x" * 60])
+
+        # a record does not wait more than maxLatency
+        buf.write("short\n")
+        time.sleep(1)
+        self.assertEqual(self.sent[-1], "short\n")
+        # the deadlines are handled by the sender thread, not by a timer per batch
+        for i in range(3):
+            buf.write("batch %d\n" % i)
+            self.assertEqual([thread for thread in threading.enumerate() if isinstance(thread, threading.Timer)], [])
+            time.sleep(0.5)
+        self.assertEqual(self.sent[-3:], ["batch 0\n", "batch 1\n", "batch 2\n"])
+        buf.cancelTimer()
+
+        buf = FixedSizeBuffer(self.slowSender, bufsize=100, autoflush=0, adaptive=True)
+        self.assertEqual(buf.limits, (100, 1048576))
+        for _ in range(5):
+            buf._adapt(2.0)
+        # larger batches while the server is slow, but not larger than maxBytes
+        self.assertEqual(buf.limits, (800, 1048576))
+        for _ in range(10):
+            buf._adapt(0.01)
+        self.assertEqual(buf.limits, (25, 262144))
+        buf._adapt(0.5)
+        self.assertEqual(buf.limits, (25, 262144))
+
+    def test_blockingWrite(self):
+        buf = FixedSizeBuffer(self.slowSender, bufsize=1, autoflush=0, maxBatches=1, overflowPolicy="block")
+        buf.sender.blockTimeout = 1
+        buf.write("sent\n")
+        self.waitForSending(buf.sender)
+        buf.write("queued\n")
+        # waits for room, without holding the buffer lock
+        blocked = threading.Thread(target=buf.write, args=("blocked\n",))
+        blocked.start()
+        time.sleep(0.2)
+        self.assertTrue(blocked.is_alive())
+        start = time.time()
+        self.assertTrue(buf._rlock.acquire(timeout=0.5))
+        buf._rlock.release()
+        self.assertLess(time.time() - start, 0.5)
+        self.unblock.set()
+        blocked.join(5)
+        buf.flush()
+        self.assertEqual(self.sent, ["sent\n", "queued\n", "blocked\n"])
+        self.assertEqual(buf.sender.counters["dropped"], 0)
+
+    def test_overflowPolicies(self):
+        sender = BatchSender(self.slowSender, maxBatches=2, overflowPolicy="dropDebug")
+        sender.put("sent\n")
+        self.waitForSending(sender)
+        for batch in ["a DEBUG [Pilot] x\nb INFO [Pilot] y\n", "c DEBUG [Pilot] z\n", "d INFO [Pilot] w\n"]:
+            sender.put(batch)
+        self.assertEqual(list(sender._batches), ["b INFO [Pilot] y\n", "d INFO [Pilot] w\n"])
+        self.assertEqual(sender.droppedLines, 2)
+
+        sender = BatchSender(self.slowSender, maxBatches=1, overflowPolicy="block", blockTimeout=0.2)
+        sender.put("sent\n")
+        self.waitForSending(sender)
+        start = time.time()
+        for batch in ["waiting\n", "dropped\n"]:
+            sender.put(batch)
+        self.assertGreaterEqual(time.time() - start, 0.2)
+        self.assertEqual(sender.counters["dropped"], 1)
+        self.unblock.set()
+        self.assertTrue(sender.drain(5))
+        self.assertEqual(self.sent[-1], "waiting\n")
+
+        def failingSender(message):
+            raise IOError("unreachable")
+
+        sender = BatchSender(failingSender)
+        sender.put("lost\n")
+        self.assertTrue(sender.drain(5))
+        self.assertEqual(sender.counters["failed"], 1)
+
+        with self.assertRaises(ValueError):
+            BatchSender(failingSender, overflowPolicy="dropAll")
+
+
+class TestRemoteLogSpooler(unittest.TestCase):
+    def setUp(self):
+        self.testDir = tempfile.mkdtemp()
+        self.spoolFile = os.path.join(self.testDir, "pilot.remotelog.spool")
+        self.cwd = os.getcwd()
+        self.down = set()
+        self.calls = []
+        self.sent = []
+
+    def tearDown(self):
+        shutil.rmtree(self.testDir)
+
+    def sendFunc(self, url, method, message):
+        self.calls.append(url)
+        if url in self.down:
+            raise IOError("%s is down" % url)
+        self.sent.append((url, method, message))
+
+    def test_outage(self):
+        spooler = RemoteLogSpooler(["https://logger", None], self.sendFunc, self.spoolFile)
+        spooler("batch 0\n")
+        self.down.add("https://logger")
+        for i in range(1, 6):
+            spooler("batch %d\n" % i)
+        # the circuit breaker opened after 3 failures: the next batches were spooled without a request
+        self.assertEqual(self.calls, ["https://logger"] * 4)
+        self.assertTrue(spooler.isOpen)
+        self.assertEqual(spooler.counters["spooled"], 5)
+        self.assertTrue(os.path.exists(self.spoolFile))
+
+        # back: the spool is replayed first, in order
+        self.down.clear()
+        spooler.retryAt = 0
+        spooler("batch 6\n")
+        self.assertEqual([message for _, _, message in self.sent], ["batch %d\n" % i for i in range(7)])
+        self.assertEqual(spooler.counters, {"spooled": 5, "replayed": 5, "spoolDropped": 0, "failures": 0})
+        self.assertFalse(os.path.exists(self.spoolFile))
+
+    def test_failover(self):
+        spooler = RemoteLogSpooler(["https://logger", "https://failover"], self.sendFunc, self.spoolFile)
+        self.down.add("https://logger")
+        spooler("batch 0\n")
+        spooler("batch 1\n")
+        # the URL that works is tried first
+        self.assertEqual(self.calls, ["https://logger", "https://failover", "https://failover"])
+        self.assertEqual(spooler.counters["spooled"], 0)
+
+        self.down.add("https://failover")
+        for i in range(2, 5):
+            spooler("batch %d\n" % i)
+        self.assertTrue(spooler.isOpen)
+        # with the breaker open, only a forced attempt is made
+        self.assertFalse(spooler.send("finaliseLogs", {}))
+        self.down.clear()
+        self.assertTrue(spooler.replay(force=True))
+        self.assertEqual([message for _, _, message in self.sent][-3:], ["batch 2\n", "batch 3\n", "batch 4\n"])
+
+    def test_previousSpool(self):
+        os.chdir(self.testDir)
+        self.addCleanup(os.chdir, self.cwd)
+        self.down.add("https://logger")
+        RemoteLogSpooler(["https://logger"], self.sendFunc, pilotUUID="uuid1")("batch of uuid1\n")
+        self.assertTrue(os.path.exists("pilot.remotelog.uuid1.spool"))
+        self.down.clear()
+
+        # another pilot does not send it
+        RemoteLogSpooler(["https://logger"], self.sendFunc, pilotUUID="uuid2").replay()
+        self.assertEqual(self.sent, [])
+        # nor one without a UUID (it is dropped)
+        with open("pilot.remotelog.unknown.spool", "w") as fp:
+            fp.write('"batch of an unknown pilot\\n"\n')
+        RemoteLogSpooler(["https://logger"], self.sendFunc).replay()
+        self.assertEqual(self.sent, [])
+        self.assertFalse(os.path.exists("pilot.remotelog.unknown.spool"))
+        # the same pilot, again
+        self.assertTrue(RemoteLogSpooler(["https://logger"], self.sendFunc, pilotUUID="uuid1").replay())
+        self.assertEqual(self.sent, [("https://logger", "sendMessage", "batch of uuid1\n")])
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,195 @@
+"""Tests for the pilot credentials and the HTTPS transport (transportTools)"""
+
+import gzip
+import json
+import os
+import shutil
+import socketserver
+import ssl
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest.mock import patch
+from urllib.error import HTTPError
+from urllib.parse import parse_qs
+
+sys.path.insert(0, os.getcwd() + "/Pilot")
+
+from pilotTools import sendMessage
+from proxyTools import getVO
+from transportTools import HTTPSTransport, PilotCredentials
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    """http.server.ThreadingHTTPServer, that is only in Python >= 3.7"""
+
+    daemon_threads = True
+
+
+CERTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "certs")
+
+
+class LoggingHandler(BaseHTTPRequestHandler):
+    """Stand-in for the Tornado pilot logging service"""
+
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately: do not wait for delayed ACKs
+    disable_nagle_algorithm = True
+    # idle connections are closed by the server
+    timeout = 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.headers.get("Content-Encoding") == "gzip":
+            # compact format, not supported by "legacy" servers
+            status = 415 if "/legacy" in self.path else 200
+            if status == 200:
+                self.server.compact.append(json.loads(gzip.decompress(body)))
+        else:
+            status = 200
+            self.server.received.append((self.client_address, parse_qs(body.decode())))
+        answer = b"OK"
+        if self.path.endswith("/broken"):
+            status = 500
+        elif self.path.endswith("/unknown") and self.headers.get("Content-Encoding") == "gzip":
+            # a server answering the compact format with an S_ERROR
+            self.server.compact.pop()
+            answer = json.dumps({"OK": False, "Message": "Unknown method"}).encode()
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(answer)))
+        self.end_headers()
+        self.wfile.write(answer)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestPilotCredentials(unittest.TestCase):
+    def setUp(self):
+        self.testDir = tempfile.mkdtemp()
+        self.proxy = os.path.join(self.testDir, "x509up")
+        shutil.copy(os.path.join(CERTS, "voms/proxy.pem"), self.proxy)
+
+    def tearDown(self):
+        PilotCredentials.clear()
+        shutil.rmtree(self.testDir)
+
+    @patch("transportTools.getVO", wraps=getVO)
+    def test_proxy(self, getVOMock):
+        credentials = PilotCredentials.get(self.proxy, os.path.join(CERTS, "ca"))
+        self.assertIs(PilotCredentials.get(self.proxy, os.path.join(CERTS, "ca")), credentials)
+        self.assertFalse(credentials.isHost)
+        self.assertEqual(credentials.vo, "fakevo")
+        self.assertEqual(credentials.identity, "/O=Dirac Computing/O=CERN/CN=MrUser")
+        # the proxy expiry, the earliest of the chain
+        self.assertEqual(credentials.notAfter, 1720285905)
+        self.assertLess(credentials.timeLeft, 0)
+        # parsed once
+        self.assertEqual(getVOMock.call_count, 1)
+
+        # renewed: parsed again, new context
+        with open(os.path.join(CERTS, "user/usercert.pem"), "rb") as fp:
+            renewed = fp.read()
+        with open(os.path.join(CERTS, "user/userkey.pem"), "rb") as fp:
+            renewed += fp.read()
+        with open(self.proxy + ".new", "wb") as fp:
+            fp.write(renewed)
+        os.rename(self.proxy + ".new", self.proxy)
+        self.assertIsNone(credentials.vo)
+        self.assertEqual(credentials.identity, "/O=Dirac Computing/O=CERN/CN=MrUser")
+        self.assertEqual(getVOMock.call_count, 2)
+        context = credentials.context
+        self.assertIs(credentials.context, context)
+        os.utime(self.proxy, ns=(0, os.stat(self.proxy).st_mtime_ns + 1))
+        self.assertIsNot(credentials.context, context)
+
+    def test_host(self):
+        credentials = PilotCredentials.get(os.path.join(CERTS, "host"), os.path.join(CERTS, "ca"))
+        self.assertTrue(credentials.isHost)
+        self.assertIsNone(credentials.vo)
+        self.assertEqual(credentials.identity, "/O=Dirac Computing/O=CERN/CN=VOBox")
+        self.assertIsNotNone(credentials.context)
+        with self.assertRaises(IOError):
+            PilotCredentials.get(os.path.join(self.testDir, "missing")).vo
+
+
+class TestHTTPSTransport(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("localhost", 0), LoggingHandler)
+        self.server.received = []
+        self.server.compact = []
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(os.path.join(CERTS, "host/hostcert.pem"), os.path.join(CERTS, "host/hostkey.pem"))
+        self.server.socket = context.wrap_socket(self.server.socket, server_side=True)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "https://localhost:%d/WorkloadManagement/TornadoPilotLogging" % self.server.server_address[1]
+        self.environ = patch.dict(
+            os.environ, {"X509_CERT_DIR": os.path.join(CERTS, "ca"), "X509_USER_PROXY": os.path.join(CERTS, "host")}
+        )
+        self.environ.start()
+
+    def tearDown(self):
+        self.environ.stop()
+        HTTPSTransport.closeAll()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_sendMessage(self):
+        for i in range(3):
+            sendMessage(self.url, "uuid", "gridpp", "sendMessage", "message %d" % i)
+        transport = HTTPSTransport.get(self.url)
+        # one connection (TLS handshake), one SSL context
+        self.assertEqual(transport.connections, 1)
+        self.assertEqual(len({client for client, _ in self.server.received}), 1)
+        self.assertEqual(len(PilotCredentials._credentials), 1)
+        args = self.server.received[-1][1]
+        self.assertEqual(args["method"], ["sendMessage"])
+        self.assertEqual(args["extraCredentials"], ['"hosts"'])
+        self.assertEqual(json.loads(args["args"][0]), [json.dumps("message 2"), "uuid", "gridpp"])
+
+        # the server closed the idle connection: sent again on a new one
+        time.sleep(1.5)
+        sendMessage(self.url, "uuid", "gridpp", "finaliseLogs", {"retCode": "0"})
+        self.assertEqual(transport.connections, 2)
+        self.assertEqual(len(self.server.received), 4)
+
+        # renewed credentials: new context
+        context = transport.context
+        hostCert = os.path.join(CERTS, "host/hostcert.pem")
+        os.utime(hostCert, ns=(0, os.stat(hostCert).st_mtime_ns + 1))
+        sendMessage(self.url, "uuid", "gridpp", "sendMessage", "renewed")
+        self.assertIsNot(transport.context, context)
+
+        with self.assertRaises(HTTPError) as cm:
+            sendMessage(self.url + "/broken", "uuid", "gridpp", "sendMessage", "message")
+        self.assertEqual(cm.exception.code, 500)
+
+    def test_compact(self):
+        sendMessage(self.url, "uuid", "gridpp", "sendMessage", "line 1\nline 2\n", compact=True)
+        self.assertEqual(
+            self.server.compact,
+            [{"method": "sendMessage", "args": ["line 1\nline 2\n", "uuid", "gridpp"], "extraCredentials": "hosts"}],
+        )
+        self.assertTrue(HTTPSTransport.get(self.url).compactSupported[self.url])
+
+        # an older server: legacy format, from the first rejection on
+        for i in range(2):
+            sendMessage(self.url + "/legacy", "uuid", "gridpp", "sendMessage", "line %d" % i, compact=True)
+        self.assertEqual(len(self.server.compact), 1)
+        self.assertEqual([json.loads(args["args"][0])[0] for _, args in self.server.received], ['"line 0"', '"line 1"'])
+        self.assertIs(HTTPSTransport.get(self.url).compactSupported[self.url + "/legacy"], False)
+
+        # an older server, answering with an S_ERROR
+        self.server.received = []
+        for i in range(2):
+            sendMessage(self.url + "/unknown", "uuid", "gridpp", "sendMessage", "line %d" % i, compact=True)
+        self.assertEqual(len(self.server.compact), 1)
+        self.assertEqual([json.loads(args["args"][0])[0] for _, args in self.server.received], ['"line 0"', '"line 1"'])
+        self.assertIs(HTTPSTransport.get(self.url).compactSupported[self.url + "/unknown"], False)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,264 @@
+"""Micro-benchmarks of the pilot tools, run by hand (not collected by pytest):
+
+    python Pilot/tests/pilotBenchmarks.py [benchmark name ...]
+"""
+
+import gzip
+import json
+import os
+import socketserver
+import ssl
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlencode
+from urllib.request import urlopen
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from jsonTools import LazyJSONObject  # noqa: E402
+from pilotTools import OptionIndex, sendMessage  # noqa: E402
+from proxyTools import getVO, getVOWithOpenSSL  # noqa: E402
+from transportTools import HTTPSTransport, encodeMessage  # noqa: E402
+
+CERTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "certs")
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    """http.server.ThreadingHTTPServer, that is only in Python >= 3.7"""
+
+    daemon_threads = True
+
+
+benchmarks = {}
+
+
+def benchmark(func):
+    """Register a benchmark"""
+    benchmarks[func.__name__] = func
+    return func
+
+
+def timeIt(label, func, repeat):
+    """Run func repeat times, and print the rate"""
+    start = time.time()
+    for i in range(repeat):
+        func(i)
+    elapsed = time.time() - start
+    print("  %-40s %8.3f ms/call %10.1f calls/s" % (label, 1000 * elapsed / repeat, repeat / elapsed))
+    return elapsed
+
+
+class LoggingHandler(BaseHTTPRequestHandler):
+    """Stand-in for the Tornado pilot logging service"""
+
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately: do not wait for delayed ACKs
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"OK")
+
+    def log_message(self, *args):
+        pass
+
+
+def startHTTPSServer(handler=LoggingHandler):
+    """Start a local HTTPS server, with the test host certificate
+
+    :return: the server, and its URL
+    """
+    server = ThreadingHTTPServer(("localhost", 0), handler)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(os.path.join(CERTS, "host/hostcert.pem"), os.path.join(CERTS, "host/hostkey.pem"))
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "https://localhost:%d/WorkloadManagement/TornadoPilotLogging" % server.server_address[1]
+
+
+def legacySendMessage(url, pilotUUID, wnVO, method, rawMessage):
+    """sendMessage as it was: a new SSL context and connection for each message"""
+    context = ssl.create_default_context()
+    context.load_verify_locations(capath=os.getenv("X509_CERT_DIR"))
+    cert = os.getenv("X509_USER_PROXY")
+    context.load_cert_chain(os.path.join(cert, "hostcert.pem"), os.path.join(cert, "hostkey.pem"))
+    message = json.dumps((json.dumps(rawMessage), pilotUUID, wnVO))
+    data = urlencode({"method": method, "args": message, "extraCredentials": '"hosts"'}).encode("utf-8")
+    urlopen(url, data, context=context).close()
+
+
+@benchmark
+def sendMessages(repeat=200):
+    """Remote logger messages sent to a local HTTPS server"""
+    os.environ["X509_CERT_DIR"] = os.path.join(CERTS, "ca")
+    os.environ["X509_USER_PROXY"] = os.path.join(CERTS, "host")
+    server, url = startHTTPSServer()
+    message = "2024-01-31T12:34:56.123456Z INFO [Pilot] a line of the pilot log\n" * 10
+    try:
+        legacy = timeIt(
+            "new context and connection per message",
+            lambda i: legacySendMessage(url, "uuid", "vo", "sendMessage", message),
+            repeat,
+        )
+        pooled = timeIt(
+            "cached context, kept-alive connection",
+            lambda i: sendMessage(url, "uuid", "vo", "sendMessage", message),
+            repeat,
+        )
+        print("  speed-up: x%.1f" % (legacy / pooled))
+    finally:
+        HTTPSTransport.closeAll()
+        server.shutdown()
+        server.server_close()
+
+
+def pilotLogBatch(lines=1000):
+    """A remote logger batch, with JobAgent-like output"""
+    return "".join(
+        '2024-01-31T12:34:56.%06dZ INFO [JobAgent] Job 12345%03d: {"Status": "Running", "MinorStatus": '
+        '"Application", "Site": "LCG.Example.org", "CPU": %d}\n' % (i, i % 1000, i)
+        for i in range(lines)
+    )
+
+
+@benchmark
+def wireFormat(repeat=200):
+    """Size of a 1000-line remote logger batch, and time to decode it on the server"""
+    batch = pilotLogBatch()
+
+    def decodeLegacy(body):
+        args = parse_qs(body.decode())["args"][0]
+        return json.loads(json.loads(args)[0])
+
+    def decodeCompact(body):
+        return json.loads(gzip.decompress(body))["args"][0]
+
+    results = {}
+    for compact, decode in [(False, decodeLegacy), (True, decodeCompact)]:
+        label = "compact" if compact else "legacy"
+        body, _headers = encodeMessage("sendMessage", batch, "uuid", "vo", isHost=True, compact=compact)
+        assert decode(body) == batch
+        print("  %-40s %8d bytes (log text: %d)" % (label + " message", len(body), len(batch)))
+        timeIt(
+            label + " encode (pilot)", lambda i: encodeMessage("sendMessage", batch, "u", "vo", True, compact), repeat
+        )
+        results[label] = (len(body), timeIt(label + " decode (server)", lambda i: decode(body), repeat))
+    print(
+        "  bytes: /%.1f, server decode time: /%.1f"
+        % (results["legacy"][0] / results["compact"][0], results["legacy"][1] / results["compact"][1])
+    )
+
+
+@benchmark
+def proxyVO(repeat=50):
+    """VO of the test VOMS proxy (3 certificates), as done when the pilot starts"""
+    with open(os.path.join(CERTS, "voms", "proxy.pem"), "rb") as fp:
+        proxy = fp.read()
+    assert getVO(proxy) == getVOWithOpenSSL(proxy)
+    forks = timeIt("openssl x509 and asn1parse", lambda i: getVOWithOpenSSL(proxy), repeat)
+    parsed = timeIt("DER decoded in Python", lambda i: getVO(proxy), repeat)
+    print("  speed-up: x%.1f" % (forks / parsed))
+
+
+def syntheticPilotJSON(vos=200, setups=5, ces=5000):
+    """A large pilot.json, in the VO-based schema"""
+    options = {"RemoteLogging": "True", "RemoteLoggerURL": "https://logger.example.org", "Version": "v8.0.1"}
+    options["Commands"] = {"CE%d" % i: "CheckWorkerNode, InstallDIRAC, LaunchAgent" for i in range(20)}
+    pilotJSON = {"Defaults": {"Pilot": dict(options)}, "ConfigurationServers": ["dips://cs.example.org:9135"]}
+    for vo in range(vos):
+        section = pilotJSON["vo%d" % vo] = {"Pilot": {"UploadSE": "SE-%d" % vo}, "Defaults": {"Pilot": dict(options)}}
+        for setup in range(setups):
+            section["Setup%d" % setup] = {"Pilot": {"Version": "v8.0.%d" % setup}}
+    pilotJSON["CEs"] = {
+        "ce%d.example.org" % i: {"Site": "LCG.Site%d.org" % (i % 500), "GridCEType": "CE1"} for i in range(ces)
+    }
+    return pilotJSON
+
+
+def legacyGetOptionForPaths(paths, inDict):
+    """getOptionForPaths as it was: it adds the missing sections to inDict"""
+    outDict = {}
+    for path in paths:
+        target = inDict
+        for elem in path.strip("/").split("/"):
+            target = target.setdefault(elem, {})
+        outDict.update(target)
+    return outDict
+
+
+@benchmark
+def pilotOptions(repeat=2000):
+    """Options of a pilot (a VO, setup and CE type) resolved from a large pilot.json"""
+    pilotJSON = syntheticPilotJSON()
+    print("  %-40s %8d bytes" % ("pilot.json", len(json.dumps(pilotJSON))))
+
+    def paths(i):
+        vo, setup = "vo%d" % (i % 250), "Setup%d" % (i % 7)
+        return ["/Defaults/Pilot", "/%s/Pilot" % setup, "/%s/Defaults/Pilot" % vo, "/%s/%s/Pilot" % (vo, setup)]
+
+    def legacy(i):
+        options = legacyGetOptionForPaths(paths(i), pilotJSON)
+        commands = options.get("Commands", {})
+        return [options.get("Version"), options.get("RemoteLoggerURL"), commands.get("CE3", commands.get("Defaults"))]
+
+    def indexed(i):
+        options = OptionIndex(pilotJSON, paths(i))
+        commands = options.get(["Commands/CE3", "Commands/Defaults"])
+        return [options.get("Version"), options.get("RemoteLoggerURL"), commands]
+
+    for i in range(100):
+        assert legacy(i) == indexed(i)
+    size = len(json.dumps(pilotJSON))
+    timeIt("setdefault walk, shallow merge", legacy, repeat)
+    timeIt("flattened index", indexed, repeat)
+    print("  the setdefault walk added %d bytes of empty sections" % (len(json.dumps(pilotJSON)) - size))
+
+
+@benchmark
+def lazyPilotJSON(repeat=5):
+    """Loading a 50 MB pilot.json, and reading what a pilot needs: memory kept, and time"""
+    pilotJSON = syntheticPilotJSON(vos=500, ces=25000)
+    queue = {"LocalCEType": "Pool", "MaxTotalJobs": 1000, "Tag": ["MultiProcessor"] * 5}
+    for ce in pilotJSON["CEs"].values():
+        ce.update({"Queue%d" % q: dict(queue) for q in range(8)})
+    pilotJSON = {"timestamp": "2024-01-31T12:34:56.123456", **pilotJSON}
+    fd, path = tempfile.mkstemp(suffix=".json")
+    with os.fdopen(fd, "w") as fp:
+        json.dump(pilotJSON, fp, indent=2)
+    del pilotJSON
+    print("  %-40s %8.1f MB" % ("pilot.json", os.path.getsize(path) / 1e6))
+
+    def read(pilotJSON, i):
+        ce = pilotJSON["CEs"]["ce%d.example.org" % (i * 7919 % 25000)]
+        options = OptionIndex(pilotJSON, ["/Defaults/Pilot", "/vo%d/Defaults/Pilot" % i, "/vo%d/Pilot" % i])
+        return pilotJSON["timestamp"], ce["Site"], options.get("Version"), pilotJSON["ConfigurationServers"]
+
+    def load(loader, i):
+        with open(path, "rb") as fp:
+            return loader(fp) if loader else LazyJSONObject.load(path)
+
+    try:
+        for label, loader in [("json.load", json.load), ("LazyJSONObject", None)]:
+            tracemalloc.start()
+            pilotJSON = load(loader, 0)
+            read(pilotJSON, 0)
+            kept = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del pilotJSON
+            print("  %-40s %8.1f MB" % (label + ": memory kept", kept / 1e6))
+            timeIt(label + ": load and read", lambda i: read(load(loader, i), i), repeat)
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or sorted(benchmarks):
+        print("%s: %s" % (name, benchmarks[name].__doc__))
+        benchmarks[name]()
@@ -0,0 +1,12 @@
+"""Threading helpers shared by the pilot tools"""
+
+from functools import wraps
+
+
+def synchronized(func):
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self._rlock:
+            return func(self, *args, **kwargs)
+
+    return wrapper
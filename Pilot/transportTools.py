@@ -0,0 +1,303 @@
+"""Credentials of the pilot, and HTTPS transport to the DIRAC services"""
+
+import gzip
+import json
+import os
+import ssl
+import time
+from http.client import HTTPException, HTTPSConnection
+from io import BytesIO
+from threading import RLock
+from urllib.error import HTTPError
+from urllib.parse import urlencode, urlparse
+from urllib.request import getproxies, proxy_bypass
+
+from proxyTools import getCertificatesInfo, getIdentity, getVO
+from threadTools import synchronized
+
+
+class PilotCredentials(object):
+    """The pilot credentials: a proxy, or a directory with a host certificate and key (hostcert/key.pem).
+
+    The credential file is read and parsed once, for the VO, the identity (DN) and the end of validity,
+    and the SSL context is created once, for all the network clients. The files are checked with a
+    stat() only: all this is done again when a renewed proxy, or a new CA or CRL, is found.
+    """
+
+    _rlock = RLock()
+    # credentials, by (cert, caPath)
+    _credentials = {}
+
+    def __init__(self, cert, caPath=None):
+        """c'tor
+
+        :param str cert: the proxy, or a directory with hostcert.pem and hostkey.pem
+        :param str caPath: the CA directory (None: the system CAs)
+        """
+        self.cert = cert
+        self.caPath = caPath
+        self.isHost = bool(cert) and os.path.isdir(cert)
+        if self.isHost:
+            self.files = [os.path.join(cert, "hostcert.pem"), os.path.join(cert, "hostkey.pem")]
+        else:
+            self.files = [cert]
+        self._rlock = RLock()
+        self._signature = None
+        self._info = None
+        self._context = None
+        self._contextSignature = None
+
+    @classmethod
+    def get(cls, cert=None, caPath=None):
+        """The (shared) credentials, by default those of X509_USER_PROXY and X509_CERT_DIR"""
+        cert = cert or os.getenv("X509_USER_PROXY")
+        caPath = caPath or os.getenv("X509_CERT_DIR")
+        with cls._rlock:
+            credentials = cls._credentials.get((cert, caPath))
+            if credentials is None:
+                credentials = cls._credentials[(cert, caPath)] = cls(cert, caPath)
+            return credentials
+
+    @classmethod
+    def clear(cls):
+        """Forget all the credentials, and their SSL contexts"""
+        with cls._rlock:
+            cls._credentials.clear()
+
+    @staticmethod
+    def signature(paths):
+        """What tells that files changed: their inode, modification time and size"""
+        signature = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+                signature.append((st.st_ino, st.st_mtime_ns, st.st_size))
+            except (OSError, TypeError):
+                signature.append(None)
+        return signature
+
+    @synchronized
+    def _getInfo(self):
+        """The VO, identity and end of validity of the credentials, parsed again if the file changed
+
+        :raises IOError: if the credentials can't be read
+        """
+        signature = self.signature(self.files[:1])
+        if self._info is None or signature != self._signature:
+            with open(self.files[0], "rb") as fp:
+                data = fp.read()
+            info = {"vo": None, "identity": None, "notAfter": None}
+            try:
+                certificates = getCertificatesInfo(data)
+                info["identity"] = getIdentity(certificates)
+                info["notAfter"] = min([cert["notAfter"] for cert in certificates] or [None])
+            except ValueError:
+                pass
+            if not self.isHost:
+                try:
+                    info["vo"] = getVO(data)
+                except NotImplementedError:
+                    # no VOMS extension
+                    pass
+            self._info = info
+            self._signature = signature
+        return self._info
+
+    @property
+    def vo(self):
+        """The VO of the proxy (None if there is none)"""
+        return self._getInfo()["vo"]
+
+    @property
+    def identity(self):
+        """The DN of the owner of the credentials"""
+        return self._getInfo()["identity"]
+
+    @property
+    def notAfter(self):
+        """The end of validity of the credentials, in seconds since the epoch"""
+        return self._getInfo()["notAfter"]
+
+    @property
+    def timeLeft(self):
+        """Seconds until the credentials expire (negative once they have)"""
+        notAfter = self.notAfter
+        return None if notAfter is None else notAfter - time.time()
+
+    @property
+    @synchronized
+    def context(self):
+        """The SSL context authenticating with these credentials, re-created if they (or the CAs) changed"""
+        # the directory mtime changes when CAs or CRLs are added or removed
+        signature = self.signature([self.caPath] + self.files)
+        if self._context is None or signature != self._contextSignature:
+            context = ssl.create_default_context()
+            if self.caPath:
+                context.load_verify_locations(capath=self.caPath)
+            context.load_cert_chain(*self.files)  # a proxy, or a host certificate and key
+            self._context = context
+            self._contextSignature = signature
+        return self._context
+
+
+class HTTPSTransport(object):
+    """Keep-alive HTTPS connection to a (logging) server, authenticated with the pilot credentials.
+
+    The SSL context is the one of the PilotCredentials, re-created only when they are renewed.
+    There is one transport per server, shared by all the callers (remote loggers, logFinalizer).
+    """
+
+    _rlock = RLock()
+    # transports, by (host, port)
+    _transports = {}
+
+    def __init__(self, host, port=443, timeout=60):
+        """c'tor
+
+        :param str host: server host
+        :param int port: server port
+        :param int timeout: socket timeout in seconds
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.connection = None
+        self.context = None
+        # number of connections opened (i.e. TLS handshakes)
+        self.connections = 0
+        # whether the server accepts the compact message format, by URL (missing: not known yet)
+        self.compactSupported = {}
+        self._rlock = RLock()
+
+    @classmethod
+    def get(cls, url):
+        """The (shared) transport to the server of a URL"""
+        parsed = urlparse(url)
+        key = (parsed.hostname, parsed.port or 443)
+        with cls._rlock:
+            transport = cls._transports.get(key)
+            if transport is None:
+                transport = cls._transports[key] = cls(*key)
+            return transport
+
+    @classmethod
+    def closeAll(cls):
+        """Close all the connections, and forget the cached SSL contexts"""
+        with cls._rlock:
+            for transport in cls._transports.values():
+                transport.close()
+            cls._transports.clear()
+            PilotCredentials.clear()
+
+    def _connect(self):
+        """Open a new connection, through the HTTPS proxy if there is one"""
+        proxy = getproxies().get("https")
+        if proxy and not proxy_bypass(self.host):
+            parsedProxy = urlparse(proxy if "://" in proxy else "http://" + proxy)
+            connection = HTTPSConnection(
+                parsedProxy.hostname, parsedProxy.port or 8080, timeout=self.timeout, context=self.context
+            )
+            connection.set_tunnel(self.host, self.port)
+        else:
+            connection = HTTPSConnection(self.host, self.port, timeout=self.timeout, context=self.context)
+        self.connections += 1
+        return connection
+
+    @synchronized
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    @synchronized
+    def post(self, url, data, context, headers=None):
+        """POST data, over the kept-alive connection if there is one (re-connecting once if it was closed)
+
+        :param str url: the URL
+        :param bytes data: the data (by default, urlencoded)
+        :param context: the SSL context
+        :param dict headers: request headers, e.g. the content type
+        :return: the response body
+        :rtype: bytes
+        :raises HTTPError: if the server answers with an error
+        """
+        if context is not self.context:
+            # new credentials
+            self.close()
+            self.context = context
+        parsed = urlparse(url)
+        path = parsed.path or "/"
+        if parsed.query:
+            path += "?" + parsed.query
+        headers = dict(headers or {"Content-Type": "application/x-www-form-urlencoded"}, Connection="keep-alive")
+
+        for attempt in range(2):
+            reused = self.connection is not None
+            if not reused:
+                self.connection = self._connect()
+            try:
+                self.connection.request("POST", path, data, headers)
+                response = self.connection.getresponse()
+                body = response.read()
+            except (HTTPException, ConnectionError, ssl.SSLError):
+                self.close()
+                # the server may have closed an idle connection: try again, once, on a new one
+                if reused and attempt == 0:
+                    continue
+                raise
+            except Exception:
+                self.close()
+                raise
+            if response.will_close:
+                self.close()
+            if response.status >= 400:
+                raise HTTPError(url, response.status, response.reason, response.msg, BytesIO(body))
+            return body
+
+
+def encodeMessage(method, rawMessage, pilotUUID, wnVO, isHost=False, compact=False):
+    """
+    Encode a message for the Tornado pilot logging server.
+
+    The legacy format is a form with the arguments JSON-encoded twice. The compact format is a single
+    JSON document, gzip-compressed.
+
+    :param str method: a method to be invoked
+    :param rawMessage: a message to be sent (JSON-serialisable)
+    :param str pilotUUID: pilot unique ID
+    :param str wnVO: VO name, relevant only if not contained in a proxy
+    :param bool isHost: the pilot uses a host certificate
+    :param bool compact: use the compact format
+    :return: (body, headers)
+    :rtype: tuple
+    """
+    if compact:
+        document = {"method": method, "args": [rawMessage, pilotUUID, wnVO]}
+        if isHost:
+            document["extraCredentials"] = "hosts"
+        body = gzip.compress(json.dumps(document, separators=(",", ":")).encode("utf-8"), compresslevel=6)
+        return body, {"Content-Type": "application/json", "Content-Encoding": "gzip"}
+
+    message = json.dumps((json.dumps(rawMessage), pilotUUID, wnVO))
+
+    raw_data = {"method": method, "args": message}
+    if isHost:  # a dir containing cert and key
+        raw_data["extraCredentials"] = '"hosts"'
+
+    data = urlencode(raw_data).encode("utf-8")  # encode to bytes
+    return data, {"Content-Type": "application/x-www-form-urlencoded"}
+
+
+def isErrorResponse(body):
+    """
+    Whether a response body is a DIRAC S_ERROR structure, as returned (with HTTP 200) by a Tornado server
+    not knowing the compact format.
+
+    :param bytes body: the response body
+    :return: bool
+    """
+    try:
+        result = json.loads(body.decode("utf-8"))
+    except ValueError:
+        return False
+    return isinstance(result, dict) and result.get("OK") is False
@@ -17,7 +17,9 @@ prepareForPilot(){
   echo '==> [prepareForPilot]'
 
   #get the pilot files from the Pilot
-  for file in dirac-pilot.py pilotCommands.py pilotTools.py proxyTools.py
+  for file in dirac-pilot.py pilotCommands.py pilotTools.py proxyTools.py \
+              cfgTools.py cvmfsTools.py fileSystemTools.py jsonTools.py mjfTools.py \
+              processTools.py remoteLogTools.py schedulerTools.py threadTools.py transportTools.py
   do
     cp "$TESTCODE/Pilot/Pilot/${file}" .
   done
@@ -38,7 +40,9 @@ prepareForPilot(){
 }
 
 cleanPilot(){
-  for file in dirac-pilot.py pilotCommands.py pilotTools.py pilot.cfg pilot.json
+  for file in dirac-pilot.py pilotCommands.py pilotTools.py proxyTools.py \
+              cfgTools.py cvmfsTools.py fileSystemTools.py jsonTools.py mjfTools.py \
+              processTools.py remoteLogTools.py schedulerTools.py threadTools.py transportTools.py pilot.cfg pilot.json
   do
     rm -f "${file}"
   done